@@ -0,0 +1,371 @@
+"""
+Vectorized analytics over the transactions table.
+
+The rows of a date range are read with a chunked cursor into columnar NumPy
+arrays (date_key, amount, income flag, item code). Group-bys, rolling
+windows, percentiles and period-over-period deltas are then computed on the
+arrays, and only a compact summary is returned to the query agent.
+
+Transactions moved to the cold-storage archive (db/archive.py) are read
+from the archive files whose period overlaps the range and appended to the
+slice.
+
+Loaded slices and finished results are cached per (database, table version),
+so a dashboard that asks for the trend, the top items and the percentiles of
+the same range reads the table once.
+"""
+import sqlite3
+from dataclasses import dataclass
+from datetime import date, timedelta
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from config import ANALYTICS_SETTING
+from db import archive
+from db.db_init import date_key
+from db.sandbox import QueryRejected, estimate_rows
+from message_encoding import records
+from query_cache import LRUCache
+from tracing import sql_span
+
+ANALYSES = ("trend", "top_items", "rolling", "percentiles", "compare")
+PERCENTILES = (50, 75, 90, 95, 99)
+
+
+@dataclass
+class TransactionSlice:
+    """Columnar copy of the transactions in one date range"""
+
+    days: np.ndarray       # datetime64[D]
+    amounts: np.ndarray    # float64
+    income: np.ndarray     # bool，True 為收入
+    item_codes: np.ndarray  # int32，索引到 items
+    items: List[str]
+
+    def __len__(self) -> int:
+        return len(self.amounts)
+
+
+def to_days(keys: np.ndarray) -> np.ndarray:
+    """Convert integer YYYYMMDD keys to datetime64[D] without a Python loop"""
+    keys = keys.astype(np.int64)
+    months = (keys // 10000 - 1970) * 12 + (keys // 100 % 100 - 1)
+    return months.astype('datetime64[M]').astype('datetime64[D]') + (keys % 100 - 1)
+
+
+def period_codes(days: np.ndarray, period: str) -> np.ndarray:
+    """Map days to the first day of their day/week (Monday)/month period"""
+    if period == "month":
+        return days.astype('datetime64[M]').astype('datetime64[D]')
+    if period == "week":
+        # 1970-01-01 是星期四：(天數 + 3) % 7 即為 0=星期一 的星期序
+        weekday = (days.astype(np.int64) + 3) % 7
+        return days - weekday
+    return days
+
+
+def load_slice(conn: sqlite3.Connection, table: str, start: str, end: str,
+               transaction_type: str = None, chunk_rows: int = None,
+               max_rows: int = None) -> TransactionSlice:
+    """Read the transactions between start and end (inclusive) into NumPy arrays"""
+    chunk_rows = chunk_rows or ANALYTICS_SETTING['CHUNK_ROWS']
+    max_rows = max_rows or ANALYTICS_SETTING['MAX_ROWS']
+    where, params = "date_key BETWEEN ? AND ?", [date_key(start), date_key(end)]
+    if transaction_type:
+        where += " AND transaction_type = ?"
+        params.append(transaction_type)
+
+    # 先用覆蓋索引數列數，超過上限時不載入，同時可預先配置陣列
+    total = conn.execute(f"SELECT COUNT(*) FROM {table} WHERE {where}", params).fetchone()[0]
+    if total > max_rows:
+        raise QueryRejected(
+            "too_many_rows",
+            f"The range {start} to {end} has {total} transactions, more than the {max_rows} that can be analyzed at once.",
+            "Narrow the date range, or use summarize_transactions for plain totals.",
+        )
+
+    keys = np.empty(total, dtype=np.int32)
+    amounts = np.empty(total, dtype=np.float64)
+    income = np.empty(total, dtype=bool)
+    item_codes = np.empty(total, dtype=np.int32)
+    index: Dict[str, int] = {}
+
+    # 範圍涵蓋大部分交易時，依 rowid 循序掃描比逐列回表查 idx_date_key 快數倍
+    source = f"{table} NOT INDEXED" if total * 4 > estimate_rows(conn, table) else table
+    sql = f"SELECT date_key, amount, transaction_type = 'Income', item FROM {source} WHERE {where}"
+    with sql_span(sql) as trace:
+        cursor = conn.cursor()
+        cursor.row_factory = None  # tuple 比 sqlite3.Row 快，且可直接 zip 成欄
+        cursor.execute(sql, params)
+        filled = 0
+        while filled < total:
+            rows = cursor.fetchmany(chunk_rows)
+            if not rows:
+                break
+            n = min(len(rows), total - filled)
+            columns = list(zip(*rows[:n]))
+            keys[filled:filled + n] = columns[0]
+            amounts[filled:filled + n] = columns[1]
+            income[filled:filled + n] = columns[2]
+            item_codes[filled:filled + n] = [index.setdefault(item, len(index)) for item in columns[3]]
+            filled += n
+        cursor.close()
+        trace.set(rows=filled)
+
+    # 載入期間若有列被刪除，只保留實際讀到的部分
+    return TransactionSlice(
+        days=to_days(keys[:filled]),
+        amounts=amounts[:filled],
+        income=income[:filled],
+        item_codes=item_codes[:filled],
+        items=list(index),
+    )
+
+
+def add_archived(data: TransactionSlice, archived, start: str, end: str, max_rows: int = None) -> TransactionSlice:
+    """data plus the archived rows of the same range (db/archive.py ArchivedRows, or None)"""
+    if archived is None:
+        return data
+    max_rows = max_rows or ANALYTICS_SETTING['MAX_ROWS']
+    total = len(data) + len(archived)
+    if total > max_rows:
+        raise QueryRejected(
+            "too_many_rows",
+            f"The range {start} to {end} has {total} transactions, more than the {max_rows} that can be analyzed at once.",
+            "Narrow the date range, or use summarize_transactions for plain totals.",
+        )
+    # 封存檔有自己的項目字典，改編到切片的 items 上
+    index = {item: i for i, item in enumerate(data.items)}
+    remap = np.array([index.setdefault(item, len(index)) for item in archived.items.tolist()], dtype=np.int32)
+    return TransactionSlice(
+        days=np.concatenate([to_days(archived.date_keys), data.days]),
+        amounts=np.concatenate([archived.amounts, data.amounts]),
+        income=np.concatenate([archived.is_income(), data.income]),
+        item_codes=np.concatenate([remap[archived.item_codes], data.item_codes]),
+        items=list(index),
+    )
+
+
+def _round(value: float) -> float:
+    return round(float(value), 2)
+
+
+def _change_pct(current: float, previous: float) -> Optional[float]:
+    return _round((current - previous) / previous * 100) if previous else None
+
+
+def _type_masks(data: TransactionSlice, transaction_type: str = None) -> List[Tuple[str, np.ndarray]]:
+    masks = [("Expense", ~data.income), ("Income", data.income)]
+    return [(name, mask) for name, mask in masks if transaction_type in (None, name)]
+
+
+def _label(day: np.datetime64, period: str) -> str:
+    return str(day.astype('datetime64[M]')) if period == "month" else str(day)
+
+
+def _downsample(n: int, max_points: int) -> np.ndarray:
+    """Evenly spaced indexes into a series of length n, always keeping the last point"""
+    if n <= max_points:
+        return np.arange(n)
+    return np.unique(np.linspace(0, n - 1, max_points).round().astype(np.int64))
+
+
+def trend(data: TransactionSlice, start: str, end: str, period: str = "month",
+          transaction_type: str = None, max_points: int = None) -> Dict[str, Any]:
+    """Totals per period with the change from the previous period"""
+    max_points = max_points or ANALYTICS_SETTING['MAX_POINTS']
+    first = period_codes(np.array([start], dtype='datetime64[D]'), period)[0]
+    last = period_codes(np.array([end], dtype='datetime64[D]'), period)[0]
+    starts = np.unique(period_codes(np.arange(first, last + 1), period))
+    codes = np.searchsorted(starts, period_codes(data.days, period))
+
+    series = []
+    for name, mask in _type_masks(data, transaction_type):
+        totals = np.bincount(codes[mask], weights=data.amounts[mask], minlength=len(starts))
+        counts = np.bincount(codes[mask], minlength=len(starts))
+        deltas = np.diff(totals, prepend=np.nan)
+        for i in range(len(starts)):
+            series.append((
+                _label(starts[i], period),
+                name,
+                _round(totals[i]),
+                int(counts[i]),
+                None if i == 0 else _round(deltas[i]),
+                None if i == 0 else _change_pct(totals[i], totals[i - 1]),
+            ))
+    periods = len(starts)
+    truncated = periods > max_points
+    if truncated:
+        # 只保留最新的 max_points 個期間
+        keep = {_label(day, period) for day in starts[-max_points:]}
+        series = [row for row in series if row[0] in keep]
+    return {
+        "period": period, "periods": periods, "truncated": truncated,
+        "series": records(["period", "transaction_type", "total", "count", "delta", "change_pct"], series),
+    }
+
+
+def top_items(data: TransactionSlice, transaction_type: str = None, limit: int = 10) -> Dict[str, Any]:
+    """Items ranked by total, with their share of the type's total"""
+    result = {}
+    for name, mask in _type_masks(data, transaction_type or "Expense"):
+        totals = np.bincount(data.item_codes[mask], weights=data.amounts[mask], minlength=len(data.items))
+        counts = np.bincount(data.item_codes[mask], minlength=len(data.items))
+        grand_total = totals.sum()
+        order = np.argsort(-totals, kind="stable")[:limit]
+        result[name] = {
+            "total": _round(grand_total),
+            "distinct_items": int((counts > 0).sum()),
+            "items": records(["item", "total", "count", "average", "share_pct"], [
+                (
+                    data.items[i],
+                    _round(totals[i]),
+                    int(counts[i]),
+                    _round(totals[i] / counts[i]),
+                    _round(totals[i] / grand_total * 100) if grand_total else None,
+                )
+                for i in order if counts[i] > 0
+            ]),
+        }
+    return result
+
+
+def rolling(data: TransactionSlice, start: str, end: str, window: int = 30,
+            transaction_type: str = None, max_points: int = None) -> Dict[str, Any]:
+    """Rolling average of daily totals (days without transactions count as 0)"""
+    max_points = max_points or ANALYTICS_SETTING['MAX_POINTS']
+    first = np.datetime64(start, 'D')
+    n_days = int((np.datetime64(end, 'D') - first).astype(np.int64)) + 1
+    window = max(1, min(window, n_days))
+    offsets = (data.days - first).astype(np.int64)
+
+    result = {"window": window}
+    for name, mask in _type_masks(data, transaction_type or "Expense"):
+        daily = np.bincount(offsets[mask], weights=data.amounts[mask], minlength=n_days)
+        cumulative = np.concatenate(([0.0], np.cumsum(daily)))
+        averages = (cumulative[window:] - cumulative[:-window]) / window
+        days = first + np.arange(window - 1, n_days)
+        keep = _downsample(len(averages), max_points)
+        result[name] = {
+            "latest": _round(averages[-1]),
+            "min": {"date": str(days[averages.argmin()]), "value": _round(averages.min())},
+            "max": {"date": str(days[averages.argmax()]), "value": _round(averages.max())},
+            "series": records(["date", "value"], [(str(days[i]), _round(averages[i])) for i in keep]),
+        }
+    return result
+
+
+def percentiles(data: TransactionSlice, transaction_type: str = None) -> Dict[str, Any]:
+    """Distribution of single transaction amounts"""
+    result = {}
+    for name, mask in _type_masks(data, transaction_type):
+        amounts = data.amounts[mask]
+        if not len(amounts):
+            continue
+        values = np.percentile(amounts, PERCENTILES)
+        result[name] = {
+            "count": int(len(amounts)),
+            "mean": _round(amounts.mean()),
+            "std": _round(amounts.std()),
+            "min": _round(amounts.min()),
+            "max": _round(amounts.max()),
+            **{f"p{p}": _round(v) for p, v in zip(PERCENTILES, values)},
+        }
+    return result
+
+
+def compare(data: TransactionSlice, start: str, end: str, transaction_type: str = None,
+            limit: int = 10) -> Dict[str, Any]:
+    """Totals of [start, end] against the equally long period right before it, with the biggest item movers"""
+    current = data.days >= np.datetime64(start, 'D')
+    previous_end = (date.fromisoformat(start) - timedelta(days=1)).isoformat()
+    result = {"previous_range": {"start_date": previous_start(start, end), "end_date": previous_end}}
+    for name, mask in _type_masks(data, transaction_type):
+        now, before = mask & current, mask & ~current
+        totals_now = np.bincount(data.item_codes[now], weights=data.amounts[now], minlength=len(data.items))
+        totals_before = np.bincount(data.item_codes[before], weights=data.amounts[before], minlength=len(data.items))
+        changes = totals_now - totals_before
+        movers = np.argsort(-np.abs(changes), kind="stable")[:limit]
+        total_now, total_before = totals_now.sum(), totals_before.sum()
+        result[name] = {
+            "current": _round(total_now),
+            "previous": _round(total_before),
+            "delta": _round(total_now - total_before),
+            "change_pct": _change_pct(total_now, total_before),
+            "count_current": int(now.sum()),
+            "count_previous": int(before.sum()),
+            "movers": records(["item", "current", "previous", "delta"], [
+                (data.items[i], _round(totals_now[i]), _round(totals_before[i]), _round(changes[i]))
+                for i in movers if changes[i]
+            ]),
+        }
+    return result
+
+
+def previous_start(start: str, end: str) -> str:
+    length = date.fromisoformat(end) - date.fromisoformat(start) + timedelta(days=1)
+    return (date.fromisoformat(start) - length).isoformat()
+
+
+class Analytics:
+    """Runs analyses on cached slices; both are keyed by the table version"""
+
+    def __init__(self, setting: Dict[str, Any] = None):
+        setting = setting or ANALYTICS_SETTING
+        self.slices = LRUCache(setting['CACHE_SIZE'])
+        self.results = LRUCache(setting['CACHE_SIZE'] * 8)
+
+    def get_slice(self, manager, table: str, start: str, end: str, transaction_type: str = None) -> TransactionSlice:
+        key = (manager.db_path, table, start, end, transaction_type, manager.write_version)
+        data = self.slices.get(key)
+        if data is None:
+            with manager.reader() as conn:
+                data = load_slice(conn, table, start, end, transaction_type)
+                # 早於封存截止日的交易在封存檔，只讀與範圍重疊的檔案
+                entries = archive.manifest(conn, table, date_key(start), date_key(end))
+            if entries:
+                archived = archive.load(manager.db_path, entries, date_key(start), date_key(end), transaction_type)
+                data = add_archived(data, archived, start, end)
+            self.slices.put(key, data)
+        return data
+
+    def analyze(self, manager, table: str, analysis: str, start: str, end: str,
+                transaction_type: str = None, period: str = "month", window: int = 30,
+                limit: int = 10) -> Dict[str, Any]:
+        """Run one analysis over [start, end] and return a JSON-ready summary"""
+        if analysis not in ANALYSES:
+            raise ValueError(f"Unknown analysis {analysis!r}, expected one of {', '.join(ANALYSES)}")
+        key = (manager.db_path, table, analysis, start, end, transaction_type, period, window, limit,
+               manager.write_version)
+        cached = self.results.get(key)
+        if cached is not None:
+            return dict(cached, cached=True)
+
+        # compare 需要前一段等長期間，一次載入兩段
+        load_start = previous_start(start, end) if analysis == "compare" else start
+        data = self.get_slice(manager, table, load_start, end, transaction_type)
+        if analysis == "trend":
+            body = trend(data, start, end, period, transaction_type)
+        elif analysis == "top_items":
+            body = top_items(data, transaction_type, limit)
+        elif analysis == "rolling":
+            body = rolling(data, start, end, window, transaction_type)
+        elif analysis == "percentiles":
+            body = percentiles(data, transaction_type)
+        else:
+            body = compare(data, start, end, transaction_type, limit)
+
+        result = {"analysis": analysis, "start_date": start, "end_date": end, "rows": len(data), **body}
+        self.results.put(key, result)
+        return dict(result, cached=False)
+
+    def clear(self) -> None:
+        self.slices.clear()
+        self.results.clear()
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {'slices': self.slices.get_stats(), 'results': self.results.get_stats()}
+
+
+analytics = Analytics()
@@ -0,0 +1 @@
+"""Offline benchmarks for Multi-Agent-CoinChat (no Gemini calls)."""
@@ -0,0 +1,123 @@
+"""
+Recorded conversations replayed by the benchmarks.
+
+Each turn pairs the user's message with the exact model responses the graph
+consumes while handling it: plain text, or {"tool": name, "args": {...}} for a
+tool call or handoff. The scripts assume the pre-router and the query cache
+are off, so every turn goes through the agents.
+"""
+from datetime import date
+from typing import Any, Dict, List
+
+
+def build_conversations(today: date = None) -> List[Dict[str, Any]]:
+    today = today or date.today()
+    day = today.isoformat()
+    month_start = today.replace(day=1).isoformat()
+
+    return [
+        {
+            'name': 'insert_single',
+            'flow': 'insert',
+            'turns': [
+                {
+                    'user': "I bought coffee for 80 today",
+                    'model': [
+                        "Great, here are the transaction details:\n"
+                        f"- Item: coffee  Amount: 80  Date: {day}  Transaction Type: Expense\n"
+                        "Please confirm if everything is correct. (yes/no)",
+                    ],
+                },
+                {
+                    'user': "yes",
+                    'model': [
+                        {'tool': 'record_transactions', 'args': {'items': [
+                            {'item': 'coffee', 'amount': 80, 'date': day, 'transaction_type': 'Expense'},
+                        ]}},
+                        "Recorded 1 transaction.",
+                    ],
+                },
+            ],
+        },
+        {
+            'name': 'insert_batch',
+            'flow': 'insert',
+            'turns': [
+                {
+                    'user': "午餐 150、計程車 30、薪水 50000",
+                    'model': [
+                        "好的，以下是交易明細：\n"
+                        f"- 午餐 150 元（{day}，支出）\n- 計程車 30 元（{day}，支出）\n"
+                        f"- 薪水 50000 元（{day}，收入）\n請確認是否正確？(是/否)",
+                    ],
+                },
+                {
+                    'user': "是",
+                    'model': [
+                        {'tool': 'record_transactions', 'args': {'items': [
+                            {'item': '午餐', 'amount': 150, 'date': day, 'transaction_type': 'Expense'},
+                            {'item': '計程車', 'amount': 30, 'date': day, 'transaction_type': 'Expense'},
+                            {'item': '薪水', 'amount': 50000, 'date': day, 'transaction_type': 'Income'},
+                        ]}},
+                        "已記錄 3 筆交易。",
+                    ],
+                },
+            ],
+        },
+        {
+            'name': 'query_summary',
+            'flow': 'query',
+            'turns': [
+                {
+                    'user': "本月總支出是多少？",
+                    'model': [
+                        {'tool': 'transfer_to_query_agent', 'args': {}},
+                        {'tool': 'summarize_transactions', 'args': {
+                            'start_date': month_start, 'end_date': day, 'transaction_type': 'Expense',
+                        }},
+                        "本月總支出為 1500 元。",
+                    ],
+                },
+            ],
+        },
+        {
+            'name': 'query_sql',
+            'flow': 'query',
+            'turns': [
+                {
+                    'user': "List my expenses from this month",
+                    'model': [
+                        {'tool': 'transfer_to_query_agent', 'args': {}},
+                        {'tool': 'execute_sql', 'args': {'sql': (
+                            "SELECT date, item, amount FROM transactions "
+                            "WHERE transaction_type = 'Expense' "
+                            f"AND date_key BETWEEN {today.replace(day=1):%Y%m%d} AND {today:%Y%m%d} "
+                            "ORDER BY date DESC"
+                        )}},
+                        "Here are your expenses for this month.",
+                    ],
+                },
+            ],
+        },
+        {
+            'name': 'clarification',
+            'flow': 'clarification',
+            'turns': [
+                {
+                    'user': "hello",
+                    'model': ["Hello! Are you looking to record a transaction or query transaction records?"],
+                },
+                {
+                    'user': "how much did I spend on coffee",
+                    'model': [
+                        {'tool': 'transfer_to_query_agent', 'args': {}},
+                        {'tool': 'execute_sql', 'args': {'sql': (
+                            "SELECT SUM(amount) AS total FROM transactions "
+                            "WHERE item LIKE '%coffee%' AND transaction_type = 'Expense'"
+                        )}},
+                        "You spent 80 on coffee in total.",
+                    ],
+                },
+            ],
+        },
+    ]
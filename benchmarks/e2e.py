@@ -0,0 +1,370 @@
+"""
+Offline end-to-end benchmark of the compiled graph.
+
+The Gemini model is replaced by ScriptedChatModel, which replays the recorded
+conversations in benchmarks/conversations.py, so the numbers measure the
+graph's own overhead: node and tool latency, checkpoint size and memory
+growth, across ledger sizes and conversation lengths.
+
+    python -m benchmarks.e2e                                 # default sizes and lengths
+    python -m benchmarks.e2e --db-rows 0,100000 --lengths 1,10
+    python -m benchmarks.e2e compare old.json new.json       # flag regressions between runs
+"""
+import argparse
+import contextlib
+import importlib
+import io
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import uuid
+from datetime import datetime
+from typing import Any, Dict, List
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+from benchmarks.conversations import build_conversations
+from config import (
+    API_SETTING, LLM_SCHEDULER_SETTING, MEMORY_SETTING, QUERY_CACHE_SETTING, ROUTER_SETTING, SPECULATION_SETTING,
+)
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(q * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def describe(values: List[float]) -> Dict[str, Any]:
+    """count / total / mean / p50 / p95 / max of a list of seconds, in milliseconds"""
+    if not values:
+        return {'count': 0}
+    ms = [v * 1000 for v in values]
+    return {
+        'count': len(ms),
+        'total_ms': round(sum(ms), 3),
+        'mean_ms': round(statistics.mean(ms), 3),
+        'p50_ms': round(percentile(ms, 0.5), 3),
+        'p95_ms': round(percentile(ms, 0.95), 3),
+        'max_ms': round(max(ms), 3),
+    }
+
+
+class LatencyRecorder(BaseCallbackHandler):
+    """Collects node, tool and model timings from LangChain callbacks.
+
+    Nodes are named by their checkpoint namespace, so a node inside an agent's
+    subgraph shows up as e.g. "query_agent/tools".
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._started: Dict[Any, tuple] = {}
+        self.timings: Dict[str, Dict[str, List[float]]] = {'nodes': {}, 'tools': {}, 'model': {}}
+
+    def reset(self) -> Dict[str, Dict[str, List[float]]]:
+        with self._lock:
+            timings = self.timings
+            self.timings = {'nodes': {}, 'tools': {}, 'model': {}}
+            self._started.clear()
+        return timings
+
+    def _start(self, run_id, kind: str, name: str) -> None:
+        with self._lock:
+            self._started[run_id] = (kind, name, time.perf_counter())
+
+    def _end(self, run_id) -> None:
+        ended = time.perf_counter()
+        with self._lock:
+            started = self._started.pop(run_id, None)
+            if started is not None:
+                kind, name, at = started
+                self.timings[kind].setdefault(name, []).append(ended - at)
+
+    def on_chain_start(self, serialized, inputs, *, run_id, parent_run_id=None, metadata=None, **kwargs):
+        metadata = metadata or {}
+        node = metadata.get('langgraph_node')
+        if node is None or kwargs.get('name') != node:
+            return
+        namespace = metadata.get('langgraph_checkpoint_ns', node)
+        name = "/".join(part.split(":")[0] for part in namespace.split("|"))
+        with self._lock:
+            parent = self._started.get(parent_run_id)
+        # 節點的外層 task 與內層函式同名，只計外層一次
+        if parent is not None and parent[1] == name:
+            return
+        self._start(run_id, 'nodes', name)
+
+    def on_chain_end(self, outputs, *, run_id, **kwargs):
+        self._end(run_id)
+
+    def on_chain_error(self, error, *, run_id, **kwargs):
+        # 交接工具以 ParentCommand 例外結束節點，仍然計入耗時
+        self._end(run_id)
+
+    def on_tool_start(self, serialized, input_str, *, run_id, **kwargs):
+        self._start(run_id, 'tools', kwargs.get('name') or (serialized or {}).get('name', 'tool'))
+
+    def on_tool_end(self, output, *, run_id, **kwargs):
+        self._end(run_id)
+
+    def on_tool_error(self, error, *, run_id, **kwargs):
+        self._end(run_id)
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+        self._start(run_id, 'model', 'chat_model')
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        self._end(run_id)
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        self._end(run_id)
+
+
+def rss_bytes() -> int:
+    """Resident set size of this process (Linux), or the peak RSS elsewhere"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        import resource
+        scale = 1 if sys.platform == 'darwin' else 1024
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+
+def checkpoint_size(saver, thread_id: str) -> Dict[str, Any]:
+    with saver.cursor(transaction=False) as cur:
+        cur.execute(
+            "SELECT COUNT(*), COALESCE(SUM(LENGTH(checkpoint) + LENGTH(metadata)), 0) "
+            "FROM checkpoints WHERE thread_id = ?",
+            (thread_id,),
+        )
+        count, total = cur.fetchone()
+        cur.execute(
+            "SELECT LENGTH(checkpoint) FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = '' "
+            "ORDER BY checkpoint_id DESC LIMIT 1",
+            (thread_id,),
+        )
+        latest = cur.fetchone()
+        cur.execute(
+            "SELECT COUNT(*), COALESCE(SUM(LENGTH(value)), 0) FROM writes WHERE thread_id = ?",
+            (thread_id,),
+        )
+        writes, writes_bytes = cur.fetchone()
+    return {
+        'checkpoints': count,
+        'checkpoint_bytes': total,
+        'latest_checkpoint_bytes': latest[0] if latest else 0,
+        'writes': writes,
+        'write_bytes': writes_bytes,
+    }
+
+
+def load_graph(workdir: str, model_latency: float):
+    """Import multi-agent.py with the scripted model, a scratch checkpointer and no shortcuts"""
+    API_SETTING['PROVIDER'] = 'scripted'
+    API_SETTING['FAKE_LATENCY'] = model_latency
+    # 腳本假設每一輪都經過 agent，因此關閉前置路由與查詢快取
+    ROUTER_SETTING['ENABLED'] = False
+    QUERY_CACHE_SETTING['ENABLED'] = False
+    # 量測的是 graph 本身的開銷，不讓速率限制把本機模型的呼叫排隊
+    LLM_SCHEDULER_SETTING['RATE_PER_MINUTE'] = 0
+    # 腳本依序回覆，推測執行的平行模型呼叫會打亂順序
+    SPECULATION_SETTING['ENABLED'] = False
+    MEMORY_SETTING['CHECKPOINT_DB_PATH'] = os.path.join(workdir, 'checkpoints.db')
+    return importlib.import_module("multi-agent")
+
+
+def prepare_ledger(workdir: str, rows: int) -> str:
+    from db.db_init import DatabaseManager
+
+    path = os.path.join(workdir, f"ledger_{rows}.db")
+    if not os.path.exists(path):
+        with contextlib.redirect_stdout(io.StringIO()):
+            DatabaseManager(path).generate_synthetic_ledger(rows, seed=1)
+    return path
+
+
+def run_conversation(agents, recorder: LatencyRecorder, conversation: Dict[str, Any], length: int) -> Dict[str, Any]:
+    """Replay a conversation `length` times in one thread and collect its metrics"""
+    # 排程器包裝時，腳本在內層的 ScriptedChatModel 上
+    script = getattr(agents.model, 'inner', agents.model).script
+    thread_id = f"bench-{conversation['name']}-{uuid.uuid4().hex[:8]}"
+    config = {"configurable": {"thread_id": thread_id}, "callbacks": [recorder]}
+    turn_seconds, errors = [], []
+    recorder.reset()
+    rss_before = rss_bytes()
+    heap_before = tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else None
+
+    for _ in range(length):
+        for turn in conversation['turns']:
+            script.clear()
+            script.load(turn['model'])
+            started = time.perf_counter()
+            try:
+                agents.graph.invoke({"messages": [{"role": "user", "content": turn['user']}]}, config=config)
+            except Exception as e:
+                errors.append(f"{turn['user']!r}: {type(e).__name__}: {e}")
+            turn_seconds.append(time.perf_counter() - started)
+            if script.remaining():
+                errors.append(f"{turn['user']!r}: {script.remaining()} scripted responses left unused")
+
+    timings = recorder.reset()
+    result = {
+        'conversation': conversation['name'],
+        'flow': conversation['flow'],
+        'length': length,
+        'turns': len(turn_seconds),
+        'turn': describe(turn_seconds),
+        'nodes': {name: describe(values) for name, values in sorted(timings['nodes'].items())},
+        'tools': {name: describe(values) for name, values in sorted(timings['tools'].items())},
+        'model': describe(timings['model'].get('chat_model', [])),
+        'checkpoint': checkpoint_size(agents.checkpointer, thread_id),
+        'memory': {'rss_growth_bytes': rss_bytes() - rss_before},
+        'errors': errors,
+    }
+    if heap_before is not None:
+        result['memory']['heap_growth_bytes'] = tracemalloc.get_traced_memory()[0] - heap_before
+    return result
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args) -> Dict[str, Any]:
+    workdir = tempfile.mkdtemp(prefix="coinchat-bench-")
+    try:
+        if args.tracemalloc:
+            tracemalloc.start()
+        agents = load_graph(workdir, args.model_latency)
+        recorder = LatencyRecorder()
+        conversations = [
+            c for c in build_conversations() if not args.conversations or c['name'] in args.conversations
+        ]
+
+        results = []
+        for rows in args.db_rows:
+            os.environ['DATABASE_PATH'] = prepare_ledger(workdir, rows)
+            for length in args.lengths:
+                for conversation in conversations:
+                    output = io.StringIO()
+                    with contextlib.redirect_stdout(sys.stdout if args.verbose else output):
+                        result = run_conversation(agents, recorder, conversation, length)
+                    result['db_rows'] = rows
+                    results.append(result)
+                    print(
+                        f"rows={rows:<9} length={length:<3} {conversation['name']:<15} "
+                        f"turn p50={result['turn']['p50_ms']}ms p95={result['turn']['p95_ms']}ms "
+                        f"checkpoint={result['checkpoint']['checkpoint_bytes']}B"
+                        + (f" errors={len(result['errors'])}" if result['errors'] else ""),
+                        file=sys.stderr,
+                    )
+        return {
+            'benchmark': 'e2e',
+            'commit': git_commit(),
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'settings': {
+                'db_rows': args.db_rows,
+                'lengths': args.lengths,
+                'model_latency': args.model_latency,
+                'tracemalloc': args.tracemalloc,
+            },
+            'results': results,
+        }
+    finally:
+        from db.connection import close_all
+        close_all()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def compare(old: Dict[str, Any], new: Dict[str, Any], threshold: float) -> List[Dict[str, Any]]:
+    """Pair results by (db_rows, conversation, length) and report p50 turn latency changes"""
+    def index(report):
+        return {(r['db_rows'], r['conversation'], r['length']): r for r in report['results']}
+
+    before, after = index(old), index(new)
+    rows = []
+    for key in sorted(before.keys() & after.keys(), key=str):
+        old_p50, new_p50 = before[key]['turn'].get('p50_ms'), after[key]['turn'].get('p50_ms')
+        if not old_p50 or new_p50 is None:
+            continue
+        change = (new_p50 - old_p50) / old_p50
+        rows.append({
+            'db_rows': key[0],
+            'conversation': key[1],
+            'length': key[2],
+            'old_p50_ms': old_p50,
+            'new_p50_ms': new_p50,
+            'change': round(change, 4),
+            'checkpoint_bytes': (
+                before[key]['checkpoint']['checkpoint_bytes'], after[key]['checkpoint']['checkpoint_bytes']
+            ),
+            'regression': change > threshold,
+        })
+    return rows
+
+
+def int_list(text: str) -> List[int]:
+    return [int(value) for value in text.split(',') if value.strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline end-to-end benchmark with a scripted chat model")
+    subcommands = parser.add_subparsers(dest="command")
+    parser.add_argument("--db-rows", type=int_list, default=[0, 10_000, 100_000],
+                        help="comma-separated synthetic ledger sizes")
+    parser.add_argument("--lengths", type=int_list, default=[1, 5],
+                        help="comma-separated conversation lengths (times each conversation is replayed in one thread)")
+    parser.add_argument("--conversations", nargs="*", help="only run these conversations")
+    parser.add_argument("--model-latency", type=float, default=0.0, help="seconds added to every model call")
+    parser.add_argument("--tracemalloc", action="store_true", help="also report Python heap growth (slower)")
+    parser.add_argument("--output", help="JSON output path (default: benchmarks/results/e2e-<commit>-<time>.json)")
+    parser.add_argument("--verbose", action="store_true", help="show the tools' debug output")
+    compare_parser = subcommands.add_parser("compare", help="compare two result files")
+    compare_parser.add_argument("old")
+    compare_parser.add_argument("new")
+    compare_parser.add_argument("--threshold", type=float, default=0.2, help="relative p50 slowdown that counts as a regression")
+    args = parser.parse_args()
+
+    if args.command == "compare":
+        with open(args.old, encoding='utf-8') as f:
+            old = json.load(f)
+        with open(args.new, encoding='utf-8') as f:
+            new = json.load(f)
+        rows = compare(old, new, args.threshold)
+        print(json.dumps(rows, ensure_ascii=False, indent=2))
+        regressions = [r for r in rows if r['regression']]
+        print(f"{len(regressions)} regression(s) over {args.threshold:.0%}", file=sys.stderr)
+        sys.exit(1 if regressions else 0)
+
+    report = run(args)
+    output = args.output or os.path.join(
+        RESULTS_DIR, f"e2e-{report['commit'] or 'local'}-{datetime.now():%Y%m%d-%H%M%S}.json"
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"Results written to {output}", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
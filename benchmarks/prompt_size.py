@@ -0,0 +1,147 @@
+"""
+Prompt size per turn, before and after the compact message encoding.
+
+Replays the recorded conversations back to back in one thread (so history
+accumulates the way it does in a real session) with the scripted model, and
+counts the tokens of every prompt the graph sends to the model. "before" turns
+off everything in PROMPT_SETTING (dict-per-row tool results, handoff messages
+and every old tool output resent); "after" uses the current settings.
+
+Tokens are estimated with langchain's count_tokens_approximately (about four
+characters per token), so compare the two modes rather than reading the
+numbers as exact Gemini token counts. Tool schemas are the same in both modes
+and are not counted.
+
+    python -m benchmarks.prompt_size                   # 3 rounds of every conversation
+    python -m benchmarks.prompt_size --repeat 5 --db-rows 5000
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import uuid
+from datetime import datetime
+from typing import Any, Dict
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.messages.utils import count_tokens_approximately
+
+from benchmarks.conversations import build_conversations
+from benchmarks.e2e import RESULTS_DIR, git_commit, load_graph, prepare_ledger
+from config import PROMPT_SETTING
+
+BEFORE = {'COLUMNAR_RESULTS': False, 'COLLAPSE_HANDOFFS': False, 'TOOL_OUTPUT_TURNS': 0}
+
+
+class PromptRecorder(BaseCallbackHandler):
+    """Sums the estimated tokens and message counts of the prompts sent to the model"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> Dict[str, int]:
+        with self._lock:
+            totals = getattr(self, 'totals', None)
+            self.totals = {'calls': 0, 'tokens': 0, 'messages': 0}
+        return totals
+
+    def on_chat_model_start(self, serialized, messages, **kwargs):
+        with self._lock:
+            for prompt in messages:
+                self.totals['calls'] += 1
+                self.totals['tokens'] += count_tokens_approximately(prompt)
+                self.totals['messages'] += len(prompt)
+
+
+def run_mode(agents, name: str, setting: Dict[str, Any], repeat: int) -> Dict[str, Any]:
+    PROMPT_SETTING.update(setting)
+    script = getattr(agents.model, 'inner', agents.model).script
+    recorder = PromptRecorder()
+    thread_id = f"prompt-{name}-{uuid.uuid4().hex[:8]}"
+    config = {"configurable": {"thread_id": thread_id}, "callbacks": [recorder]}
+    turns, errors = [], []
+    for _ in range(repeat):
+        for conversation in build_conversations():
+            for turn in conversation['turns']:
+                script.clear()
+                script.load(turn['model'])
+                recorder.reset()
+                with contextlib.redirect_stdout(io.StringIO()):
+                    try:
+                        agents.graph.invoke({"messages": [{"role": "user", "content": turn['user']}]}, config=config)
+                    except Exception as e:
+                        errors.append(f"{turn['user']!r}: {type(e).__name__}: {e}")
+                turns.append({'conversation': conversation['name'], **recorder.reset()})
+    tokens = [turn['tokens'] for turn in turns]
+    state = agents.graph.get_state({"configurable": {"thread_id": thread_id}}).values
+    return {
+        'mode': name,
+        'setting': dict(setting),
+        'turns': turns,
+        'prompt_tokens': {
+            'total': sum(tokens),
+            'mean_per_turn': round(statistics.mean(tokens), 1) if tokens else None,
+            'last_turn': tokens[-1] if tokens else None,
+            'max_turn': max(tokens) if tokens else None,
+        },
+        # checkpoint 內仍保存完整訊息
+        'state_messages': len(state.get('messages', [])),
+        'errors': errors,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Prompt tokens per turn with and without the compact message encoding")
+    parser.add_argument("--repeat", type=int, default=3, help="rounds of all recorded conversations in one thread")
+    parser.add_argument("--db-rows", type=int, default=2000, help="rows in the synthetic ledger")
+    parser.add_argument("--output", help="JSON output path (default: benchmarks/results/prompt_size-<commit>-<time>.json)")
+    args = parser.parse_args()
+
+    after = {key: PROMPT_SETTING[key] for key in BEFORE}
+    workdir = tempfile.mkdtemp(prefix="coinchat-prompt-")
+    try:
+        agents = load_graph(workdir, 0.0)
+        os.environ['DATABASE_PATH'] = prepare_ledger(workdir, args.db_rows)
+        modes = [run_mode(agents, name, setting, args.repeat) for name, setting in (('before', BEFORE), ('after', after))]
+    finally:
+        PROMPT_SETTING.update(after)
+        from db.connection import close_all
+        close_all()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    before_tokens, after_tokens = (mode['prompt_tokens'] for mode in modes)
+    reduction = 1 - after_tokens['total'] / before_tokens['total'] if before_tokens['total'] else None
+    for mode in modes:
+        per_turn = " ".join(str(turn['tokens']) for turn in mode['turns'])
+        print(f"{mode['mode']:<7} total={mode['prompt_tokens']['total']:<8} "
+              f"mean/turn={mode['prompt_tokens']['mean_per_turn']:<9} per turn: {per_turn}"
+              + (f" errors={len(mode['errors'])}" if mode['errors'] else ""), file=sys.stderr)
+    if reduction is not None:
+        print(f"prompt tokens -{reduction:.1%}", file=sys.stderr)
+
+    report = {
+        'benchmark': 'prompt_size',
+        'commit': git_commit(),
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'settings': {'repeat': args.repeat, 'db_rows': args.db_rows},
+        'modes': modes,
+        'reduction': round(reduction, 4) if reduction is not None else None,
+    }
+    output = args.output or os.path.join(
+        RESULTS_DIR, f"prompt_size-{report['commit'] or 'local'}-{datetime.now():%Y%m%d-%H%M%S}.json"
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"Results written to {output}", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
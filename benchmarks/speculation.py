@@ -0,0 +1,111 @@
+"""
+Speculative query drafting benchmark.
+
+Runs the same messages with speculation off and on, using the fake model with
+an injected delay per call, so the overlap of intent classification and the
+query agent shows up in turn latency. The rule-based router and the query
+cache are turned off, otherwise most queries would never reach the intent
+checker. Non-query messages measure what a dropped draft costs.
+
+    python -m benchmarks.speculation                      # 0.2 s per model call
+    python -m benchmarks.speculation --model-latency 0.5 --repeat 5 --async
+"""
+import argparse
+import asyncio
+import importlib
+import json
+import os
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime
+from typing import Any, Dict, List
+
+from benchmarks.e2e import RESULTS_DIR, describe, git_commit
+from config import API_SETTING, LLM_SCHEDULER_SETTING, MEMORY_SETTING, QUERY_CACHE_SETTING, ROUTER_SETTING, SPECULATION_SETTING
+
+# 前兩類是會交給 query agent 的查詢，最後一類像查詢但 intent checker 不會交接
+MESSAGES = {
+    'query': ["本月總支出", "this month's expenses", "上個月收入多少?"],
+    'not_query': ["what did I buy at the store?", "幾點了?"],
+}
+
+
+def load_graph(workdir: str, model_latency: float):
+    API_SETTING['PROVIDER'] = 'fake'
+    API_SETTING['FAKE_LATENCY'] = model_latency
+    ROUTER_SETTING['ENABLED'] = False
+    QUERY_CACHE_SETTING['ENABLED'] = False
+    LLM_SCHEDULER_SETTING['RATE_PER_MINUTE'] = 0
+    MEMORY_SETTING['CHECKPOINT_DB_PATH'] = os.path.join(workdir, 'checkpoints.db')
+    os.environ['DATABASE_PATH'] = os.path.join(workdir, 'ledger.db')
+    return importlib.import_module("multi-agent")
+
+
+async def _ainvoke(graph, message: str, thread_id: str) -> None:
+    await graph.ainvoke({"messages": [{"role": "user", "content": message}]},
+                        config={"configurable": {"thread_id": thread_id}})
+
+
+def run_mode(agents, speculate: bool, repeat: int, use_async: bool) -> Dict[str, Any]:
+    SPECULATION_SETTING['ENABLED'] = speculate
+    agents.speculation_stats.reset()
+    graph = agents.get_graph()
+    seconds: Dict[str, List[float]] = {kind: [] for kind in MESSAGES}
+    for _ in range(repeat):
+        for kind, messages in MESSAGES.items():
+            for message in messages:
+                # 每則訊息使用新的對話，避免歷史長度影響結果
+                thread_id = f"spec-{uuid.uuid4().hex[:8]}"
+                started = time.perf_counter()
+                if use_async:
+                    asyncio.run(_ainvoke(graph, message, thread_id))
+                else:
+                    graph.invoke({"messages": [{"role": "user", "content": message}]},
+                                 config={"configurable": {"thread_id": thread_id}})
+                seconds[kind].append(time.perf_counter() - started)
+    return {
+        'speculate': speculate,
+        'turns': {kind: describe(values) for kind, values in seconds.items()},
+        'speculation': agents.get_speculation_stats() if speculate else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Turn latency with and without speculative query drafting")
+    parser.add_argument("--model-latency", type=float, default=0.2, help="seconds the fake model waits per call")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--async", dest="use_async", action="store_true", help="use graph.ainvoke instead of invoke")
+    parser.add_argument("--output", help="JSON output path (default: benchmarks/results/speculation-<commit>-<time>.json)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="coinchat-speculation-") as workdir:
+        agents = load_graph(workdir, args.model_latency)
+        modes = [run_mode(agents, speculate, args.repeat, args.use_async) for speculate in (False, True)]
+        from db.connection import close_all
+        close_all()
+
+    for mode in modes:
+        turns = "  ".join(f"{kind} p50={stats['p50_ms']}ms" for kind, stats in mode['turns'].items())
+        print(f"speculate={str(mode['speculate']):<5} {turns}", file=sys.stderr)
+    print(f"speculation: {modes[1]['speculation']}", file=sys.stderr)
+
+    report = {
+        'benchmark': 'speculation',
+        'commit': git_commit(),
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'settings': {'model_latency': args.model_latency, 'repeat': args.repeat, 'async': args.use_async},
+        'modes': modes,
+    }
+    output = args.output or os.path.join(
+        RESULTS_DIR, f"speculation-{report['commit'] or 'local'}-{datetime.now():%Y%m%d-%H%M%S}.json"
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"Results written to {output}", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+"""
+Cold-start benchmark for the CLI and the server.
+
+Every run starts a fresh Python process, so module imports, model creation
+and agent compilation are measured the way a user pays for them. The fake
+model is used, so Gemini is never contacted; the real provider's import
+cost is measured separately with --provider gemini (no API call is made).
+
+    python -m benchmarks.startup                 # 5 runs, median per phase
+    python -m benchmarks.startup --runs 10 --importtime 15
+    python -m benchmarks.startup --provider gemini
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+from datetime import datetime
+from typing import Any, Dict, List
+
+from benchmarks.e2e import RESULTS_DIR, git_commit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 在子行程中依序量測各階段（秒），最後以 JSON 印出
+PROBE = r"""
+import importlib, json, sys, time
+started = time.perf_counter()
+from config import API_SETTING, MEMORY_SETTING
+API_SETTING['PROVIDER'] = sys.argv[1]
+MEMORY_SETTING['CHECKPOINT_DB_PATH'] = sys.argv[2]
+phases = {}
+agents = importlib.import_module("multi-agent")
+phases['import'] = time.perf_counter() - started
+mark = time.perf_counter()
+agents.get_graph()
+phases['graph'] = time.perf_counter() - mark
+if sys.argv[1] != 'gemini':
+    mark = time.perf_counter()
+    agents.get_graph().invoke(
+        {"messages": [{"role": "user", "content": "hello"}]},
+        config={"configurable": {"thread_id": "startup"}},
+    )
+    phases['first_turn'] = time.perf_counter() - mark
+    mark = time.perf_counter()
+    agents.get_graph().invoke(
+        {"messages": [{"role": "user", "content": "hello"}]},
+        config={"configurable": {"thread_id": "startup"}},
+    )
+    phases['second_turn'] = time.perf_counter() - mark
+mark = time.perf_counter()
+agents.warm_up()
+phases['warm_up'] = time.perf_counter() - mark
+phases['total'] = time.perf_counter() - started
+print(json.dumps(phases))
+"""
+
+
+def run_probe(provider: str, workdir: str, index: int, importtime: bool = False) -> Dict[str, Any]:
+    """Run PROBE in a new interpreter and return its phase timings (and -X importtime output)"""
+    env = dict(os.environ, API_KEY=os.environ.get('API_KEY', 'startup-benchmark'),
+               DATABASE_PATH=os.path.join(workdir, 'ledger.db'), TRACE_ENABLED='false')
+    command = [sys.executable] + (["-X", "importtime"] if importtime else []) + [
+        "-c", PROBE, provider, os.path.join(workdir, f"checkpoints-{index}.db"),
+    ]
+    completed = subprocess.run(command, cwd=ROOT, env=env, capture_output=True, text=True)
+    if completed.returncode != 0:
+        raise RuntimeError(f"startup probe failed:\n{completed.stderr[-2000:]}")
+    return {'phases': json.loads(completed.stdout.strip().splitlines()[-1]), 'stderr': completed.stderr}
+
+
+def slowest_imports(importtime_output: str, top: int) -> List[Dict[str, Any]]:
+    """Top-level modules by cumulative import time from -X importtime output"""
+    modules = []
+    for line in importtime_output.splitlines():
+        parts = line.split("|")
+        if not line.startswith("import time:") or len(parts) != 3:
+            continue
+        cumulative, name = parts[1].strip(), parts[2]
+        # 巢狀匯入的名稱會再縮排，只取最外層
+        if not cumulative.isdigit() or name.startswith("  "):
+            continue
+        modules.append({'module': name.strip(), 'ms': round(int(cumulative) / 1000, 1)})
+    return sorted(modules, key=lambda entry: -entry['ms'])[:top]
+
+
+def run(args) -> Dict[str, Any]:
+    samples: Dict[str, List[float]] = {}
+    imports = None
+    with tempfile.TemporaryDirectory(prefix="coinchat-startup-") as workdir:
+        for index in range(args.runs):
+            probe = run_probe(args.provider, workdir, index, importtime=bool(args.importtime) and index == 0)
+            for phase, seconds in probe['phases'].items():
+                samples.setdefault(phase, []).append(seconds * 1000)
+            if args.importtime and index == 0:
+                imports = slowest_imports(probe['stderr'], args.importtime)
+            # 第一次執行會編譯 .pyc，後續才是一般的冷啟動
+            if index == 0 and args.runs > 1:
+                samples = {phase: [] for phase in samples}
+
+    phases = {
+        phase: {
+            'median_ms': round(statistics.median(values), 1),
+            'min_ms': round(min(values), 1),
+            'max_ms': round(max(values), 1),
+        }
+        for phase, values in samples.items() if values
+    }
+    return {
+        'benchmark': 'startup',
+        'commit': git_commit(),
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'python': sys.version.split()[0],
+        'settings': {'runs': args.runs, 'provider': args.provider},
+        'phases': phases,
+        'slowest_imports': imports,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cold-start benchmark for multi-agent.py")
+    parser.add_argument("--runs", type=int, default=5, help="fresh processes to start (the first only warms .pyc)")
+    parser.add_argument("--provider", choices=["fake", "gemini"], default="fake",
+                        help="model provider; gemini measures its import and model creation without calling it")
+    parser.add_argument("--importtime", type=int, default=0, metavar="N",
+                        help="also list the N slowest top-level imports (python -X importtime)")
+    parser.add_argument("--output", help="JSON output path (default: benchmarks/results/startup-<commit>-<time>.json)")
+    args = parser.parse_args()
+
+    report = run(args)
+    for phase, stats in report['phases'].items():
+        print(f"{phase:<12} median={stats['median_ms']:>8.1f}ms  min={stats['min_ms']:>8.1f}ms  max={stats['max_ms']:>8.1f}ms",
+              file=sys.stderr)
+    for entry in report['slowest_imports'] or []:
+        print(f"  import {entry['module']:<40} {entry['ms']:>8.1f}ms", file=sys.stderr)
+
+    output = args.output or os.path.join(
+        RESULTS_DIR, f"startup-{report['commit'] or 'local'}-{datetime.now():%Y%m%d-%H%M%S}.json"
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"Results written to {output}", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
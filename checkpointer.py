@@ -0,0 +1,118 @@
+"""
+Durable, bounded checkpoint storage for the graph.
+
+SqliteSaver stores a full copy of the graph state per step, so a long session
+would grow the checkpoint file without bound. PrunedSqliteSaver keeps only the
+latest checkpoints of each thread (plus the subgraph checkpoints written after
+them) and deletes the rest as it goes. Its async methods run the sync ones in
+the event loop's executor, so the same saver serves graph.invoke and
+graph.ainvoke / astream.
+"""
+import threading
+from typing import Any, AsyncIterator, Dict, Optional, Sequence, Tuple
+
+from langchain_core.runnables import RunnableConfig
+from langchain_core.runnables.config import run_in_executor
+from langgraph.checkpoint.base import CheckpointTuple
+from langgraph.checkpoint.sqlite import SqliteSaver
+
+from config import MEMORY_SETTING
+from db.connection import get_connection_manager
+
+
+class PrunedSqliteSaver(SqliteSaver):
+    """SqliteSaver that retains at most keep_last root checkpoints per thread"""
+
+    def __init__(self, conn, *, keep_last: int = None, prune_every: int = None, **kwargs):
+        super().__init__(conn, **kwargs)
+        self.keep_last = keep_last or MEMORY_SETTING['KEEP_CHECKPOINTS']
+        self.prune_every = prune_every or MEMORY_SETTING['PRUNE_EVERY']
+        self._puts: Dict[str, int] = {}
+        self._puts_lock = threading.Lock()
+
+    def put(self, config: RunnableConfig, checkpoint, metadata, new_versions) -> RunnableConfig:
+        saved = super().put(config, checkpoint, metadata, new_versions)
+        thread_id = str(config["configurable"]["thread_id"])
+        with self._puts_lock:
+            count = self._puts.get(thread_id, 0) + 1
+            self._puts[thread_id] = count
+        if count % self.prune_every == 0:
+            self.prune(thread_id)
+        return saved
+
+    async def aget_tuple(self, config: RunnableConfig) -> Optional[CheckpointTuple]:
+        return await run_in_executor(None, self.get_tuple, config)
+
+    async def alist(
+        self,
+        config: Optional[RunnableConfig],
+        *,
+        filter: Optional[Dict[str, Any]] = None,
+        before: Optional[RunnableConfig] = None,
+        limit: Optional[int] = None,
+    ) -> AsyncIterator[CheckpointTuple]:
+        tuples = await run_in_executor(
+            None, lambda: list(self.list(config, filter=filter, before=before, limit=limit))
+        )
+        for checkpoint_tuple in tuples:
+            yield checkpoint_tuple
+
+    async def aput(self, config: RunnableConfig, checkpoint, metadata, new_versions) -> RunnableConfig:
+        return await run_in_executor(None, self.put, config, checkpoint, metadata, new_versions)
+
+    async def aput_writes(
+        self,
+        config: RunnableConfig,
+        writes: Sequence[Tuple[str, Any]],
+        task_id: str,
+        task_path: str = "",
+    ) -> None:
+        await run_in_executor(None, self.put_writes, config, writes, task_id, task_path)
+
+    async def adelete_thread(self, thread_id: str) -> None:
+        await run_in_executor(None, self.delete_thread, thread_id)
+
+    def prune(self, thread_id: str, keep_last: int = None) -> int:
+        """Delete all but the newest keep_last root checkpoints of a thread.
+
+        Subgraph checkpoints older than the oldest retained root checkpoint go
+        too. Checkpoint ids are time-ordered UUIDs, so comparing them as text
+        gives their age. Returns the number of deleted checkpoints.
+        """
+        keep_last = keep_last or self.keep_last
+        with self.cursor() as cur:
+            cur.execute(
+                "SELECT checkpoint_id FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = '' "
+                "ORDER BY checkpoint_id DESC LIMIT 1 OFFSET ?",
+                (str(thread_id), keep_last - 1),
+            )
+            row = cur.fetchone()
+            if row is None:
+                return 0
+            oldest_kept = row[0]
+            cur.execute(
+                "DELETE FROM checkpoints WHERE thread_id = ? AND checkpoint_id < ?",
+                (str(thread_id), oldest_kept),
+            )
+            deleted = cur.rowcount
+            cur.execute(
+                "DELETE FROM writes WHERE thread_id = ? AND checkpoint_id < ?",
+                (str(thread_id), oldest_kept),
+            )
+        return deleted
+
+    def prune_all(self, keep_last: int = None) -> int:
+        """Prune every thread, e.g. once at startup"""
+        with self.cursor(transaction=False) as cur:
+            cur.execute("SELECT DISTINCT thread_id FROM checkpoints")
+            thread_ids = [row[0] for row in cur.fetchall()]
+        return sum(self.prune(thread_id, keep_last) for thread_id in thread_ids)
+
+
+def build_checkpointer(db_path: str = None) -> PrunedSqliteSaver:
+    """Create the checkpointer on its own SQLite file, using the shared PRAGMA tuning"""
+    conn = get_connection_manager(db_path or MEMORY_SETTING['CHECKPOINT_DB_PATH']).open_connection()
+    conn.row_factory = None
+    saver = PrunedSqliteSaver(conn)
+    saver.prune_all()
+    return saver
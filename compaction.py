@@ -0,0 +1,75 @@
+"""
+Rolling-summary compaction of long conversations.
+
+Once a thread holds more than COMPACT_TRIGGER_MESSAGES messages, everything
+before the last COMPACT_KEEP_MESSAGES (cut at a user message, so tool calls
+stay paired with their results) is folded into the `summary` state key and
+removed from the message list. Prompt size and checkpoint size then stay flat
+however long a session runs.
+"""
+from typing import Any, Dict, List, Optional
+
+from langchain_core.messages import (
+    AIMessage,
+    BaseMessage,
+    HumanMessage,
+    RemoveMessage,
+    SystemMessage,
+    ToolMessage,
+)
+
+from config import MEMORY_SETTING
+from prompts import HISTORY_SUMMARY_PROMPT
+
+_TOOL_PREVIEW_CHARS = 200
+
+
+def find_cut(messages: List[BaseMessage], keep: int) -> Optional[int]:
+    """Index of the first message to keep, or None if there is nothing to compact"""
+    for index in range(max(len(messages) - keep, 1), len(messages)):
+        if isinstance(messages[index], HumanMessage):
+            return index
+    return None
+
+
+def render_transcript(messages: List[BaseMessage]) -> str:
+    lines = []
+    for message in messages:
+        content = message.content if isinstance(message.content, str) else str(message.content)
+        if isinstance(message, HumanMessage):
+            lines.append(f"User: {content}")
+        elif isinstance(message, AIMessage):
+            if content:
+                lines.append(f"Assistant: {content}")
+            for call in message.tool_calls:
+                lines.append(f"Assistant called {call['name']}({call['args']})")
+        elif isinstance(message, ToolMessage):
+            lines.append(f"Tool {message.name}: {content[:_TOOL_PREVIEW_CHARS]}")
+    return "\n".join(lines)
+
+
+def compact_messages(
+    messages: List[BaseMessage],
+    summary: str,
+    model,
+    trigger: int = None,
+    keep: int = None,
+) -> Optional[Dict[str, Any]]:
+    """Return a state update that folds old messages into the summary, or None"""
+    trigger = trigger or MEMORY_SETTING['COMPACT_TRIGGER_MESSAGES']
+    keep = keep or MEMORY_SETTING['COMPACT_KEEP_MESSAGES']
+    if len(messages) <= trigger:
+        return None
+    cut = find_cut(messages, keep)
+    if cut is None:
+        return None
+
+    old = messages[:cut]
+    response = model.invoke([
+        SystemMessage(content=HISTORY_SUMMARY_PROMPT),
+        HumanMessage(content=f"Current summary:\n{summary or '(none)'}\n\nNew messages:\n{render_transcript(old)}"),
+    ])
+    return {
+        "summary": response.content,
+        "messages": [RemoveMessage(id=message.id) for message in old],
+    }
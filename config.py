@@ -1,6 +1,155 @@
+import os
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
 API_SETTING = {
     'MAX_TOKENS': 500,
-    'MODEL_NAME': 'gemini-1.5-flash-001'
+    'MODEL_NAME': 'gemini-1.5-flash-001',
+    # 'gemini'、'fake'（本機假模型，壓力測試用，不需要 API 金鑰）或 'scripted'（依腳本回覆，benchmark 用）
+    'PROVIDER': os.getenv('MODEL_PROVIDER', 'gemini'),
+    'FAKE_LATENCY': float(os.getenv('FAKE_MODEL_LATENCY', '0')),
+    'FAKE_ERROR_RATE': float(os.getenv('FAKE_MODEL_ERROR_RATE', '0')),  # 假模型回傳 429 的機率，測試重試用
+}
+
+# 模型呼叫排程（llm_scheduler.py）：所有 agent 共用同一組併發上限、速率限制與重試
+LLM_SCHEDULER_SETTING = {
+    'ENABLED': os.getenv('LLM_SCHEDULER_ENABLED', 'true').lower() in ('1', 'true', 'yes'),
+    'MAX_CONCURRENCY': int(os.getenv('LLM_MAX_CONCURRENCY', '8')),        # 同時送出的模型請求上限
+    'RATE_PER_MINUTE': float(os.getenv('LLM_RATE_PER_MINUTE', '60')),      # token bucket 補充速率，0 表示不限
+    'BURST': int(os.getenv('LLM_BURST', '10')),                            # bucket 容量（可瞬間送出的請求數）
+    'MAX_RETRIES': int(os.getenv('LLM_MAX_RETRIES', '4')),
+    'BACKOFF_BASE': 0.5,     # 第 n 次重試最多等待 BACKOFF_BASE * 2**n 秒（full jitter）
+    'BACKOFF_MAX': 20.0,
+    'COALESCE': True,        # 相同的進行中請求只送一次，結果分給所有等待者
+    'WAIT_SAMPLES': 1000,    # 計算等待時間百分位數保留的最近樣本數
+}
+
+# 規則式前置路由：高信心的訊息不經過 LLM 直接處理
+ROUTER_SETTING = {
+    'ENABLED': True,
+}
+
+# 推測執行：訊息像查詢但前置路由無法確定時，query agent 與 intent checker 同時執行，
+# intent checker 交給 query agent 時直接採用已完成的草稿，否則丟棄
+SPECULATION_SETTING = {
+    'ENABLED': os.getenv('SPECULATIVE_QUERY', 'false').lower() in ('1', 'true', 'yes'),
+}
+
+# Query Agent 快取：問題 -> SQL、(SQL, 資料版本) -> 查詢結果 / 回答
+QUERY_CACHE_SETTING = {
+    'ENABLED': True,
+    'SQL_MAXSIZE': 256,
+    'SQL_TTL': 24 * 60 * 60,
+    'RESULT_MAXSIZE': 256,
+    'RESULT_TTL': 60 * 60,
+}
+
+# 對話記憶：SQLite checkpoint 保留數量與長對話摘要壓縮
+MEMORY_SETTING = {
+    'CHECKPOINT_DB_PATH': 'db/checkpoints.db',
+    'KEEP_CHECKPOINTS': 20,          # 每個 thread 保留的最新 checkpoint 數
+    'PRUNE_EVERY': 10,               # 每寫入幾個 checkpoint 清理一次
+    'COMPACT_TRIGGER_MESSAGES': 40,  # 訊息數超過此值時壓縮成摘要
+    'COMPACT_KEEP_MESSAGES': 12,     # 壓縮後保留的最新訊息數
+}
+
+# 送給模型的訊息編碼（message_encoding.py）；checkpoint 仍保存完整訊息
+PROMPT_SETTING = {
+    # 查詢工具以 columns + rows 陣列回傳結果，欄位名稱只出現一次
+    'COLUMNAR_RESULTS': os.getenv('PROMPT_COLUMNAR_RESULTS', 'true').lower() in ('1', 'true', 'yes'),
+    # 不把 transfer_to_* 交接呼叫與「Successfully transferred」回覆送給模型
+    'COLLAPSE_HANDOFFS': os.getenv('PROMPT_COLLAPSE_HANDOFFS', 'true').lower() in ('1', 'true', 'yes'),
+    # 保留工具呼叫與結果的最近輪數（含本輪），更早的輪只送文字回覆；0 表示全部保留
+    'TOOL_OUTPUT_TURNS': int(os.getenv('PROMPT_TOOL_OUTPUT_TURNS', '1')),
+}
+
+# 非同步多使用者伺服器（server.py）
+SERVER_SETTING = {
+    'HOST': os.getenv('SERVER_HOST', '127.0.0.1'),
+    'PORT': int(os.getenv('SERVER_PORT', '8080')),
+    'MAX_CONCURRENCY': int(os.getenv('SERVER_MAX_CONCURRENCY', '32')),  # 同時執行的對話輪數上限
+    'DB_THREADS': int(os.getenv('SERVER_DB_THREADS', '8')),             # 執行 SQLite 工具的執行緒數
+}
+
+# 命令列輸出：'messages' 逐字串流顯示回覆；'updates' 為舊的節點更新除錯輸出
+DISPLAY_SETTING = {
+    'STREAM_MODE': os.getenv('STREAM_MODE', 'messages'),
+    'HIDDEN_NODES': ['compact_history', 'query_draft'],  # 這些節點的模型輸出不顯示給使用者
+}
+
+# 節點／工具追蹤：span 以 JSONL 寫入 PATH（EXPORTER='otel' 時改交給 OpenTelemetry SDK）
+TRACING_SETTING = {
+    'ENABLED': os.getenv('TRACE_ENABLED', 'true').lower() in ('1', 'true', 'yes'),
+    'PATH': os.getenv('TRACE_PATH', 'logs/traces.jsonl'),
+    'EXPORTER': os.getenv('TRACE_EXPORTER', 'jsonl'),
+    'SAMPLE_RATE': float(os.getenv('TRACE_SAMPLE_RATE', '1.0')),  # 以整個 trace（一輪對話）為單位抽樣
+    'MAX_SQL_CHARS': 500,
+}
+
+# 向量化分析（analytics.py）：交易以分塊 cursor 載入 NumPy 陣列後計算
+ANALYTICS_SETTING = {
+    'CHUNK_ROWS': 50_000,    # 每次 fetchmany 的列數
+    'MAX_ROWS': 2_000_000,   # 單次分析可載入的最多交易數，超過時請模型縮小範圍
+    'MAX_POINTS': 60,        # 回傳給模型的時間序列最多點數
+    'CACHE_SIZE': 16,        # 依資料版本快取的交易切片數
 }
 
+# SQLite 連線（db/connection.py）：所有連線共用的 PRAGMA 設定，可透過環境變數調整
+DB_SETTING = {
+    'JOURNAL_MODE': os.getenv('DB_JOURNAL_MODE', 'WAL'),
+    'SYNCHRONOUS': os.getenv('DB_SYNCHRONOUS', 'NORMAL'),
+    'CACHE_SIZE': int(os.getenv('DB_CACHE_SIZE', '-65536')),      # 負值代表 KiB，約 64 MB
+    'MMAP_SIZE': int(os.getenv('DB_MMAP_SIZE', str(256 * 1024 * 1024))),
+    'BUSY_TIMEOUT_MS': int(os.getenv('DB_BUSY_TIMEOUT_MS', '5000')),
+    # 查詢結果上限：超過時只回傳摘要與分頁 handle
+    'MAX_RESULT_ROWS': int(os.getenv('DB_MAX_RESULT_ROWS', '50')),
+    'MAX_FETCH_ROWS': int(os.getenv('DB_MAX_FETCH_ROWS', '100')),
+    'MAX_RESULT_HANDLES': int(os.getenv('DB_MAX_RESULT_HANDLES', '16')),
+    'RESULT_HANDLE_TTL': float(os.getenv('DB_RESULT_HANDLE_TTL', '300')),
+    'MAX_HANDLE_ROWS': int(os.getenv('DB_MAX_HANDLE_ROWS', '1000')),     # fetch_more 最多可翻閱的總筆數
+    # 模型產生的 SQL：執行時間上限，以及超過多少列的資料表不允許整表掃描
+    'QUERY_TIMEOUT_MS': float(os.getenv('DB_QUERY_TIMEOUT_MS', '2000')),
+    'LARGE_TABLE_ROWS': int(os.getenv('DB_LARGE_TABLE_ROWS', '100000')),
+}
 
+# 讀取副本（db/replica.py）：查詢工具改讀以 backup API 複製的快照
+REPLICA_SETTING = {
+    'ENABLED': os.getenv('DB_READ_REPLICA', 'false').lower() in ('1', 'true', 'yes'),
+    'MODE': os.getenv('DB_REPLICA_MODE', 'file'),                           # 'file' 或 'memory'
+    # memory 模式可複製的資料庫大小上限，超過時改用 file（記憶體中會有兩份完整副本）
+    'MAX_MEMORY_BYTES': int(os.getenv('DB_REPLICA_MAX_MEMORY_MB', '64')) * 1024 * 1024,
+    'MAX_STALENESS': float(os.getenv('DB_REPLICA_MAX_STALENESS', '2.0')),  # 秒；超過時查詢改讀主資料庫
+    'MIN_INTERVAL': float(os.getenv('DB_REPLICA_MIN_INTERVAL', '0.5')),    # 兩次刷新的最短間隔，合併連續寫入
+    'MAX_DUTY': float(os.getenv('DB_REPLICA_MAX_DUTY', '0.25')),           # 刷新耗時佔總時間的比例上限
+    'PAGES': int(os.getenv('DB_REPLICA_PAGES', '1024')),                   # 每個 backup step 複製的頁數，-1 一次複製
+    'STEP_SLEEP': float(os.getenv('DB_REPLICA_STEP_SLEEP', '0')),          # 分段複製時每步之間讓出的秒數
+    'READER_WAIT': 30.0,     # 刷新或關閉時等待舊快照上的查詢結束的最長秒數
+}
+
+# 每位租戶一個帳本檔案（db/shards.py）
+SHARD_SETTING = {
+    'ENABLED': os.getenv('DB_SHARDING', 'false').lower() in ('1', 'true', 'yes'),
+    # 以 graph config 的 configurable 中哪個鍵分片：'user_id'（每位使用者一個帳本）或 'thread_id'
+    'KEY': os.getenv('DB_SHARD_KEY', 'user_id'),
+    'DIR': os.getenv('DB_SHARD_DIR', 'db/shards'),
+    'MAX_OPEN': int(os.getenv('DB_SHARD_MAX_OPEN', '64')),          # 同時保持開啟的分片數
+    'IDLE_SECONDS': float(os.getenv('DB_SHARD_IDLE_SECONDS', '600')),  # 閒置超過此秒數的分片會關閉連線
+}
+
+# 舊交易封存（db/archive.py）：依期間寫成欄式檔案，主表只留近期交易
+ARCHIVE_SETTING = {
+    'PERIOD': os.getenv('DB_ARCHIVE_PERIOD', 'month'),                    # 每個封存檔涵蓋的期間：'month' 或 'year'
+    'KEEP_MONTHS': int(os.getenv('DB_ARCHIVE_KEEP_MONTHS', '24')),        # 未指定截止日時，保留最近幾個月在主表
+    'CHUNK_ROWS': int(os.getenv('DB_ARCHIVE_CHUNK_ROWS', '50000')),       # 每次 fetchmany 的列數
+    'GRACE_SECONDS': float(os.getenv('DB_ARCHIVE_GRACE_SECONDS', '3600')),  # 被取代的舊檔保留秒數，供舊快照讀取
+    'CACHE_SIZE': 32,                                                     # 已載入的封存檔快取數
+    # execute_sql 單次查詢最多載入的封存列數；沒有日期範圍的查詢超過時拒絕，請模型縮小範圍或改用彙總表
+    'MAX_QUERY_ROWS': int(os.getenv('DB_ARCHIVE_MAX_QUERY_ROWS', '200000')),
+}
+
+# 對話中匯入帳單（import_statement 工具）：只能讀取此目錄內的檔案，模型與遠端使用者不能指定任意路徑
+IMPORT_SETTING = {
+    'DIR': os.getenv('IMPORT_DIR', 'imports'),
+}
@@ -0,0 +1,469 @@
+"""
+Cold-storage tiering of old transactions.
+
+DatabaseManager.archive() moves the transactions dated before a cutoff out of
+the hot table into compressed columnar files, one per period (month or year),
+under <db_path>.archive/. Rows are streamed out with a chunked cursor and a
+period's file is written once the cursor has moved past it, so memory holds
+at most one period.
+
+Each file is a NumPy .npz holding one array per column (ids, date keys,
+amounts, dictionary-encoded items and types, ...). The manifest is the
+{table}_archive table: one row per period with its file and the min/max date,
+row counts and totals of the file. It lives in the database so that it
+commits in the same transaction as the DELETE of the archived rows; a failed
+run leaves only unreferenced files, which later runs remove. File names are
+unique per write, so a file is never changed once a manifest points to it.
+
+The rollup tables keep covering archived rows (their triggers skip the
+archive's DELETE), so summarize_transactions answers from them as before. The
+other query tools read the manifest and open only the files whose date range
+overlaps the question.
+"""
+import os
+import re
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import closing
+from dataclasses import dataclass
+from datetime import date
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+try:
+    from db.sandbox import mask_sql
+except ImportError:  # 直接執行 python db/db_init.py 時
+    from sandbox import mask_sql
+from config import ARCHIVE_SETTING
+
+
+# 封存的欄位，順序即 rows() 回傳的順序
+COLUMNS = ('id', 'item', 'amount', 'date', 'transaction_type', 'import_key', 'date_key')
+PERIODS = ('month', 'year')
+
+
+def archive_dir(db_path: str) -> str:
+    return f"{db_path}.archive"
+
+
+def default_cutoff(keep_months: int = None, today: date = None) -> str:
+    """First day of the month keep_months months before the current one"""
+    keep_months = ARCHIVE_SETTING['KEEP_MONTHS'] if keep_months is None else keep_months
+    today = today or date.today()
+    months = today.year * 12 + today.month - 1 - keep_months
+    return date(months // 12, months % 12 + 1, 1).isoformat()
+
+
+def period_of(key: int, period: str) -> str:
+    """Period label of a YYYYMMDD key: 'YYYY-MM' or 'YYYY'"""
+    return f"{key // 10000:04d}" if period == 'year' else f"{key // 10000:04d}-{key // 100 % 100:02d}"
+
+
+def key_date(key: int) -> str:
+    return f"{key // 10000:04d}-{key // 100 % 100:02d}-{key % 100:02d}"
+
+
+@dataclass
+class ArchivedRows:
+    """The columns of one archive file"""
+
+    ids: np.ndarray          # int64
+    date_keys: np.ndarray    # int32，YYYYMMDD
+    amounts: np.ndarray      # float64
+    dates: np.ndarray        # str，原始 date 欄位
+    type_codes: np.ndarray   # int8，索引到 types
+    types: np.ndarray        # str
+    item_codes: np.ndarray   # int32，索引到 items
+    items: np.ndarray        # str
+    import_keys: np.ndarray  # str，'' 表示 NULL
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @classmethod
+    def from_rows(cls, rows: Sequence[tuple]) -> "ArchivedRows":
+        """Encode rows given in COLUMNS order"""
+        ids, items, amounts, dates, types, import_keys, keys = zip(*rows)
+        item_names, item_codes = np.unique(np.array(items, dtype=str), return_inverse=True)
+        type_names, type_codes = np.unique(np.array(types, dtype=str), return_inverse=True)
+        return cls(
+            ids=np.array(ids, dtype=np.int64),
+            date_keys=np.array(keys, dtype=np.int32),
+            amounts=np.array(amounts, dtype=np.float64),
+            dates=np.array(dates, dtype=str),
+            type_codes=type_codes.astype(np.int8),
+            types=type_names,
+            item_codes=item_codes.astype(np.int32),
+            items=item_names,
+            import_keys=np.array([key or '' for key in import_keys], dtype=str),
+        )
+
+    @classmethod
+    def concat(cls, parts: Sequence["ArchivedRows"]) -> "ArchivedRows":
+        """One ArchivedRows with the rows of all parts, ordered by date and id, without duplicate ids"""
+        if len(parts) == 1:
+            return parts[0]
+        items, item_codes = _merge_codes([(p.items, p.item_codes) for p in parts])
+        types, type_codes = _merge_codes([(p.types, p.type_codes) for p in parts])
+        merged = cls(
+            ids=np.concatenate([p.ids for p in parts]),
+            date_keys=np.concatenate([p.date_keys for p in parts]),
+            amounts=np.concatenate([p.amounts for p in parts]),
+            dates=np.concatenate([p.dates for p in parts]),
+            type_codes=type_codes.astype(np.int8),
+            types=types,
+            item_codes=item_codes.astype(np.int32),
+            items=items,
+            import_keys=np.concatenate([p.import_keys for p in parts]),
+        )
+        # 中斷後重跑可能再次寫入相同的列，以 id 去重
+        _, first = np.unique(merged.ids, return_index=True)
+        order = first[np.lexsort((merged.ids[first], merged.date_keys[first]))]
+        return merged.take(order)
+
+    def take(self, index: np.ndarray) -> "ArchivedRows":
+        return ArchivedRows(
+            ids=self.ids[index], date_keys=self.date_keys[index], amounts=self.amounts[index],
+            dates=self.dates[index], type_codes=self.type_codes[index], types=self.types,
+            item_codes=self.item_codes[index], items=self.items, import_keys=self.import_keys[index],
+        )
+
+    def mask(self, start_key: int = None, end_key: int = None, transaction_type: str = None) -> np.ndarray:
+        selected = np.ones(len(self), dtype=bool)
+        if start_key is not None:
+            selected &= self.date_keys >= start_key
+        if end_key is not None:
+            selected &= self.date_keys <= end_key
+        if transaction_type:
+            codes = np.flatnonzero(self.types == transaction_type)
+            selected &= np.isin(self.type_codes, codes)
+        return selected
+
+    def matching(self, terms: Sequence[str], limit: int) -> "ArchivedRows":
+        """The newest `limit` rows whose item contains any of the terms, ignoring case like the trigram index"""
+        lowered = np.char.lower(self.items)
+        matched = np.zeros(len(self.items), dtype=bool)
+        for term in terms:
+            matched |= np.char.find(lowered, term.lower()) >= 0
+        selected = np.flatnonzero(np.isin(self.item_codes, np.flatnonzero(matched)))
+        # 列依日期排序，倒序即新到舊
+        return self.take(selected[::-1][:limit])
+
+    def is_income(self) -> np.ndarray:
+        return self.types[self.type_codes] == 'Income'
+
+    def rows(self, selected: np.ndarray = None) -> Iterator[tuple]:
+        """Python tuples in COLUMNS order"""
+        index = np.arange(len(self)) if selected is None else np.flatnonzero(selected)
+        items, types = self.items.tolist(), self.types.tolist()
+        for i, item, amount, day, type_code, import_key, key in zip(
+            self.ids[index].tolist(), self.item_codes[index].tolist(), self.amounts[index].tolist(),
+            self.dates[index].tolist(), self.type_codes[index].tolist(), self.import_keys[index].tolist(),
+            self.date_keys[index].tolist(),
+        ):
+            yield i, items[item], amount, day, types[type_code], import_key or None, key
+
+    def summary(self) -> Dict[str, Any]:
+        """Manifest fields of this file"""
+        income = self.is_income()
+        return {
+            'rows': len(self),
+            'min_date_key': int(self.date_keys.min()),
+            'max_date_key': int(self.date_keys.max()),
+            'expense_total': round(float(self.amounts[~income].sum()), 2),
+            'expense_count': int((~income).sum()),
+            'income_total': round(float(self.amounts[income].sum()), 2),
+            'income_count': int(income.sum()),
+        }
+
+
+def rollup_totals(rows: ArchivedRows, columns: Sequence[str]) -> Dict[tuple, Tuple[float, int]]:
+    """(total, count) of rows grouped by rollup key columns (day, month, transaction_type, item)"""
+    keys = {
+        'day': lambda: rows.dates.astype('<U10'),
+        'month': lambda: rows.dates.astype('<U7'),
+        'transaction_type': lambda: rows.types[rows.type_codes],
+        'item': lambda: rows.items[rows.item_codes],
+    }
+    vocabularies, group = [], np.zeros(len(rows), dtype=np.int64)
+    for column in columns:
+        names, codes = np.unique(keys[column](), return_inverse=True)
+        vocabularies.append(names.tolist())
+        group = group * len(names) + codes
+    groups, inverse = np.unique(group, return_inverse=True)
+    totals = np.bincount(inverse, weights=rows.amounts, minlength=len(groups))
+    counts = np.bincount(inverse, minlength=len(groups))
+    result = {}
+    for code, total, count in zip(groups.tolist(), totals.tolist(), counts.tolist()):
+        key = []
+        for names in reversed(vocabularies):
+            code, index = divmod(code, len(names))
+            key.append(names[index])
+        result[tuple(reversed(key))] = (total, count)
+    return result
+
+
+def _merge_codes(parts: Sequence[Tuple[np.ndarray, np.ndarray]]) -> Tuple[np.ndarray, np.ndarray]:
+    """Re-encode several (vocabulary, codes) pairs against one merged vocabulary"""
+    vocabulary = np.unique(np.concatenate([names for names, _ in parts]))
+    codes = np.concatenate([np.searchsorted(vocabulary, names)[codes] for names, codes in parts])
+    return vocabulary, codes
+
+
+def write_file(directory: str, table: str, period: str, rows: ArchivedRows) -> str:
+    """Write rows to a new compressed file and return its name"""
+    os.makedirs(directory, exist_ok=True)
+    name = f"{table}-{period}-{uuid.uuid4().hex[:8]}.npz"
+    path = os.path.join(directory, name)
+    with open(path + '.tmp', 'wb') as f:
+        np.savez_compressed(f, **{field: getattr(rows, field) for field in ArchivedRows.__dataclass_fields__})
+    os.replace(path + '.tmp', path)
+    return name
+
+
+_cache: "OrderedDict[str, ArchivedRows]" = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def read_file(path: str) -> ArchivedRows:
+    """Load an archive file; files never change once written, so they are cached by path"""
+    with _cache_lock:
+        rows = _cache.get(path)
+        if rows is not None:
+            _cache.move_to_end(path)
+            return rows
+    with np.load(path, allow_pickle=False) as data:
+        rows = ArchivedRows(**{field: data[field] for field in ArchivedRows.__dataclass_fields__})
+    with _cache_lock:
+        _cache[path] = rows
+        while len(_cache) > ARCHIVE_SETTING['CACHE_SIZE']:
+            _cache.popitem(last=False)
+    return rows
+
+
+def stored_import_keys(path: str, import_keys: Sequence[str]) -> np.ndarray:
+    """Boolean mask of the import_keys already stored in an archive file.
+
+    Only the import_keys column is decompressed, and it is not cached, so an
+    import touching many archived periods holds one column at a time.
+    """
+    with np.load(path, allow_pickle=False) as data:
+        return np.isin(np.array(import_keys, dtype=str), data['import_keys'])
+
+
+def manifest(conn: sqlite3.Connection, table: str, start_key: int = None, end_key: int = None) -> List[Dict[str, Any]]:
+    """Manifest entries whose date range overlaps [start_key, end_key] (open ends allowed)"""
+    sql = f"SELECT * FROM {table}_archive WHERE max_date_key >= ? AND min_date_key <= ? ORDER BY min_date_key"
+    try:
+        cursor = conn.execute(sql, (start_key or 0, end_key or 99991231))
+    except sqlite3.OperationalError:
+        # 尚未套用封存遷移的資料庫沒有 manifest
+        return []
+    columns = [col[0] for col in cursor.description]
+    return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+
+def load(db_path: str, entries: Sequence[Dict[str, Any]], start_key: int = None, end_key: int = None,
+         transaction_type: str = None) -> Optional[ArchivedRows]:
+    """Archived rows of the given manifest entries inside the range, or None when there are none"""
+    parts = []
+    for entry in entries:
+        rows = read_file(os.path.join(archive_dir(db_path), entry['file']))
+        selected = rows.mask(start_key, end_key, transaction_type)
+        if selected.any():
+            parts.append(rows.take(np.flatnonzero(selected)))
+    return ArchivedRows.concat(parts) if parts else None
+
+
+def remove_unreferenced(conn: sqlite3.Connection, db_path: str, table: str, grace_seconds: float = None) -> int:
+    """Delete files no manifest entry points to (older than the grace period) and return how many"""
+    grace_seconds = ARCHIVE_SETTING['GRACE_SECONDS'] if grace_seconds is None else grace_seconds
+    directory = archive_dir(db_path)
+    if not os.path.isdir(directory):
+        return 0
+    referenced = {row[0] for row in conn.execute(f"SELECT file FROM {table}_archive")}
+    now = time.time()
+    removed = 0
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if name in referenced or not name.startswith(f"{table}-") or now - os.path.getmtime(path) < grace_seconds:
+            continue
+        os.remove(path)
+        removed += 1
+    return removed
+
+
+# 從模型寫的 SQL 找出日期條件。只有 WHERE 是單純以 AND 串接、且每個提到日期欄位的條件都能完整解析時才縮小範圍；
+# OR、NOT、子查詢、函式包住的日期欄位等其他情況一律讀取全部封存檔
+_DATE_COLUMN = re.compile(r"\b(?:\w+\.)?date(?:_key)?\b", re.I)
+_COMPARISON = re.compile(r"((?:\w+\.)?date(?:_key)?)\s*(>=|<=|==|=|>|<)\s*(.+)", re.I | re.S)
+_BETWEEN = re.compile(r"((?:\w+\.)?date(?:_key)?)\s+BETWEEN\s+(.+?)\s+AND\s+(.+)", re.I | re.S)
+_LIKE = re.compile(r"(?:\w+\.)?date\s+LIKE\s+'(\d{4})(?:-(\d{2}))?[^']*'", re.I)
+_ISO_LITERAL = re.compile(r"'(\d{4})-(\d{2})(?:-(\d{2}))?(?:[ T][^']*)?'")
+# 只含字面值參數的日期函式，例如 date('now', '-1 month')，可以先算出來
+_DATE_FUNCTION = re.compile(r"(?:date|datetime)\s*\(\s*(?:(?:'[^']*'|[-+]?\d+)\s*(?:,\s*(?:'[^']*'|[-+]?\d+)\s*)*)?\)", re.I)
+_SQL_END = re.compile(r"\b(?:GROUP\s+BY|ORDER\s+BY|LIMIT|HAVING|WINDOW)\b")
+
+
+def _value_key(column: str, value: str, upper: bool) -> Optional[int]:
+    """YYYYMMDD key of a comparison operand, or None when it is not a value the parser understands"""
+    value = value.strip()
+    if column.lower().endswith('date_key'):
+        return int(value) if re.fullmatch(r"\d{8}", value) else None
+    if _DATE_FUNCTION.fullmatch(value):
+        with closing(sqlite3.connect(":memory:")) as conn:
+            result = conn.execute(f"SELECT {value}").fetchone()[0]
+        if result is None:
+            return None
+        value = f"'{result}'"
+    match = _ISO_LITERAL.fullmatch(value)
+    if not match:
+        return None
+    year, month, day = match.groups()
+    # 只有年月時（'2024-03'），下界取月初、上界取月底
+    return int(year + month + (day or ('31' if upper else '01')))
+
+
+def _condition_range(condition: str) -> Optional[Tuple[Optional[int], Optional[int]]]:
+    """(start_key, end_key) of one date condition, or None when it is not understood"""
+    match = _LIKE.fullmatch(condition)
+    if match:
+        year, month = match.groups()
+        return (int(year + (month or '01') + '01'), int(year + (month or '12') + '31'))
+    match = _BETWEEN.fullmatch(condition)
+    if match:
+        column, low, high = match.groups()
+        bounds = (_value_key(column, low, upper=False), _value_key(column, high, upper=True))
+        return bounds if None not in bounds else None
+    match = _COMPARISON.fullmatch(condition)
+    if match:
+        column, operator, value = match.groups()
+        lower = _value_key(column, value, upper=False) if operator in ('>=', '>', '=', '==') else None
+        upper = _value_key(column, value, upper=True) if operator in ('<=', '<', '=', '==') else None
+        if lower is None and upper is None:
+            return None
+        if operator in ('=', '==') and None in (lower, upper):
+            return None
+        return lower, upper
+    return None
+
+
+def _grouping_parentheses(masked: str) -> List[int]:
+    """Positions of parentheses that only group conditions (not function calls or IN lists)"""
+    positions, stack = [], []
+    for i, char in enumerate(masked):
+        if char == '(':
+            before = masked[:i].rstrip()
+            grouping = not before or before.endswith('(') or re.search(r"\b(?:AND|WHERE)$", before, re.I)
+            stack.append(i if grouping else None)
+        elif char == ')' and stack:
+            opened = stack.pop()
+            if opened is not None:
+                positions += [opened, i]
+    return positions
+
+
+def sql_date_range(sql: str) -> Tuple[Optional[int], Optional[int]]:
+    """(start_key, end_key) that every row the query reads from the table lies in; None where a side is open.
+
+    A side is only bounded when the query is a single SELECT whose WHERE is a
+    plain AND of conditions, each either a date condition the parser fully
+    understands (date_key compared with YYYYMMDD, date compared with an ISO
+    literal or a literal date() call, BETWEEN, LIKE 'YYYY-MM%') or a
+    condition that does not mention the date columns. Anything else (OR, NOT,
+    subqueries, CTEs, compound selects, wrapped date columns) returns
+    (None, None), so all archive files are read.
+    """
+    unbounded = (None, None)
+    masked = mask_sql(sql)
+    upper_sql = masked.upper()
+    if len(re.findall(r"\bSELECT\b", upper_sql)) != 1 or re.search(r"\b(?:WITH|UNION|INTERSECT|EXCEPT)\b", upper_sql):
+        return unbounded
+    wheres = list(re.finditer(r"\bWHERE\b", upper_sql))
+    if len(wheres) != 1:
+        return unbounded
+    start = wheres[0].end()
+    end_match = _SQL_END.search(upper_sql, start)
+    end = end_match.start() if end_match else len(sql)
+    clause, clause_masked = list(sql[start:end]), list(upper_sql[start:end])
+    if re.search(r"\b(?:OR|NOT)\b", ''.join(clause_masked)):
+        return unbounded
+    for i in _grouping_parentheses(''.join(clause_masked)):
+        clause[i] = clause_masked[i] = ' '
+    clause, clause_masked = ''.join(clause), ''.join(clause_masked)
+
+    # 以 AND 切成各個條件，BETWEEN ... AND ... 的 AND 不切
+    conditions, begin, in_between = [], 0, False
+    for match in re.finditer(r"\b(?:AND|BETWEEN)\b", clause_masked):
+        if match.group(0) == 'BETWEEN':
+            in_between = True
+        elif in_between:
+            in_between = False
+        else:
+            conditions.append((begin, match.start()))
+            begin = match.end()
+    conditions.append((begin, len(clause)))
+
+    lower, upper = [], []
+    for begin, finish in conditions:
+        if not _DATE_COLUMN.search(clause_masked[begin:finish]):
+            continue  # 與日期無關的條件只會再縮小結果，不影響範圍
+        bounds = _condition_range(clause[begin:finish].strip())
+        if bounds is None:
+            return unbounded
+        if bounds[0] is not None:
+            lower.append(bounds[0])
+        if bounds[1] is not None:
+            upper.append(bounds[1])
+    # 條件全部以 AND 串接，取最緊的界
+    return (max(lower) if lower else None, min(upper) if upper else None)
+
+
+def open_with_archives(db_path: str, table: str) -> sqlite3.Connection:
+    """A connection where `table` is the hot table plus an in-memory `archived` table, filled by load_archived.
+
+    The database is attached read-only; a temp view named like the hot table
+    (temp objects take precedence over the attached ones) is the UNION ALL of
+    the two. Every other table, such as the rollups, resolves to the attached
+    database.
+    """
+    conn = sqlite3.connect("file::memory:", uri=True, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    path = os.path.abspath(db_path).replace('?', '%3f').replace('#', '%23')
+    conn.execute("ATTACH DATABASE ? AS hot", (f"file:{path}?mode=ro",))
+    columns = ", ".join(COLUMNS)
+    conn.execute(f"CREATE TABLE archived ({columns})")
+    conn.execute(
+        f"CREATE TEMP VIEW {table} AS SELECT {columns} FROM hot.{table} UNION ALL SELECT {columns} FROM main.archived"
+    )
+    conn.commit()
+    return conn
+
+
+def load_archived(conn: sqlite3.Connection, db_path: str, entries: Sequence[Dict[str, Any]],
+                  start_key: int = None, end_key: int = None, deadline: float = None) -> int:
+    """Insert the archived rows of entries inside the range into conn's archived table, then make conn read-only.
+
+    Run it under the query's time budget: the inserts are interrupted by the
+    budget's progress handler, and once deadline (time.perf_counter()) has
+    passed no further file is read. Returns the number of rows loaded.
+    """
+    loaded = 0
+    insert = f"INSERT INTO archived VALUES ({', '.join('?' * len(COLUMNS))})"
+    for entry in entries:
+        if deadline is not None and time.perf_counter() > deadline:
+            # 與被中斷的 SQL 相同的錯誤，由 time_budget 轉成逾時
+            raise sqlite3.OperationalError("interrupted")
+        rows = read_file(os.path.join(archive_dir(db_path), entry['file']))
+        selected = rows.mask(start_key, end_key)
+        if selected.any():
+            conn.executemany(insert, rows.rows(selected))
+            loaded += int(selected.sum())
+    conn.execute("CREATE INDEX archived_date_key ON archived(date_key)")
+    conn.commit()
+    conn.execute("PRAGMA query_only=ON")
+    return loaded
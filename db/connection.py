@@ -0,0 +1,201 @@
+import itertools
+import os
+import sqlite3
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List
+from dotenv import load_dotenv
+
+try:
+    from config import DB_SETTING
+except ImportError:  # 直接執行 python db/db_init.py 時，專案根目錄不在 sys.path
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from config import DB_SETTING
+
+# Load environment variables
+load_dotenv()
+
+
+# 所有資料庫共用的遞增版本號：分片各自計數時，不同分片或重新開啟的同一分片可能出現相同版本，
+# 快取會誤用別人的結果
+_write_versions = itertools.count(1)
+
+
+def next_write_version() -> int:
+    """Draw a new version, greater than every version handed out so far"""
+    return next(_write_versions)
+
+
+def get_database_path() -> str:
+    """Return the configured database path shared by the tools and DatabaseManager"""
+    return os.getenv('DATABASE_PATH', 'db/bookkeeper.db')
+
+
+class ConnectionManager:
+    """Long-lived SQLite connections for a single database file.
+
+    Readers get one read-only (query_only) connection per thread, reused
+    across calls. All writes go through a single writer connection guarded by
+    a lock, so concurrent sessions queue in-process instead of fighting over
+    SQLite's file lock.
+    """
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+
+        self._local = threading.local()
+        self._writer = None
+        self._writer_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._readers = []
+        # 寫入提交後與關閉時通知（讀取副本用來得知資料變動）
+        self._listeners: List[Callable[[str], None]] = []
+        # 每次成功寫入都會換成新的版本號（跨資料庫不重複），供快取判斷資料是否變動
+        self.write_version = next_write_version()
+        self.stats = {
+            'connections_opened': 0,
+            'reader_reuse': 0,
+            'writer_reuse': 0,
+            'lock_waits': 0,
+            'lock_wait_seconds': 0.0,
+            'writes': 0,
+        }
+
+    def _connect(self, check_same_thread: bool = True, readonly: bool = False) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=DB_SETTING['BUSY_TIMEOUT_MS'] / 1000,
+            check_same_thread=check_same_thread,
+        )
+        conn.row_factory = sqlite3.Row
+        conn.execute(f"PRAGMA journal_mode={DB_SETTING['JOURNAL_MODE']}")
+        conn.execute(f"PRAGMA synchronous={DB_SETTING['SYNCHRONOUS']}")
+        conn.execute(f"PRAGMA cache_size={DB_SETTING['CACHE_SIZE']}")
+        conn.execute(f"PRAGMA mmap_size={DB_SETTING['MMAP_SIZE']}")
+        conn.execute(f"PRAGMA busy_timeout={DB_SETTING['BUSY_TIMEOUT_MS']}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        if readonly:
+            conn.execute("PRAGMA query_only=ON")
+        self._count('connections_opened')
+        return conn
+
+    def _count(self, key: str, value: float = 1) -> None:
+        with self._stats_lock:
+            self.stats[key] += value
+
+    @contextmanager
+    def reader(self) -> Iterator[sqlite3.Connection]:
+        """Yield this thread's read-only connection, opening it on first use"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._connect(readonly=True)
+            self._local.conn = conn
+            with self._stats_lock:
+                self._readers.append(conn)
+        else:
+            self._count('reader_reuse')
+        yield conn
+
+    @contextmanager
+    def writer(self) -> Iterator[sqlite3.Connection]:
+        """Yield the shared writer connection inside a transaction.
+
+        Commits on success and rolls back on error. Callers block here while
+        another thread holds the writer.
+        """
+        if not self._writer_lock.acquire(blocking=False):
+            started = time.perf_counter()
+            self._writer_lock.acquire()
+            with self._stats_lock:
+                self.stats['lock_waits'] += 1
+                self.stats['lock_wait_seconds'] += time.perf_counter() - started
+        try:
+            if self._writer is None:
+                self._writer = self._connect(check_same_thread=False)
+            else:
+                self._count('writer_reuse')
+            try:
+                yield self._writer
+                self._writer.commit()
+                self.write_version = next_write_version()
+                self._count('writes')
+                self._notify('write')
+            except Exception:
+                self._writer.rollback()
+                raise
+        finally:
+            self._writer_lock.release()
+
+    def add_listener(self, callback: Callable[[str], None]) -> None:
+        """Call callback("write") after every committed write and callback("close") on close()"""
+        self._listeners.append(callback)
+
+    def _notify(self, event: str) -> None:
+        for callback in list(self._listeners):
+            callback(event)
+
+    def open_connection(self, readonly: bool = False) -> sqlite3.Connection:
+        """Open a dedicated connection owned by the caller (e.g. for a paging cursor)"""
+        return self._connect(check_same_thread=False, readonly=readonly)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Return a snapshot of the connection counters"""
+        with self._stats_lock:
+            return dict(self.stats)
+
+    def close(self) -> None:
+        """Close the writer and every reader opened so far"""
+        self._notify('close')
+        with self._writer_lock:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+        with self._stats_lock:
+            readers, self._readers = self._readers, []
+        for conn in readers:
+            try:
+                conn.close()
+            except sqlite3.ProgrammingError:
+                # 其他執行緒建立的連線無法在此關閉，交由 GC 回收
+                pass
+        self._local = threading.local()
+
+
+_managers: Dict[str, ConnectionManager] = {}
+_managers_lock = threading.Lock()
+
+
+def get_connection_manager(db_path: str = None) -> ConnectionManager:
+    """Return the shared ConnectionManager for db_path (defaults to DATABASE_PATH)"""
+    db_path = db_path or get_database_path()
+    key = os.path.abspath(db_path)
+    with _managers_lock:
+        manager = _managers.get(key)
+        if manager is None:
+            manager = ConnectionManager(db_path)
+            _managers[key] = manager
+        return manager
+
+
+def close_connection_manager(db_path: str) -> bool:
+    """Close and forget the manager for db_path; the next get_connection_manager reopens it"""
+    with _managers_lock:
+        manager = _managers.pop(os.path.abspath(db_path), None)
+    if manager is None:
+        return False
+    manager.close()
+    return True
+
+
+def close_all() -> None:
+    """Close every manager created through get_connection_manager"""
+    with _managers_lock:
+        managers = list(_managers.values())
+        _managers.clear()
+    for manager in managers:
+        manager.close()
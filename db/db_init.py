@@ -1,27 +1,183 @@
+import argparse
+import json
 import os
+import random
 import sqlite3
-from datetime import datetime
-from typing import List, Dict, Any
+import time
+from contextlib import closing
+from datetime import date, datetime, timedelta
+from typing import List, Dict, Any, Sequence, Tuple
 from dotenv import load_dotenv
 
+try:
+    from db.connection import get_connection_manager, get_database_path
+    from db.shards import list_shards, shard_path
+except ImportError:  # 直接執行 python db/db_init.py 時
+    from connection import get_connection_manager, get_database_path
+    from shards import list_shards, shard_path
+
 # Load environment variables
 load_dotenv()
 
+# 結構描述遷移：(版本, 說明, 方法名稱)，已套用的版本記錄在 PRAGMA user_version
+# 新的結構變更一律附加在最後，不要修改已發布的遷移
+MIGRATIONS = [
+    (1, 'transactions table', '_migrate_create_table'),
+    (2, 'import_key column', '_migrate_import_key'),
+    (3, 'rollup tables and triggers', '_migrate_rollups'),
+    (4, 'date_key column and covering indexes', '_migrate_date_key'),
+    (5, 'item full-text search', '_migrate_item_search'),
+    (6, 'archive manifest and rollup guard', '_migrate_archive'),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+# date_key：由 ISO 日期換算的整數 YYYYMMDD，作為區間查詢與覆蓋索引的日期欄位
+DATE_KEY_SQL = "CAST(strftime('%Y%m%d', {row}.date) AS INTEGER)"
+
+# 目前結構的全部索引：名稱 -> (是否唯一, 欄位定義)
+# 兩個覆蓋索引讓「日期區間（與類型）加總金額」只讀索引，不必回表
+INDEXES = {
+    'idx_date': (False, "(date)"),
+    'idx_import_key': (True, "(import_key) WHERE import_key IS NOT NULL"),
+    'idx_type_date_key': (False, "(transaction_type, date_key, amount)"),
+    'idx_date_key': (False, "(date_key, transaction_type, amount)"),
+    'idx_item': (False, "(item, date_key)"),
+}
+
+# 彙總表：{table}_{name}，以觸發器隨 INSERT / UPDATE / DELETE 增量維護
+# key 為 (欄位名稱, 由交易列 {row} 計算該欄位的 SQL 運算式)
+ROLLUPS = {
+    'daily': [('day', "substr({row}.date, 1, 10)"), ('transaction_type', "{row}.transaction_type")],
+    'monthly': [('month', "substr({row}.date, 1, 7)"), ('transaction_type', "{row}.transaction_type")],
+    'monthly_items': [
+        ('month', "substr({row}.date, 1, 7)"),
+        ('transaction_type', "{row}.transaction_type"),
+        ('item', "{row}.item"),
+    ],
+}
+
+# 合成帳本的預設項目：(項目, 類型, 最小金額, 最大金額)
+SYNTHETIC_ITEMS = [
+    ('Breakfast', 'Expense', 40, 150),
+    ('Lunch', 'Expense', 80, 300),
+    ('Dinner', 'Expense', 120, 800),
+    ('Coffee', 'Expense', 50, 200),
+    ('Groceries', 'Expense', 200, 3000),
+    ('Transportation', 'Expense', 20, 100),
+    ('Taxi', 'Expense', 100, 600),
+    ('Rent', 'Expense', 8000, 25000),
+    ('Utilities', 'Expense', 500, 3000),
+    ('Phone bill', 'Expense', 300, 1500),
+    ('Books', 'Expense', 200, 1200),
+    ('Movies', 'Expense', 250, 600),
+    ('Clothing', 'Expense', 300, 5000),
+    ('Medical', 'Expense', 150, 3000),
+    ('Gifts', 'Expense', 300, 5000),
+    ('Salary', 'Income', 30000, 90000),
+    ('Bonus', 'Income', 5000, 100000),
+    ('Freelance', 'Income', 2000, 30000),
+    ('Interest', 'Income', 10, 2000),
+    ('Refund', 'Income', 100, 3000),
+]
+
+# 標準測試資料庫大小（db/fixtures/ledger_<name>.db）
+FIXTURE_SIZES = {
+    'small': 10_000,
+    'medium': 1_000_000,
+    'large': 10_000_000,
+    'xlarge': 50_000_000,
+}
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+def date_key(value: str) -> int:
+    """Integer YYYYMMDD key of an ISO date (or datetime) string"""
+    return int(value[:10].replace('-', ''))
+
+
+def _tiering():
+    """db/archive.py, imported on first use so NumPy is not loaded at startup"""
+    try:
+        from db import archive
+    except ImportError:  # 直接執行 python db/db_init.py 時
+        import archive
+    return archive
+
+
 class DatabaseManager:
     def __init__(self, db_path: str = None):
         """Initialize database manager"""
-        self.db_path = db_path or os.getenv('DATABASE_PATH', 'db/bookkeeper.db')
+        self.db_path = db_path or get_database_path()
         self.db_dir = os.path.dirname(self.db_path)
         self.table_name = os.getenv('TABLE_NAME', 'transactions')
 
+    @classmethod
+    def for_tenant(cls, tenant: str) -> "DatabaseManager":
+        """Manager for a tenant's shard (see db/shards.py)"""
+        return cls(shard_path(tenant))
+
+    @property
+    def connections(self):
+        """Shared connection manager for this database (also used by tools.py)"""
+        return get_connection_manager(self.db_path)
+
     def init_database(self) -> None:
         """Initialize database and create necessary tables"""
-        if not os.path.exists(self.db_dir):
-            os.makedirs(self.db_dir)
+        applied = self.migrate()
         
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        # Insert test data
+        test_data = [
+            ('Lunch', 150.0, '2024-03-01', 'Expense'),
+            ('Salary', 50000.0, '2024-03-05', 'Income'),
+            ('Transportation', 30.0, '2024-03-02', 'Expense'),
+            ('Coffee', 80.0, '2024-03-03', 'Expense')
+        ]
         
+        with self.connections.writer() as conn:
+            conn.executemany(f"""
+            INSERT INTO {self.table_name} (item, amount, date, transaction_type, date_key)
+            VALUES (?, ?, ?, ?, ?)
+            """, [row + (date_key(row[2]),) for row in test_data])
+        print("Database initialization completed!")
+        if applied:
+            print(f"Applied migrations: {', '.join(applied)}")
+        print(f"Database location: {os.path.abspath(self.db_path)}")
+
+    def schema_version(self) -> int:
+        with self.connections.reader() as conn:
+            return conn.execute("PRAGMA user_version").fetchone()[0]
+
+    def migrate(self) -> List[str]:
+        """Apply pending migrations in order and return their descriptions.
+
+        All pending migrations run in one write transaction together with the
+        user_version bump, so a failed migration leaves the schema unchanged.
+        """
+        applied = []
+        with self.connections.writer() as conn:
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            if version > SCHEMA_VERSION:
+                raise RuntimeError(
+                    f"Database schema version {version} is newer than this code supports ({SCHEMA_VERSION})"
+                )
+            if version == SCHEMA_VERSION:
+                return applied
+            # sqlite3 模組不會替 DDL 自動開啟交易，需手動 BEGIN 才能整批回滾
+            if not conn.in_transaction:
+                conn.execute("BEGIN")
+            cursor = conn.cursor()
+            for number, description, method in MIGRATIONS:
+                if number <= version:
+                    continue
+                getattr(self, method)(cursor)
+                cursor.execute(f"PRAGMA user_version = {number}")
+                applied.append(description)
+        return applied
+
+    def _columns(self, cursor: sqlite3.Cursor) -> List[str]:
+        return [row[1] for row in cursor.execute(f"PRAGMA table_info({self.table_name})")]
+
+    def _migrate_create_table(self, cursor: sqlite3.Cursor) -> None:
         # Create transactions table
         cursor.execute(f"""
         CREATE TABLE IF NOT EXISTS {self.table_name} (
@@ -33,7 +189,6 @@ class DatabaseManager:
         )
         """)
         
-        # Create indices
         cursor.execute(f"""
         CREATE INDEX IF NOT EXISTS idx_date 
         ON {self.table_name}(date)
@@ -43,24 +198,382 @@ class DatabaseManager:
         CREATE INDEX IF NOT EXISTS idx_transaction_type 
         ON {self.table_name}(transaction_type)
         """)
-        
-        # Insert test data
-        test_data = [
-            ('Lunch', 150.0, '2024-03-01', 'Expense'),
-            ('Salary', 50000.0, '2024-03-05', 'Income'),
-            ('Transportation', 30.0, '2024-03-02', 'Expense'),
-            ('Coffee', 80.0, '2024-03-03', 'Expense')
-        ]
-        
-        cursor.executemany(f"""
-        INSERT INTO {self.table_name} (item, amount, date, transaction_type)
-        VALUES (?, ?, ?, ?)
-        """, test_data)
-        
-        conn.commit()
-        conn.close()
-        print("Database initialization completed!")
-        print(f"Database location: {os.path.abspath(self.db_path)}")
+
+    def _migrate_import_key(self, cursor: sqlite3.Cursor) -> None:
+        # 匯入帳單時的去重鍵，只有匯入的交易才有值
+        if 'import_key' not in self._columns(cursor):
+            cursor.execute(f"ALTER TABLE {self.table_name} ADD COLUMN import_key TEXT")
+        self._create_index(cursor, 'idx_import_key')
+
+    def _migrate_rollups(self, cursor: sqlite3.Cursor) -> None:
+        self._create_rollups(cursor)
+        self._fill_rollups(cursor)
+
+    def _migrate_date_key(self, cursor: sqlite3.Cursor) -> None:
+        if 'date_key' not in self._columns(cursor):
+            cursor.execute(f"ALTER TABLE {self.table_name} ADD COLUMN date_key INTEGER")
+        # 無法解析的舊日期保留原值，date_key 為 NULL
+        cursor.execute(f"""
+        UPDATE {self.table_name} SET date_key = {DATE_KEY_SQL.format(row=self.table_name)}
+        WHERE date(date) IS NOT NULL
+        """)
+        # (transaction_type) 是新覆蓋索引的前綴，不再需要
+        cursor.execute("DROP INDEX IF EXISTS idx_transaction_type")
+        self._create_index(cursor, 'idx_type_date_key')
+        self._create_index(cursor, 'idx_date_key')
+        self._create_date_triggers(cursor)
+        cursor.execute("ANALYZE")
+
+    def _migrate_item_search(self, cursor: sqlite3.Cursor) -> None:
+        self._create_index(cursor, 'idx_item')
+        self._create_item_search(cursor)
+        self._rebuild_item_search(cursor)
+
+    def _migrate_archive(self, cursor: sqlite3.Cursor) -> None:
+        # 封存的 manifest：每個期間一個檔案，與刪除主表資料在同一個交易中更新
+        cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS {self.table_name}_archive (
+            period TEXT PRIMARY KEY,
+            file TEXT NOT NULL,
+            rows INTEGER NOT NULL,
+            min_date TEXT NOT NULL,
+            max_date TEXT NOT NULL,
+            min_date_key INTEGER NOT NULL,
+            max_date_key INTEGER NOT NULL,
+            expense_total REAL NOT NULL,
+            expense_count INTEGER NOT NULL,
+            income_total REAL NOT NULL,
+            income_count INTEGER NOT NULL,
+            bytes INTEGER NOT NULL,
+            archived_at TEXT NOT NULL
+        )
+        """)
+        # 重建彙總觸發器，加上封存期間不更新的條件
+        cursor.execute(f"DROP TRIGGER IF EXISTS {self.table_name}_rollup_insert")
+        cursor.execute(f"DROP TRIGGER IF EXISTS {self.table_name}_rollup_delete")
+        self._create_rollups(cursor)
+
+    def _create_index(self, cursor: sqlite3.Cursor, name: str) -> None:
+        unique, definition = INDEXES[name]
+        cursor.execute(
+            f"CREATE {'UNIQUE ' if unique else ''}INDEX IF NOT EXISTS {name} ON {self.table_name}{definition}"
+        )
+
+    def _create_indexes(self, cursor: sqlite3.Cursor) -> None:
+        for name in INDEXES:
+            self._create_index(cursor, name)
+
+    def _create_date_triggers(self, cursor: sqlite3.Cursor) -> None:
+        """Reject dates that are not ISO YYYY-MM-DD and keep date_key in step with date"""
+        # 經 julianday 往返可擋下 2024-02-30 這類 date() 照單全收的日期
+        invalid = "date(julianday(NEW.date)) IS NULL OR date(julianday(NEW.date)) != substr(NEW.date, 1, 10)"
+        key = DATE_KEY_SQL.format(row="NEW")
+        for event in ('insert', 'update'):
+            on = "INSERT" if event == 'insert' else "UPDATE OF date, date_key"
+            cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS {self.table_name}_date_check_{event}
+            BEFORE {on} ON {self.table_name}
+            WHEN {invalid}
+            BEGIN SELECT RAISE(ABORT, 'date must be an ISO date (YYYY-MM-DD)'); END
+            """)
+            # 寫入端通常已帶入 date_key；只有缺少或不一致時才補寫
+            cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS {self.table_name}_date_key_{event}
+            AFTER {on} ON {self.table_name}
+            WHEN NEW.date_key IS NOT {key}
+            BEGIN UPDATE {self.table_name} SET date_key = {key} WHERE id = NEW.id; END
+            """)
+
+    def _create_item_search(self, cursor: sqlite3.Cursor) -> None:
+        """Create the {table}_fts index over item and the triggers that keep it in sync.
+
+        The trigram tokenizer matches any substring of 3+ characters, so CJK
+        items like 購買文具用品 are found without word segmentation. The table
+        stores no copy of the text (content=), only the index.
+        """
+        fts = f"{self.table_name}_fts"
+        cursor.execute(f"""
+        CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5(
+            item, content='{self.table_name}', content_rowid='id', tokenize='trigram'
+        )
+        """)
+        cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS {self.table_name}_fts_insert
+        AFTER INSERT ON {self.table_name}
+        BEGIN INSERT INTO {fts}(rowid, item) VALUES (NEW.id, NEW.item); END
+        """)
+        cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS {self.table_name}_fts_delete
+        AFTER DELETE ON {self.table_name}
+        BEGIN INSERT INTO {fts}({fts}, rowid, item) VALUES ('delete', OLD.id, OLD.item); END
+        """)
+        cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS {self.table_name}_fts_update
+        AFTER UPDATE OF item ON {self.table_name}
+        BEGIN
+            INSERT INTO {fts}({fts}, rowid, item) VALUES ('delete', OLD.id, OLD.item);
+            INSERT INTO {fts}(rowid, item) VALUES (NEW.id, NEW.item);
+        END
+        """)
+
+    def _rebuild_item_search(self, cursor: sqlite3.Cursor) -> None:
+        fts = f"{self.table_name}_fts"
+        cursor.execute(f"INSERT INTO {fts}({fts}) VALUES ('rebuild')")
+
+    def _drop_indexes_and_triggers(self, cursor: sqlite3.Cursor) -> None:
+        for name in INDEXES:
+            cursor.execute(f"DROP INDEX IF EXISTS {name}")
+        for trigger in ('rollup_insert', 'rollup_delete', 'rollup_update',
+                        'date_check_insert', 'date_check_update', 'date_key_insert', 'date_key_update',
+                        'fts_insert', 'fts_delete', 'fts_update'):
+            cursor.execute(f"DROP TRIGGER IF EXISTS {self.table_name}_{trigger}")
+
+    def generate_synthetic_ledger(
+        self,
+        rows: int,
+        start_date: str = None,
+        days: int = 365,
+        items: Sequence[Tuple[str, str, float, float]] = None,
+        income_ratio: float = 0.1,
+        batch_size: int = 100_000,
+        seed: int = None,
+    ) -> Dict[str, Any]:
+        """Bulk-load random transactions for scale testing.
+
+        Rows are inserted on a dedicated connection with synchronous=OFF, in
+        one IMMEDIATE transaction taken while holding the shared writer lock:
+        other sessions keep reading the previous state, and writers (in this
+        process or another) wait until the load commits. Indexes, triggers and
+        the item search index are dropped inside that transaction and rebuilt
+        once at the end, together with the rollup tables, so a failed load
+        rolls back to the ledger with its indexes and triggers intact.
+        Pending schema migrations are applied first.
+
+        Args:
+            rows: Number of transactions to generate.
+            start_date: First date (YYYY-MM-DD); defaults to `days` days before today.
+            days: Number of days the transactions are spread over.
+            items: (item, transaction_type, min_amount, max_amount) vocabulary,
+                defaults to SYNTHETIC_ITEMS.
+            income_ratio: Share of rows drawn from the Income items.
+            batch_size: Rows generated per executemany call.
+            seed: Random seed for reproducible ledgers.
+
+        Returns:
+            Dict with the row count, phase timings and rows_per_second.
+        """
+        items = list(items or SYNTHETIC_ITEMS)
+        expenses = [i for i in items if i[1] == 'Expense']
+        incomes = [i for i in items if i[1] == 'Income']
+        if not expenses and not incomes:
+            raise ValueError("items must contain at least one Expense or Income entry")
+        if not incomes:
+            income_ratio = 0.0
+        elif not expenses:
+            income_ratio = 1.0
+
+        first = date.fromisoformat(start_date) if start_date else date.today() - timedelta(days=days - 1)
+        dates = [(first + timedelta(days=d)).isoformat() for d in range(max(1, days))]
+        dates = [(d, date_key(d)) for d in dates]
+        rng = random.Random(seed)
+
+        def batch(n: int):
+            for _ in range(n):
+                item, kind, low, high = rng.choice(incomes if rng.random() < income_ratio else expenses)
+                day, key = rng.choice(dates)
+                yield item, float(round(rng.uniform(low, high))), day, kind, key
+
+        self.migrate()
+        conn = self.connections.open_connection()
+        conn.isolation_level = None
+        started = time.perf_counter()
+        # 持有共用寫入鎖，並以單一 IMMEDIATE 交易載入：刪除索引與觸發器期間沒有其他寫入者
+        # （包括其他行程），失敗時 ROLLBACK 連同索引、觸發器一併還原
+        with self.connections.writer(), closing(conn):
+            conn.execute("PRAGMA synchronous=OFF")
+            conn.execute("PRAGMA cache_size=-262144")
+            cursor = conn.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            try:
+                self._drop_indexes_and_triggers(cursor)
+                insert = (
+                    f"INSERT INTO {self.table_name} (item, amount, date, transaction_type, date_key) "
+                    "VALUES (?, ?, ?, ?, ?)"
+                )
+                remaining = rows
+                while remaining > 0:
+                    n = min(batch_size, remaining)
+                    cursor.executemany(insert, batch(n))
+                    remaining -= n
+                loaded = time.perf_counter()
+
+                self._create_indexes(cursor)
+                self._create_date_triggers(cursor)
+                self._create_item_search(cursor)
+                self._rebuild_item_search(cursor)
+                indexed = time.perf_counter()
+
+                # 交易表建好後一次算出彙總表，再裝回彙總觸發器
+                self._create_rollups(cursor)
+                self._fill_rollups(cursor)
+                cursor.execute("COMMIT")
+            except BaseException:
+                cursor.execute("ROLLBACK")
+                raise
+            cursor.execute("ANALYZE")
+        finished = time.perf_counter()
+
+        load_seconds = loaded - started
+        report = {
+            'rows': rows,
+            'load_seconds': round(load_seconds, 3),
+            'index_seconds': round(indexed - loaded, 3),
+            'rollup_seconds': round(finished - indexed, 3),
+            'total_seconds': round(finished - started, 3),
+            'rows_per_second': round(rows / load_seconds) if load_seconds else None,
+            'db_path': os.path.abspath(self.db_path),
+        }
+        return report
+
+    def _rollup_add_sql(self, name: str, row: str, sign: str) -> str:
+        keys = ROLLUPS[name]
+        columns = ", ".join(column for column, _ in keys)
+        values = ", ".join(expr.format(row=row) for _, expr in keys)
+        return f"""
+            INSERT INTO {self.table_name}_{name} ({columns}, total, count)
+            VALUES ({values}, {sign}{row}.amount, {sign}1)
+            ON CONFLICT({columns}) DO UPDATE SET
+                total = total + excluded.total,
+                count = count + excluded.count;
+        """
+
+    def _rollup_cleanup_sql(self, name: str, row: str) -> str:
+        match = " AND ".join(f"{column} = {expr.format(row=row)}" for column, expr in ROLLUPS[name])
+        return f"DELETE FROM {self.table_name}_{name} WHERE {match} AND count <= 0;"
+
+    def _create_rollups(self, cursor: sqlite3.Cursor) -> None:
+        """Create the rollup tables and the triggers that keep them current"""
+        for name, keys in ROLLUPS.items():
+            key_columns = ", ".join(f"{column} TEXT NOT NULL" for column, _ in keys)
+            cursor.execute(f"""
+            CREATE TABLE IF NOT EXISTS {self.table_name}_{name} (
+                {key_columns},
+                total REAL NOT NULL DEFAULT 0,
+                count INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY ({", ".join(column for column, _ in keys)})
+            ) WITHOUT ROWID
+            """)
+
+        add_new = "".join(self._rollup_add_sql(name, "NEW", "") for name in ROLLUPS)
+        remove_old = "".join(
+            self._rollup_add_sql(name, "OLD", "-") + self._rollup_cleanup_sql(name, "OLD")
+            for name in ROLLUPS
+        )
+        # 彙總表也涵蓋已封存的交易：封存搬移期間此表有一列，觸發器看到它就不更新彙總表
+        cursor.execute(f"CREATE TABLE IF NOT EXISTS {self.table_name}_archiving (active INTEGER)")
+        not_archiving = f"NOT EXISTS (SELECT 1 FROM {self.table_name}_archiving)"
+        cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS {self.table_name}_rollup_insert
+        AFTER INSERT ON {self.table_name}
+        WHEN {not_archiving}
+        BEGIN {add_new} END
+        """)
+        cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS {self.table_name}_rollup_delete
+        AFTER DELETE ON {self.table_name}
+        WHEN {not_archiving}
+        BEGIN {remove_old} END
+        """)
+        cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS {self.table_name}_rollup_update
+        AFTER UPDATE OF item, amount, date, transaction_type ON {self.table_name}
+        BEGIN {remove_old} {add_new} END
+        """)
+
+    def _rollup_select_sql(self, name: str) -> str:
+        keys = ROLLUPS[name]
+        exprs = ", ".join(f"{expr.format(row=self.table_name)} AS {column}" for column, expr in keys)
+        columns = ", ".join(column for column, _ in keys)
+        return (
+            f"SELECT {exprs}, SUM(amount) AS total, COUNT(*) AS count "
+            f"FROM {self.table_name} GROUP BY {columns}"
+        )
+
+    def rebuild_rollups(self) -> Dict[str, int]:
+        """Recompute every rollup table from the transactions table and its archive"""
+        with self.connections.writer() as conn:
+            cursor = conn.cursor()
+            self._create_rollups(cursor)
+            return self._fill_rollups(cursor)
+
+    def _fill_rollups(self, cursor: sqlite3.Cursor) -> Dict[str, int]:
+        counts = {}
+        for name, keys in ROLLUPS.items():
+            columns = ", ".join(column for column, _ in keys)
+            cursor.execute(f"DELETE FROM {self.table_name}_{name}")
+            cursor.execute(
+                f"INSERT INTO {self.table_name}_{name} ({columns}, total, count) "
+                f"{self._rollup_select_sql(name)}"
+            )
+            counts[name] = cursor.rowcount
+            archived = self._archived_rollups(cursor, name)
+            if archived:
+                cursor.executemany(
+                    f"INSERT INTO {self.table_name}_{name} ({columns}, total, count) "
+                    f"VALUES ({', '.join('?' * (len(keys) + 2))}) "
+                    f"ON CONFLICT({columns}) DO UPDATE SET "
+                    "total = total + excluded.total, count = count + excluded.count",
+                    [key + value for key, value in archived.items()],
+                )
+                counts[name] = cursor.execute(f"SELECT COUNT(*) FROM {self.table_name}_{name}").fetchone()[0]
+        return counts
+
+    def _archived_rollups(self, conn, name: str) -> Dict[tuple, Tuple[float, int]]:
+        """Rollup totals of the archived transactions, which the rollup tables also cover"""
+        try:
+            entries = conn.execute(f"SELECT file FROM {self.table_name}_archive").fetchall()
+        except sqlite3.OperationalError:
+            return {}  # 尚未套用封存遷移（遷移 3 建立彙總表時）
+        if not entries:
+            return {}
+        tiering = _tiering()
+        totals: Dict[tuple, Tuple[float, int]] = {}
+        columns = [column for column, _ in ROLLUPS[name]]
+        for (file,) in entries:
+            rows = tiering.read_file(os.path.join(tiering.archive_dir(self.db_path), file))
+            for key, (total, count) in tiering.rollup_totals(rows, columns).items():
+                before = totals.get(key, (0.0, 0))
+                totals[key] = (before[0] + total, before[1] + count)
+        return totals
+
+    def verify_rollups(self, tolerance: float = 0.005) -> Dict[str, Any]:
+        """Compare every rollup table against a fresh aggregate of the transactions table and its archive"""
+        report = {}
+        with self.connections.reader() as conn:
+            for name, keys in ROLLUPS.items():
+                columns = [column for column, _ in keys]
+                expected = {
+                    tuple(row[:len(columns)]): (row[-2], row[-1])
+                    for row in conn.execute(self._rollup_select_sql(name))
+                }
+                for key, (total, count) in self._archived_rollups(conn, name).items():
+                    before = expected.get(key, (0.0, 0))
+                    expected[key] = (before[0] + total, before[1] + count)
+                actual = {
+                    tuple(row[:len(columns)]): (row[-2], row[-1])
+                    for row in conn.execute(
+                        f"SELECT {', '.join(columns)}, total, count FROM {self.table_name}_{name}"
+                    )
+                }
+                mismatched = [
+                    key for key in expected.keys() | actual.keys()
+                    if key not in expected or key not in actual
+                    or expected[key][1] != actual[key][1]
+                    or abs(expected[key][0] - actual[key][0]) > tolerance
+                ]
+                report[name] = {'rows': len(expected), 'mismatched': len(mismatched), 'examples': mismatched[:5]}
+        report['ok'] = all(entry['mismatched'] == 0 for entry in report.values())
+        return report
 
     def check_database(self) -> Dict[str, Any]:
         """Check database status and return status information"""
@@ -68,6 +581,7 @@ class DatabaseManager:
             'exists': False,
             'table_exists': False,
             'record_count': 0,
+            'schema_version': 0,
             'error': None
         }
         
@@ -76,34 +590,171 @@ class DatabaseManager:
             if not status['exists']:
                 return status
             
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            # Check if table exists
-            cursor.execute(f"SELECT name FROM sqlite_master WHERE type='table' AND name='{self.table_name}'")
-            status['table_exists'] = cursor.fetchone() is not None
-            
-            if status['table_exists']:
-                cursor.execute(f"SELECT COUNT(*) FROM {self.table_name}")
-                status['record_count'] = cursor.fetchone()[0]
-            
-            conn.close()
+            with self.connections.reader() as conn:
+                cursor = conn.cursor()
+                
+                # Check if table exists
+                cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?", (self.table_name,))
+                status['table_exists'] = cursor.fetchone() is not None
+                status['schema_version'] = cursor.execute("PRAGMA user_version").fetchone()[0]
+                
+                if status['table_exists']:
+                    cursor.execute(f"SELECT COUNT(*) FROM {self.table_name}")
+                    status['record_count'] = cursor.fetchone()[0]
             
         except Exception as e:
             status['error'] = str(e)
             
         return status
 
+    def vacuum(self) -> Dict[str, Any]:
+        """Rebuild the file to reclaim pages freed by deletes and refresh planner statistics"""
+        def size() -> int:
+            return sum(os.path.getsize(self.db_path + s) for s in ('', '-wal') if os.path.exists(self.db_path + s))
+
+        before = size()
+        # VACUUM 不能在交易中執行；writer() 只在 DML 前才開始交易，這裡不會有未結束的交易
+        with self.connections.writer() as conn:
+            conn.execute("VACUUM")
+            conn.execute("PRAGMA optimize")
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        return {'db_path': self.db_path, 'bytes_before': before, 'bytes_after': size()}
+
+    def archive(self, before: str = None, period: str = None, chunk_rows: int = None) -> Dict[str, Any]:
+        """Move the transactions dated before `before` into per-period archive files (see db/archive.py).
+
+        Everything runs in one write transaction: rows are streamed out in
+        chunks ordered by date, each period is written to a new file (merged
+        with the period's earlier file, if any), the manifest is updated and
+        the rows are deleted. The rollup tables are left unchanged, so they
+        keep covering the archived history. Without `before`, the last
+        ARCHIVE_SETTING['KEEP_MONTHS'] months stay in the table.
+        """
+        tiering = _tiering()
+        before = date.fromisoformat(before or tiering.default_cutoff()).isoformat()
+        period = period or tiering.ARCHIVE_SETTING['PERIOD']
+        if period not in tiering.PERIODS:
+            raise ValueError(f"Unknown archive period {period!r}, expected one of {', '.join(tiering.PERIODS)}")
+        chunk_rows = chunk_rows or tiering.ARCHIVE_SETTING['CHUNK_ROWS']
+        directory = tiering.archive_dir(self.db_path)
+        cutoff = date_key(before)
+        divisor = 10000 if period == 'year' else 100
+        report = {'before': before, 'period': period, 'rows': 0, 'files': []}
+        written = []
+
+        self.migrate()
+        try:
+            with self.connections.writer() as conn:
+                # 先取得寫入鎖，讀出到刪除之間不會有其他行程插入更舊的交易
+                if not conn.in_transaction:
+                    conn.execute("BEGIN IMMEDIATE")
+                existing = {entry['period']: entry for entry in tiering.manifest(conn, self.table_name)}
+
+                def flush(rows: List[tuple]) -> None:
+                    label = tiering.period_of(rows[0][-1], period)
+                    part = tiering.ArchivedRows.from_rows(rows)
+                    if label in existing:
+                        earlier = tiering.read_file(os.path.join(directory, existing[label]['file']))
+                        part = tiering.ArchivedRows.concat([earlier, part])
+                    name = tiering.write_file(directory, self.table_name, label, part)
+                    written.append(name)
+                    summary = part.summary()
+                    conn.execute(
+                        f"INSERT OR REPLACE INTO {self.table_name}_archive (period, file, rows, min_date, max_date, "
+                        "min_date_key, max_date_key, expense_total, expense_count, income_total, income_count, "
+                        "bytes, archived_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                        (label, name, summary['rows'], tiering.key_date(summary['min_date_key']),
+                         tiering.key_date(summary['max_date_key']), summary['min_date_key'], summary['max_date_key'],
+                         summary['expense_total'], summary['expense_count'], summary['income_total'],
+                         summary['income_count'], os.path.getsize(os.path.join(directory, name)),
+                         datetime.now().isoformat(timespec='seconds')),
+                    )
+                    report['rows'] += len(rows)
+                    report['files'].append({'period': label, 'file': name, 'rows': summary['rows']})
+
+                cursor = conn.cursor()
+                cursor.row_factory = None
+                cursor.execute(
+                    f"SELECT {', '.join(tiering.COLUMNS)} FROM {self.table_name} "
+                    "WHERE date_key < ? ORDER BY date_key, id",
+                    (cutoff,),
+                )
+                current, pending = None, []
+                while True:
+                    chunk = cursor.fetchmany(chunk_rows)
+                    if not chunk:
+                        break
+                    for row in chunk:
+                        # 依日期排序，期間改變時前一個期間已完整讀出
+                        if row[-1] // divisor != current:
+                            if pending:
+                                flush(pending)
+                            current, pending = row[-1] // divisor, []
+                        pending.append(row)
+                if pending:
+                    flush(pending)
+                cursor.close()
+
+                if report['rows']:
+                    conn.execute(f"INSERT INTO {self.table_name}_archiving VALUES (1)")
+                    deleted = conn.execute(f"DELETE FROM {self.table_name} WHERE date_key < ?", (cutoff,)).rowcount
+                    conn.execute(f"DELETE FROM {self.table_name}_archiving")
+                    if deleted != report['rows']:
+                        raise RuntimeError(f"Archived {report['rows']} rows but would delete {deleted}")
+        except Exception:
+            # 交易已回滾，manifest 沒有指向這次寫的檔案
+            for name in written:
+                os.remove(os.path.join(directory, name))
+            raise
+
+        with self.connections.reader() as conn:
+            report['removed_files'] = tiering.remove_unreferenced(conn, self.db_path, self.table_name)
+        return report
+
+    def restore_archive(self, period: str) -> Dict[str, Any]:
+        """Move one archived period back into the transactions table"""
+        tiering = _tiering()
+        self.migrate()
+        with self.connections.writer() as conn:
+            if not conn.in_transaction:
+                conn.execute("BEGIN IMMEDIATE")
+            entry = conn.execute(
+                f"SELECT file FROM {self.table_name}_archive WHERE period = ?", (period,)
+            ).fetchone()
+            if entry is None:
+                raise ValueError(f"No archived period {period!r}")
+            rows = tiering.read_file(os.path.join(tiering.archive_dir(self.db_path), entry[0]))
+            # 彙總表本來就含這些交易，搬回時不再累加
+            conn.execute(f"INSERT INTO {self.table_name}_archiving VALUES (1)")
+            conn.executemany(
+                f"INSERT INTO {self.table_name} ({', '.join(tiering.COLUMNS)}) "
+                f"VALUES ({', '.join('?' * len(tiering.COLUMNS))})",
+                rows.rows(),
+            )
+            conn.execute(f"DELETE FROM {self.table_name}_archiving")
+            conn.execute(f"DELETE FROM {self.table_name}_archive WHERE period = ?", (period,))
+        # 檔案留到寬限期後由下一次 archive 刪除，讀取舊快照的查詢仍可使用
+        return {'period': period, 'rows': len(rows), 'file': entry[0]}
+
+    def archive_status(self) -> Dict[str, Any]:
+        """Manifest entries and the row counts of the hot table and the archive"""
+        tiering = _tiering()
+        with self.connections.reader() as conn:
+            entries = tiering.manifest(conn, self.table_name)
+            hot = conn.execute(f"SELECT COUNT(*) FROM {self.table_name}").fetchone()[0]
+        return {
+            'hot_rows': hot,
+            'archived_rows': sum(entry['rows'] for entry in entries),
+            'archive_bytes': sum(entry['bytes'] for entry in entries),
+            'periods': entries,
+        }
+
     def clean_database(self) -> bool:
         """Clean all records in the database"""
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
+            with self.connections.writer() as conn:
+                conn.execute(f"DELETE FROM {self.table_name}")
             
-            cursor.execute(f"DELETE FROM {self.table_name}")
-            
-            conn.commit()
-            conn.close()
             print("Database records have been cleaned")
             return True
             
@@ -111,8 +762,150 @@ class DatabaseManager:
             print(f"Error occurred while cleaning database: {str(e)}")
             return False
 
+def build_fixture(name: str, directory: str = FIXTURE_DIR, force: bool = False, seed: int = 42) -> Dict[str, Any]:
+    """Create the standard fixture database db/fixtures/ledger_<name>.db"""
+    if name not in FIXTURE_SIZES:
+        raise ValueError(f"Unknown fixture {name!r}, expected one of {', '.join(FIXTURE_SIZES)}")
+    path = os.path.join(directory, f"ledger_{name}.db")
+    if os.path.exists(path):
+        if not force:
+            return {'rows': None, 'db_path': path, 'skipped': True}
+        get_connection_manager(path).close()
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+    # 固定起始日與 seed，讓每次產生的 fixture 內容相同
+    return DatabaseManager(path).generate_synthetic_ledger(
+        FIXTURE_SIZES[name], start_date='2023-01-01', days=3 * 365, seed=seed
+    )
+
+
+def generate_command(db_manager: DatabaseManager, args) -> None:
+    if args.fixture:
+        report = build_fixture(args.fixture, force=args.force, seed=args.seed if args.seed is not None else 42)
+    else:
+        items = None
+        if args.items:
+            # --items 只替換支出項目，保留預設的收入項目
+            names = [name.strip() for name in args.items.split(',') if name.strip()]
+            items = [(name, 'Expense', 20, 2000) for name in names]
+            items += [i for i in SYNTHETIC_ITEMS if i[1] == 'Income']
+        report = db_manager.generate_synthetic_ledger(
+            args.rows,
+            start_date=args.start_date,
+            days=args.days,
+            items=items,
+            income_ratio=args.income_ratio,
+            batch_size=args.batch_size,
+            seed=args.seed,
+        )
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+
+def migrate_command(db_manager: DatabaseManager, args) -> None:
+    before = db_manager.schema_version()
+    applied = db_manager.migrate()
+    for description in applied:
+        print(f"Applied: {description}")
+    print(f"Schema version {before} -> {db_manager.schema_version()} (latest {SCHEMA_VERSION})")
+
+
+def shards_command(args) -> None:
+    """create / list / vacuum / migrate tenant shards (all shards on disk when no tenant is given)"""
+    if args.action == "list":
+        print(json.dumps(list_shards(), ensure_ascii=False, indent=2))
+        return
+    if args.tenants:
+        managers = [DatabaseManager.for_tenant(tenant) for tenant in args.tenants]
+    elif args.action == "create":
+        print("shards create needs at least one tenant id")
+        return
+    else:
+        managers = [DatabaseManager(shard['db_path']) for shard in list_shards()]
+
+    for manager in managers:
+        if args.action == "vacuum":
+            if not os.path.exists(manager.db_path):
+                print(f"{manager.db_path}: no such shard")
+                continue
+            report = manager.vacuum()
+            print(f"{manager.db_path}: {report['bytes_before']} -> {report['bytes_after']} bytes")
+        else:
+            # create 與 migrate 相同：不存在的分片會建立並套用全部遷移
+            applied = manager.migrate()
+            print(f"{manager.db_path}: schema version {manager.schema_version()}"
+                  + (f" (applied: {', '.join(applied)})" if applied else ""))
+
+
+def archive_command(db_manager: DatabaseManager, args) -> None:
+    """run / list / restore the cold-storage archive of old transactions"""
+    if args.tenant:
+        db_manager = DatabaseManager.for_tenant(args.tenant)
+    if args.action == "run":
+        report = db_manager.archive(before=args.before, period=args.period)
+    elif args.action == "restore":
+        if not args.restore_period:
+            print("archive restore needs --restore-period, e.g. 2024-03")
+            return
+        report = db_manager.restore_archive(args.restore_period)
+    else:
+        report = db_manager.archive_status()
+    print(json.dumps(report, ensure_ascii=False, indent=2, default=str))
+
+
+def rollups_command(db_manager: DatabaseManager, args) -> None:
+    if args.rebuild:
+        counts = db_manager.rebuild_rollups()
+        print(f"Rollups rebuilt: {counts}")
+    report = db_manager.verify_rollups()
+    print(json.dumps(report, ensure_ascii=False, indent=2, default=str))
+    print("Rollups are consistent" if report['ok'] else "Rollups are out of date, run with --rebuild")
+
+
 def main():
+    parser = argparse.ArgumentParser(description="Database maintenance for Multi-Agent-CoinChat")
+    subcommands = parser.add_subparsers(dest="command")
+    subcommands.add_parser("migrate", help="apply pending schema migrations")
+    shards = subcommands.add_parser("shards", help="manage per-tenant ledger shards (DB_SHARD_DIR)")
+    shards.add_argument("action", choices=["create", "list", "vacuum", "migrate"])
+    shards.add_argument("tenants", nargs="*", help="tenant ids (default for vacuum/migrate: every shard on disk)")
+    archive = subcommands.add_parser("archive", help="move old transactions to compressed columnar archive files")
+    archive.add_argument("action", choices=["run", "list", "restore"])
+    archive.add_argument("--before", help="archive transactions dated before YYYY-MM-DD "
+                                          "(default: keep DB_ARCHIVE_KEEP_MONTHS months)")
+    archive.add_argument("--period", choices=["month", "year"], help="one file per month or year (default: DB_ARCHIVE_PERIOD)")
+    archive.add_argument("--restore-period", help="period to move back into the table, e.g. 2024-03")
+    archive.add_argument("--tenant", help="archive a tenant's shard instead of DATABASE_PATH")
+    rollups = subcommands.add_parser("rollups", help="verify (or rebuild) the daily/monthly rollup tables")
+    rollups.add_argument("--rebuild", action="store_true", help="recompute the rollups from the transactions table")
+    generate = subcommands.add_parser("generate", help="bulk-load a synthetic ledger for scale testing")
+    generate.add_argument("--rows", type=int, default=1_000_000)
+    generate.add_argument("--start-date", help="first date, YYYY-MM-DD (default: --days before today)")
+    generate.add_argument("--days", type=int, default=365, help="number of days to spread transactions over")
+    generate.add_argument("--items", help="comma-separated expense items (default: built-in vocabulary)")
+    generate.add_argument("--income-ratio", type=float, default=0.1)
+    generate.add_argument("--batch-size", type=int, default=100_000)
+    generate.add_argument("--seed", type=int)
+    generate.add_argument("--fixture", choices=list(FIXTURE_SIZES), help="build db/fixtures/ledger_<name>.db instead")
+    generate.add_argument("--force", action="store_true", help="overwrite an existing fixture")
+    args = parser.parse_args()
+
     db_manager = DatabaseManager()
+    if args.command == "migrate":
+        migrate_command(db_manager, args)
+        return
+    if args.command == "shards":
+        shards_command(args)
+        return
+    if args.command == "archive":
+        archive_command(db_manager, args)
+        return
+    if args.command == "rollups":
+        rollups_command(db_manager, args)
+        return
+    if args.command == "generate":
+        generate_command(db_manager, args)
+        return
     
     # Check database status
     print("Checking database status...")
@@ -125,6 +918,7 @@ def main():
     print(f"Database file exists: {'Yes' if status['exists'] else 'No'}")
     print(f"Transactions table exists: {'Yes' if status['table_exists'] else 'No'}")
     print(f"Current record count: {status['record_count']}")
+    print(f"Schema version: {status['schema_version']} (latest {SCHEMA_VERSION})")
     
     # Ask whether to clean database
     if status['exists'] and status['record_count'] > 0:
@@ -0,0 +1,397 @@
+"""
+Streaming import of bank and credit-card statements (CSV or OFX).
+
+Rows are parsed one at a time, mapped to item/amount/date/transaction_type
+and written with INSERT OR IGNORE in batched transactions, so memory stays
+flat however large the file is. Each imported row gets an import_key (the
+OFX FITID, or a hash of date/amount/item and its occurrence number), and a
+unique index on it makes re-importing the same or an overlapping statement
+skip rows that are already stored. Rows of periods moved to the archive
+(db/archive.py) are checked batch by batch against the import_keys column of
+the archive files, which is read without caching the files.
+
+    python -m db.importer statement.csv
+    python -m db.importer card.csv --expense-sign positive --date-format %d/%m/%Y
+    python -m db.importer bank.ofx --batch-size 10000
+"""
+import argparse
+import csv
+import hashlib
+import json
+import os
+import re
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from config import IMPORT_SETTING
+from db.connection import get_connection_manager
+from db.db_init import DatabaseManager, date_key
+from db.shards import shard_path
+
+# 常見帳單欄位名稱（小寫比對），依序嘗試
+COLUMN_ALIASES = {
+    'date': ['date', 'transaction date', 'posted date', 'posting date', 'booking date', '日期', '交易日期', '消費日期', '入帳日期'],
+    'item': ['description', 'item', 'payee', 'name', 'memo', 'details', 'merchant', '摘要', '說明', '項目', '交易說明', '消費明細', '備註'],
+    'amount': ['amount', 'transaction amount', '金額', '交易金額'],
+    'debit': ['debit', 'withdrawal', 'withdrawals', 'money out', '支出', '提款', '支出金額'],
+    'credit': ['credit', 'deposit', 'deposits', 'money in', '收入', '存入', '存入金額'],
+    'transaction_type': ['transaction_type', 'type', '類型', '收支'],
+}
+DATE_FORMATS = ['%Y-%m-%d', '%Y/%m/%d', '%Y%m%d', '%m/%d/%Y', '%Y.%m.%d', '%d.%m.%Y']
+_INCOME_TYPES = {'income', 'credit', 'deposit', 'cr', '收入', '存入'}
+_EXPENSE_TYPES = {'expense', 'debit', 'withdrawal', 'payment', 'dr', '支出', '提款'}
+# 出現次數計數器的上限，讓記憶體不隨檔案大小成長（帳單多依日期排序，相同交易通常相鄰）
+MAX_OCCURRENCE_KEYS = 10_000
+
+
+class ImportErrorRow(ValueError):
+    """A statement row that cannot be mapped to a transaction"""
+
+
+def parse_amount(text: str) -> float:
+    """Parse "1,234.50", "-80", "(80.00)" or "NT$ 80" into a float"""
+    text = (text or '').strip()
+    negative = text.startswith('(') and text.endswith(')')
+    cleaned = re.sub(r"[^\d.\-+]", "", text)
+    if not cleaned or cleaned in ('-', '+', '.'):
+        raise ImportErrorRow("invalid amount")
+    value = float(cleaned)
+    return -abs(value) if negative else value
+
+
+def parse_date(text: str, date_format: str = None) -> str:
+    text = (text or '').strip()
+    if date_format:
+        try:
+            return datetime.strptime(text, date_format).date().isoformat()
+        except ValueError:
+            raise ImportErrorRow(f"date does not match {date_format}") from None
+    # OFX 日期如 20240305120000[-5:EST]，只取日期部分
+    if re.match(r"^\d{8}", text) and not text[:8].count('/'):
+        text = text[:8]
+    for fmt in DATE_FORMATS:
+        try:
+            return datetime.strptime(text, fmt).date().isoformat()
+        except ValueError:
+            continue
+    raise ImportErrorRow("unrecognized date")
+
+
+def resolve_columns(header: List[str], mapping: Dict[str, str] = None) -> Dict[str, str]:
+    """Map our fields to the statement's column names, from aliases or an explicit mapping.
+
+    Errors name only our fields and the column count: the header may not be a
+    statement at all, and the message can reach the model and the user.
+    """
+    columns = {}
+    lowered = {name.strip().lower(): name for name in header if name}
+    for field, aliases in COLUMN_ALIASES.items():
+        if mapping and field in mapping:
+            if mapping[field] not in header:
+                raise ValueError(f"Column mapped to {field} not found among the {len(header)} columns")
+            columns[field] = mapping[field]
+            continue
+        for alias in aliases:
+            if alias in lowered:
+                columns[field] = lowered[alias]
+                break
+    if 'date' not in columns or 'item' not in columns:
+        raise ValueError(f"Could not find date/description columns among the {len(header)} columns; "
+                         "pass a column mapping")
+    if 'amount' not in columns and not ('debit' in columns or 'credit' in columns):
+        raise ValueError(f"Could not find an amount (or debit/credit) column among the {len(header)} columns; "
+                         "pass a column mapping")
+    return columns
+
+
+def _transaction_type(raw_type: Optional[str], signed_amount: float, expense_sign: str) -> str:
+    if raw_type:
+        lowered = raw_type.strip().lower()
+        if lowered in _INCOME_TYPES:
+            return 'Income'
+        if lowered in _EXPENSE_TYPES:
+            return 'Expense'
+    if expense_sign == 'positive':
+        return 'Expense' if signed_amount > 0 else 'Income'
+    return 'Expense' if signed_amount < 0 else 'Income'
+
+
+def iter_csv(
+    path: str,
+    mapping: Dict[str, str] = None,
+    date_format: str = None,
+    expense_sign: str = 'negative',
+    encoding: str = 'utf-8-sig',
+) -> Iterator[Dict[str, Any]]:
+    """Yield raw statement rows from a CSV file, one at a time"""
+    with open(path, newline='', encoding=encoding) as f:
+        sample = f.read(4096)
+        f.seek(0)
+        try:
+            dialect = csv.Sniffer().sniff(sample, delimiters=",;\t")
+        except csv.Error:
+            dialect = csv.excel
+        reader = csv.DictReader(f, dialect=dialect)
+        columns = resolve_columns(reader.fieldnames or [], mapping)
+        for line_number, row in enumerate(reader, start=2):
+            try:
+                amount = (row.get(columns['amount']) or '').strip() if 'amount' in columns else ''
+                debit = (row.get(columns['debit']) or '').strip() if 'debit' in columns else ''
+                credit = (row.get(columns['credit']) or '').strip() if 'credit' in columns else ''
+                sign = expense_sign
+                if amount:
+                    signed = parse_amount(amount)
+                elif debit or credit:
+                    signed = -abs(parse_amount(debit)) if debit else abs(parse_amount(credit))
+                    # 借貸分欄時金額方向已確定，不套用 expense_sign
+                    sign = 'negative'
+                else:
+                    raise ImportErrorRow("no amount")
+                yield {
+                    'item': (row.get(columns['item']) or '').strip(),
+                    'signed_amount': signed,
+                    'date': parse_date(row.get(columns['date']), date_format),
+                    'raw_type': row.get(columns['transaction_type']) if 'transaction_type' in columns else None,
+                    'expense_sign': sign,
+                    'ref': None,
+                }
+            except ImportErrorRow as e:
+                yield {'error': f"line {line_number}: {e}"}
+            except ValueError:
+                # 其他例外訊息可能含有該行內容，只回報行號
+                yield {'error': f"line {line_number}: unreadable row"}
+
+
+def _ofx_tokens(path: str, chunk_size: int = 65536) -> Iterator[Tuple[str, str]]:
+    """Yield (tag, text) pairs from an OFX file (SGML or XML) without loading it whole"""
+    buffer = ''
+    with open(path, encoding='utf-8', errors='replace') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            buffer += chunk
+            parts = buffer.split('<')
+            # 最後一段可能被 chunk 切斷，留到下一輪
+            buffer = parts.pop() if chunk else ''
+            for part in parts:
+                if not part or '>' not in part:
+                    continue
+                tag, _, text = part.partition('>')
+                yield tag.strip().upper(), text.strip()
+            if not chunk:
+                break
+
+
+def iter_ofx(path: str) -> Iterator[Dict[str, Any]]:
+    """Yield raw statement rows from the <STMTTRN> blocks of an OFX file"""
+    current = None
+    number = 0
+    for tag, text in _ofx_tokens(path):
+        if tag == 'STMTTRN':
+            current = {}
+            number += 1
+        elif tag == '/STMTTRN' and current is not None:
+            try:
+                signed = parse_amount(current.get('TRNAMT'))
+                yield {
+                    'item': (current.get('NAME') or current.get('MEMO') or current.get('PAYEE') or '').strip(),
+                    'signed_amount': signed,
+                    'date': parse_date(current.get('DTPOSTED') or current.get('DTUSER')),
+                    'raw_type': None,
+                    # OFX 金額一律以負數表示支出
+                    'expense_sign': 'negative',
+                    'ref': current.get('FITID'),
+                }
+            except ImportErrorRow as e:
+                yield {'error': f"transaction {number}: {e}"}
+            except ValueError:
+                yield {'error': f"transaction {number}: unreadable transaction"}
+            current = None
+        elif current is not None and not tag.startswith('/') and text:
+            current.setdefault(tag, text)
+
+
+def detect_format(path: str) -> str:
+    extension = os.path.splitext(path)[1].lower()
+    if extension in ('.ofx', '.qfx'):
+        return 'ofx'
+    if extension in ('.csv', '.tsv', '.txt'):
+        return 'csv'
+    with open(path, encoding='utf-8', errors='replace') as f:
+        head = f.read(1024).upper()
+    return 'ofx' if 'OFXHEADER' in head or '<OFX>' in head else 'csv'
+
+
+def resolve_import_path(path: str, directory: str = None) -> str:
+    """Real path of a statement inside directory (IMPORT_SETTING['DIR']); ValueError for anything outside it.
+
+    Used for paths that come from the model or a remote user, so they cannot
+    read arbitrary files on the host. Relative paths are taken relative to
+    directory; symlinks and '..' are resolved before the check.
+    """
+    root = os.path.realpath(directory or IMPORT_SETTING['DIR'])
+    resolved = os.path.realpath(os.path.join(root, os.path.expanduser(path)))
+    if os.path.commonpath([root, resolved]) != root:
+        raise ValueError(f"Statements can only be imported from the import directory ({directory or IMPORT_SETTING['DIR']})")
+    if not os.path.isfile(resolved):
+        raise ValueError(f"No statement file named {os.path.relpath(resolved, root)!r} in the import directory")
+    return resolved
+
+
+def make_import_key(row: Dict[str, Any], occurrence: int, source: str) -> str:
+    if row['ref']:
+        return f"{source}:fitid:{row['ref']}"
+    raw = f"{row['date']}|{row['signed_amount']:.2f}|{row['item'].lower()}|{occurrence}"
+    return f"{source}:{hashlib.sha1(raw.encode('utf-8')).hexdigest()}"
+
+
+def import_statement(
+    path: str,
+    file_format: str = None,
+    db_path: str = None,
+    batch_size: int = 5000,
+    mapping: Dict[str, str] = None,
+    date_format: str = None,
+    expense_sign: str = 'negative',
+    source: str = None,
+) -> Dict[str, Any]:
+    """Import a CSV/OFX statement and return counts and throughput.
+
+    Args:
+        path: Statement file.
+        file_format: "csv" or "ofx" (detected from the file when omitted).
+        db_path: Target database (defaults to DATABASE_PATH).
+        batch_size: Rows per write transaction.
+        mapping: Explicit {field: column} mapping for CSV headers, e.g.
+            {"item": "Payee", "amount": "Value"}.
+        date_format: strptime format for CSV dates that are not auto-detected.
+        expense_sign: "negative" when expenses are negative amounts (bank
+            exports), "positive" when purchases are positive (card exports).
+        source: Namespace for import keys, so identical rows from different
+            accounts are kept apart (defaults to "import").
+
+    Returns:
+        Dict with read/inserted/duplicates/skipped counts, the first errors,
+        seconds and rows_per_second.
+    """
+    file_format = file_format or detect_format(path)
+    if file_format not in ('csv', 'ofx'):
+        raise ValueError(f"Unsupported format {file_format!r}, expected csv or ofx")
+    if expense_sign not in ('negative', 'positive'):
+        raise ValueError("expense_sign must be 'negative' or 'positive'")
+    source = source or 'import'
+
+    manager = DatabaseManager(db_path)
+    manager.migrate()
+    connections = get_connection_manager(manager.db_path)
+    sql = (
+        f"INSERT OR IGNORE INTO {manager.table_name} (item, amount, date, transaction_type, date_key, import_key) "
+        "VALUES (?, ?, ?, ?, ?, ?)"
+    )
+
+    # 已封存期間的交易不在主表，唯一索引擋不住重複匯入，改比對封存檔中的 import_key
+    from db import archive
+    with connections.reader() as conn:
+        archived = archive.manifest(conn, manager.table_name)
+
+    def without_archived(rows: List[tuple]) -> List[tuple]:
+        """Rows whose import_key is not in the archive file of their period, checked one batch at a time"""
+        keep = [True] * len(rows)
+        for entry in archived:
+            index = [i for i, row in enumerate(rows) if entry['min_date_key'] <= row[4] <= entry['max_date_key']]
+            if not index:
+                continue
+            found = archive.stored_import_keys(
+                os.path.join(archive.archive_dir(manager.db_path), entry['file']), [rows[i][5] for i in index]
+            )
+            for i, stored in zip(index, found):
+                if stored:
+                    keep[i] = False
+        return [row for row, kept in zip(rows, keep) if kept]
+
+    rows = iter_ofx(path) if file_format == 'ofx' else iter_csv(path, mapping, date_format, expense_sign)
+    occurrences: "OrderedDict[tuple, int]" = OrderedDict()
+    report = {'read': 0, 'inserted': 0, 'duplicates': 0, 'skipped': 0, 'errors': []}
+    batch: List[tuple] = []
+
+    def flush() -> None:
+        rows = without_archived(batch) if archived else batch
+        with connections.writer() as conn:
+            # rowcount 不含觸發器對彙總表的變更，被 IGNORE 的重複列也不計入
+            inserted = conn.executemany(sql, rows).rowcount
+        report['inserted'] += inserted
+        report['duplicates'] += len(batch) - inserted
+        batch.clear()
+
+    started = time.perf_counter()
+    for row in rows:
+        report['read'] += 1
+        if 'error' in row:
+            report['skipped'] += 1
+            if len(report['errors']) < 10:
+                report['errors'].append(row['error'])
+            continue
+        amount = abs(row['signed_amount'])
+        if not row['item'] or amount == 0:
+            report['skipped'] += 1
+            continue
+
+        identity = (row['date'], round(row['signed_amount'], 2), row['item'].lower())
+        occurrence = occurrences.pop(identity, 0) + 1
+        occurrences[identity] = occurrence
+        if len(occurrences) > MAX_OCCURRENCE_KEYS:
+            occurrences.popitem(last=False)
+
+        kind = _transaction_type(row['raw_type'], row['signed_amount'], row['expense_sign'])
+        key, import_key = date_key(row['date']), make_import_key(row, occurrence, source)
+        batch.append((row['item'], amount, row['date'], kind, key, import_key))
+        if len(batch) >= batch_size:
+            flush()
+    if batch:
+        flush()
+
+    elapsed = time.perf_counter() - started
+    report['seconds'] = round(elapsed, 3)
+    report['rows_per_second'] = round(report['read'] / elapsed) if elapsed else None
+    return report
+
+
+def parse_mapping(text: str) -> Dict[str, str]:
+    mapping = {}
+    for pair in (text or '').split(','):
+        if '=' in pair:
+            field, column = pair.split('=', 1)
+            mapping[field.strip()] = column.strip()
+    return mapping
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import a CSV/OFX bank or credit-card statement")
+    parser.add_argument("path")
+    parser.add_argument("--format", choices=["csv", "ofx"], help="file format (detected when omitted)")
+    parser.add_argument("--db", help="database path (default: DATABASE_PATH)")
+    parser.add_argument("--tenant", help="import into this tenant's shard instead (see db/shards.py)")
+    parser.add_argument("--batch-size", type=int, default=5000)
+    parser.add_argument("--map", help='CSV column mapping, e.g. "item=Payee,amount=Value,date=Booked"')
+    parser.add_argument("--date-format", help="strptime format for CSV dates, e.g. %%d/%%m/%%Y")
+    parser.add_argument("--expense-sign", choices=["negative", "positive"], default="negative",
+                        help="sign of expenses in a single amount column (card exports are often positive)")
+    parser.add_argument("--source", help="import key namespace, e.g. the account name")
+    args = parser.parse_args()
+
+    report = import_statement(
+        args.path,
+        file_format=args.format,
+        db_path=shard_path(args.tenant) if args.tenant else args.db,
+        batch_size=args.batch_size,
+        mapping=parse_mapping(args.map),
+        date_format=args.date_format,
+        expense_sign=args.expense_sign,
+        source=args.source,
+    )
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+
+if __name__ == '__main__':
+    main()
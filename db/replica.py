@@ -0,0 +1,397 @@
+"""
+Read replica for query traffic.
+
+A ReadReplica keeps a snapshot of a primary database, copied with SQLite's
+online backup API, so long analytical SELECTs from the query tools do not
+share pages and locks with inserts on the primary. Two snapshot buffers are
+used in turn: a refresh copies into the idle buffer and then switches readers
+over. Readers are counted per buffer, and a refresh waits until the last
+query on the old snapshot has finished before overwriting that buffer.
+
+The copy runs inside one read transaction on the primary, PAGES pages per
+step, so it is a consistent snapshot and other connections' writes do not
+make it start over; the primary's writer is never blocked.
+
+Refreshes are triggered by writes: the primary's ConnectionManager notifies
+the replica after each commit, and a watch connection polls PRAGMA
+data_version to catch writes from other processes (e.g. the importer CLI).
+Refreshes run at a bounded rate: at least MIN_INTERVAL apart, and no more
+than MAX_DUTY of the time is spent copying, so writes in between are batched.
+When the oldest write not yet copied is older than MAX_STALENESS,
+get_read_manager() returns the primary instead, so reads are never staler
+than the limit. A database whose copy takes longer than MAX_STALENESS could
+almost never be read from its replica, so the replica is closed and that
+database reads the primary from then on. A conversation also reads the
+primary until the snapshot contains its own last write (see remember_write),
+so "coffee 80" followed by "how much today?" is never stale.
+
+    MODE='file'    snapshots are <db>.replica-0 / <db>.replica-1 next to the primary (default)
+    MODE='memory'  snapshots are shared-cache in-memory databases (two copies in RAM);
+                   databases larger than MAX_MEMORY_BYTES use file snapshots instead
+
+A replica lives as long as its primary's ConnectionManager: closing the
+manager (e.g. ShardRouter evicting a shard) closes the replica, stops its
+thread, closes its reader connections and frees or deletes its snapshots.
+"""
+import itertools
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Optional
+
+try:
+    from db.connection import ConnectionManager, next_write_version
+except ImportError:  # 直接執行 python db/db_init.py 時
+    from connection import ConnectionManager, next_write_version
+from config import DB_SETTING, REPLICA_SETTING
+
+
+logger = logging.getLogger(__name__)
+_ids = itertools.count(1)
+
+
+class ReadReplica:
+    """Double-buffered backup-API snapshot of one primary database"""
+
+    def __init__(self, primary: ConnectionManager, setting: Dict[str, Any] = None):
+        setting = dict(REPLICA_SETTING, **(setting or {}))
+        if setting['MODE'] not in ('memory', 'file'):
+            raise ValueError(f"Unknown replica mode {setting['MODE']!r}, expected 'memory' or 'file'")
+        self.primary = primary
+        self.db_path = primary.db_path
+        self.mode = setting['MODE']
+        if self.mode == 'memory' and _database_bytes(self.db_path) > setting['MAX_MEMORY_BYTES']:
+            self.mode = 'file'
+        self.max_staleness = setting['MAX_STALENESS']
+        self.min_interval = setting['MIN_INTERVAL']
+        self.max_duty = setting['MAX_DUTY']
+        self.pages = setting['PAGES']
+        self.step_sleep = setting['STEP_SLEEP']
+        self.reader_wait = setting['READER_WAIT']
+
+        replica_id = next(_ids)
+        if self.mode == 'memory':
+            self._targets = [f"file:coinchat-replica-{replica_id}-{i}?mode=memory&cache=shared" for i in range(2)]
+        else:
+            self._targets = [f"file:{os.path.abspath(self.db_path)}.replica-{i}" for i in range(2)]
+        # 複製目的地的連線；記憶體模式下它們也讓 shared-cache 資料庫保持存在
+        self._destinations = [self._connect(target) for target in self._targets]
+
+        self._lock = threading.Lock()
+        # 每份緩衝上進行中的查詢數歸零時通知
+        self._idle = threading.Condition(self._lock)
+        self._refresh_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._closed = False
+        self._local = threading.local()
+        self._readers = set()
+        self._active = [0, 0]
+        self._current = None
+        self._generation = 0
+        self._dirty_since: Optional[float] = None
+        self.write_version = None
+        self.refreshed_at = 0.0
+        self.last_refresh_seconds = 0.0
+        self.stats = {
+            'refreshes': 0, 'refresh_seconds': 0.0, 'last_refresh_ms': None, 'max_refresh_ms': 0.0,
+            'reads': 0, 'stale_fallbacks': 0, 'own_write_fallbacks': 0, 'reader_waits': 0, 'errors': 0,
+        }
+
+        self.refresh()
+        self._watch = primary.open_connection(readonly=True)
+        self._data_version = self._read_data_version()
+        primary.add_listener(self._on_primary_event)
+        self._thread = threading.Thread(target=self._run, name=f"coinchat-replica-{replica_id}", daemon=True)
+        self._thread.start()
+
+    def _connect(self, target: str, readonly: bool = False) -> sqlite3.Connection:
+        conn = sqlite3.connect(target, uri=True, check_same_thread=False,
+                               timeout=DB_SETTING['BUSY_TIMEOUT_MS'] / 1000)
+        conn.row_factory = sqlite3.Row
+        conn.execute(f"PRAGMA cache_size={DB_SETTING['CACHE_SIZE']}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        if readonly:
+            conn.execute("PRAGMA query_only=ON")
+        return conn
+
+    # ---- 讀取端：與 ConnectionManager 相同的介面 ----
+
+    @contextmanager
+    def reader(self) -> Iterator[sqlite3.Connection]:
+        """Yield this thread's read-only connection to the current snapshot"""
+        with self._lock:
+            closed = self._closed
+            if not closed:
+                index, generation = self._current, self._generation
+                self._active[index] += 1
+                self.stats['reads'] += 1
+        if closed:
+            # 取得副本後主資料庫才被關閉（例如分片被逐出）時，改讀主資料庫
+            with self.primary.reader() as conn:
+                yield conn
+            return
+        try:
+            local = self._local
+            if getattr(local, 'generation', None) != generation:
+                conn = self._connect(self._targets[index], readonly=True)
+                with self._lock:
+                    old = getattr(local, 'conn', None)
+                    self._readers.discard(old)
+                    self._readers.add(conn)
+                if old is not None:
+                    old.close()
+                local.conn, local.generation = conn, generation
+            yield local.conn
+        finally:
+            with self._lock:
+                self._active[index] -= 1
+                if not self._active[index]:
+                    self._idle.notify_all()
+
+    def open_connection(self, readonly: bool = False) -> sqlite3.Connection:
+        # 分頁 cursor 可能開很久，放在快照上會讓之後的刷新一直等待，因此改開在主資料庫
+        return self.primary.open_connection(readonly=readonly)
+
+    # ---- 刷新 ----
+
+    def lag(self) -> float:
+        """Seconds since the oldest write that the snapshot does not contain yet"""
+        with self._lock:
+            dirty_since = self._dirty_since
+        return 0.0 if dirty_since is None else time.monotonic() - dirty_since
+
+    def is_fresh(self) -> bool:
+        return not self._closed and self.lag() <= self.max_staleness
+
+    def too_slow(self) -> bool:
+        """A copy takes longer than MAX_STALENESS, so after any write the replica cannot be fresh"""
+        return self.last_refresh_seconds > self.max_staleness
+
+    def refresh(self) -> None:
+        """Copy the primary into the idle buffer and switch readers to it"""
+        with self._refresh_lock:
+            if self._closed:
+                return
+            started = time.perf_counter()
+            with self._lock:
+                target = 0 if self._current is None else 1 - self._current
+                # 等讀取這份舊快照的查詢結束才覆寫；新的查詢只會讀目前的快照
+                if self._active[target]:
+                    self.stats['reader_waits'] += 1
+                    if not self._idle.wait_for(lambda: not self._active[target], timeout=self.reader_wait):
+                        raise TimeoutError(f"Queries on the old snapshot of {self.db_path} did not finish")
+                # 複製期間的寫入會再設定 _dirty_since，觸發下一次刷新
+                self._dirty_since = None
+                # 快照自己的版本：大於複製開始前所有寫入的版本，其他行程的寫入也會讓查詢快取失效
+                version = next_write_version()
+            source = self.primary.open_connection(readonly=True)
+            try:
+                # 整個複製在同一個讀取交易中：分段複製時其他連線的寫入不會讓 backup 從頭開始，快照也一致
+                source.execute("BEGIN")
+                source.execute("SELECT 1 FROM sqlite_master LIMIT 1").fetchall()
+                source.backup(self._destinations[target], pages=self.pages, sleep=self.step_sleep)
+            finally:
+                source.close()
+            elapsed = time.perf_counter() - started
+            with self._lock:
+                self._current = target
+                self._generation += 1
+                self.write_version = version
+                self.refreshed_at = time.monotonic()
+                self.last_refresh_seconds = elapsed
+                self.stats['refreshes'] += 1
+                self.stats['refresh_seconds'] += elapsed
+                self.stats['last_refresh_ms'] = round(elapsed * 1000, 3)
+                self.stats['max_refresh_ms'] = max(self.stats['max_refresh_ms'], round(elapsed * 1000, 3))
+
+    def _mark_dirty(self) -> None:
+        with self._lock:
+            if self._dirty_since is None:
+                self._dirty_since = time.monotonic()
+        self._wake.set()
+
+    def _on_primary_event(self, event: str) -> None:
+        if event == 'write':
+            self._mark_dirty()
+        elif event == 'close':
+            self.close()
+
+    def _read_data_version(self) -> int:
+        return self._watch.execute("PRAGMA data_version").fetchone()[0]
+
+    def _next_refresh_wait(self) -> float:
+        # 至少間隔 MIN_INTERVAL，且刷新耗時不超過總時間的 MAX_DUTY
+        gap = max(self.min_interval, self.last_refresh_seconds * (1 / self.max_duty - 1))
+        return gap - (time.monotonic() - self.refreshed_at)
+
+    def _run(self) -> None:
+        # 沒有寫入通知時，定期檢查 data_version 以發現其他行程的寫入
+        poll = max(0.05, min(self.max_staleness / 2, 1.0))
+        while not self._closed:
+            self._wake.wait(timeout=poll)
+            self._wake.clear()
+            if self._closed:
+                break
+            try:
+                data_version = self._read_data_version()
+                if data_version != self._data_version:
+                    self._data_version = data_version
+                    self._mark_dirty()
+                if self.lag() == 0.0:
+                    continue
+                wait = self._next_refresh_wait()
+                if wait > 0 and self._wake.wait(timeout=wait):
+                    # 等待期間被喚醒（新的寫入或關閉），寫入已記錄，繼續等到間隔滿
+                    self._wake.clear()
+                    while not self._closed and self._next_refresh_wait() > 0:
+                        time.sleep(min(self._next_refresh_wait(), poll))
+                if not self._closed:
+                    self.refresh()
+                    self._data_version = self._read_data_version()
+            except Exception:
+                with self._lock:
+                    self.stats['errors'] += 1
+                if self._closed:
+                    break
+                logger.exception("Refreshing the read replica of %s failed", self.db_path)
+                time.sleep(poll)
+
+    def close(self) -> None:
+        """Stop refreshing, close every connection and free (memory) or delete (file) the snapshots"""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            # 等進行中的查詢結束再關閉它們的連線
+            self._idle.wait_for(lambda: not any(self._active), timeout=self.reader_wait)
+            readers, self._readers = self._readers, set()
+        self._wake.set()
+        _forget(self)
+        thread = getattr(self, '_thread', None)
+        if thread is not None and thread is not threading.current_thread():
+            thread.join(timeout=self.reader_wait)
+        with self._refresh_lock:
+            for conn in list(readers) + self._destinations + [getattr(self, '_watch', None)]:
+                if conn is not None:
+                    conn.close()
+        if self.mode == 'file':
+            for target in self._targets:
+                path = target[len("file:"):]
+                for suffix in ('', '-journal', '-wal', '-shm'):
+                    try:
+                        os.remove(path + suffix)
+                    except FileNotFoundError:
+                        pass
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self.stats)
+            stats['snapshot_version'] = self.write_version
+        stats['mode'] = self.mode
+        stats['primary_version'] = self.primary.write_version
+        stats['lag_seconds'] = round(self.lag(), 3)
+        stats['fresh'] = self.is_fresh()
+        stats['refresh_seconds'] = round(stats['refresh_seconds'], 4)
+        if stats['refreshes']:
+            stats['mean_refresh_ms'] = round(stats['refresh_seconds'] * 1000 / stats['refreshes'], 3)
+        return stats
+
+
+def _database_bytes(db_path: str) -> int:
+    size = 0
+    for suffix in ('', '-wal'):
+        try:
+            size += os.path.getsize(db_path + suffix)
+        except OSError:
+            pass
+    return size
+
+
+_replicas: Dict[int, ReadReplica] = {}
+_replicas_lock = threading.Lock()
+# 複製太慢而停用副本的資料庫 -> 原因
+_disabled: Dict[str, str] = {}
+# 正在建立副本的主資料庫（id(manager)）
+_building = set()
+# (db_path, session) -> 該對話最後一次寫入後的 write_version
+_session_writes: "OrderedDict[tuple, int]" = OrderedDict()
+_MAX_SESSIONS = 10000
+
+
+def remember_write(manager: ConnectionManager, session: Optional[str]) -> None:
+    """Record that session just wrote to manager's database, so its next reads see the write"""
+    if not REPLICA_SETTING['ENABLED'] or session is None:
+        return
+    key = (manager.db_path, session)
+    with _replicas_lock:
+        _session_writes.pop(key, None)
+        _session_writes[key] = manager.write_version
+        while len(_session_writes) > _MAX_SESSIONS:
+            _session_writes.popitem(last=False)
+
+
+def _forget(replica: ReadReplica) -> None:
+    with _replicas_lock:
+        for key in [k for k, r in _replicas.items() if r is replica]:
+            del _replicas[key]
+
+
+def get_read_manager(manager: ConnectionManager, session: Optional[str] = None):
+    """Where query tools should read: a fresh replica of manager's database, or manager itself"""
+    if not REPLICA_SETTING['ENABLED']:
+        return manager
+    key = id(manager)
+    with _replicas_lock:
+        if manager.db_path in _disabled:
+            return manager
+        replica = _replicas.get(key)
+        if replica is not None and replica.primary is not manager:
+            replica = None
+        if replica is None:
+            if key in _building:
+                # 另一個呼叫正在建立這個副本，建好前先讀主資料庫
+                return manager
+            _building.add(key)
+        own_write = _session_writes.get((manager.db_path, session)) if session is not None else None
+    if replica is None:
+        # 第一次建立時同步複製一次，之後由背景執行緒刷新；主資料庫關閉時副本會自行移除。
+        # 複製不持有 _replicas_lock，大資料庫的第一次複製不會擋住其他租戶
+        try:
+            replica = ReadReplica(manager)
+        finally:
+            with _replicas_lock:
+                _building.discard(key)
+        with _replicas_lock:
+            _replicas[key] = replica
+    if replica.too_slow():
+        # 複製一次就超過容許的落後秒數，副本幾乎永遠不夠新，只是額外負擔
+        with _replicas_lock:
+            _disabled[manager.db_path] = (f"refresh took {replica.last_refresh_seconds * 1000:.1f} ms, "
+                                          f"more than MAX_STALENESS {replica.max_staleness}s")
+        logger.warning("Read replica of %s disabled: %s", manager.db_path, _disabled[manager.db_path])
+        replica.close()
+        return manager
+    if not replica.is_fresh():
+        fallback = 'stale_fallbacks'
+    elif own_write is not None and own_write > (replica.write_version or 0):
+        # write_version 全域遞增，快照版本較舊就表示還沒有這個對話的寫入
+        fallback = 'own_write_fallbacks'
+    else:
+        return replica
+    with replica._lock:
+        replica.stats[fallback] += 1
+    return manager
+
+
+def get_replica_stats() -> Dict[str, Any]:
+    """Stats of every open replica, keyed by its primary database path"""
+    with _replicas_lock:
+        replicas = [r for r in _replicas.values() if not r._closed]
+        disabled = dict(_disabled)
+    stats = {replica.db_path: replica.get_stats() for replica in replicas}
+    stats.update({db_path: {'disabled': reason} for db_path, reason in disabled.items()})
+    return stats
@@ -0,0 +1,103 @@
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import List
+
+from config import DB_SETTING
+
+
+class ResultHandle:
+    """An open cursor over a large result set that the agent pages through"""
+
+    def __init__(self, conn: sqlite3.Connection, cursor: sqlite3.Cursor, row_count: int, owner: str = None):
+        self.id = uuid.uuid4().hex[:12]
+        # 開啟此 cursor 的租戶；其他租戶拿到 handle 也無法翻閱
+        self.owner = owner
+        self.conn = conn
+        self.cursor = cursor
+        self.columns = [col[0] for col in cursor.description]
+        self.row_count = row_count
+        self.fetched = 0
+        self.last_used = time.monotonic()
+        self.lock = threading.Lock()
+
+    def fetch(self, n: int) -> List[tuple]:
+        """The next n rows, values in column order"""
+        with self.lock:
+            rows = self.cursor.fetchmany(n)
+            self.fetched += len(rows)
+            self.last_used = time.monotonic()
+        return [tuple(row) for row in rows]
+
+    @property
+    def exhausted(self) -> bool:
+        return self.fetched >= self.row_count
+
+    def close(self) -> None:
+        with self.lock:
+            try:
+                self.conn.close()
+            except sqlite3.Error:
+                pass
+
+
+class ResultHandleStore:
+    """Bounded LRU of open result cursors with idle expiry.
+
+    Each handle owns its own connection so it can be paged from any thread.
+    Handles are closed when exhausted, when idle longer than the TTL, or when
+    the store is full, which also releases the WAL read snapshot they hold.
+    A handle is only returned to the owner (tenant) that opened it.
+    """
+
+    def __init__(self, max_handles: int = None, ttl: float = None):
+        self.max_handles = max_handles or DB_SETTING['MAX_RESULT_HANDLES']
+        self.ttl = ttl or DB_SETTING['RESULT_HANDLE_TTL']
+        self._handles: "OrderedDict[str, ResultHandle]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def open(self, conn: sqlite3.Connection, sql: str, row_count: int, owner: str = None) -> ResultHandle:
+        handle = ResultHandle(conn, conn.execute(sql), row_count, owner)
+        evicted = []
+        with self._lock:
+            evicted.extend(self._expire())
+            self._handles[handle.id] = handle
+            while len(self._handles) > self.max_handles:
+                evicted.append(self._handles.popitem(last=False)[1])
+        for old in evicted:
+            old.close()
+        return handle
+
+    def get(self, handle_id: str, owner: str = None) -> ResultHandle:
+        with self._lock:
+            evicted = self._expire()
+            handle = self._handles.get(handle_id)
+            if handle is not None and handle.owner != owner:
+                handle = None
+            if handle is not None:
+                self._handles.move_to_end(handle_id)
+        for old in evicted:
+            old.close()
+        return handle
+
+    def release(self, handle_id: str, owner: str = None) -> None:
+        with self._lock:
+            handle = self._handles.get(handle_id)
+            if handle is None or handle.owner != owner:
+                return
+            del self._handles[handle_id]
+        if handle is not None:
+            handle.close()
+
+    def _expire(self) -> List[ResultHandle]:
+        now = time.monotonic()
+        expired = [h for h in self._handles.values() if now - h.last_used > self.ttl]
+        for handle in expired:
+            del self._handles[handle.id]
+        return expired
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._handles)
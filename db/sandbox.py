@@ -0,0 +1,190 @@
+"""
+Guards for running model-written SQL.
+
+Queries run on query_only connections, so writes fail. Before a query runs,
+its EXPLAIN QUERY PLAN is checked: a full scan of a large table is rejected
+unless the query can stop early (a LIMIT without sorting or aggregation). While it runs, a progress handler aborts it once the
+time budget is spent. Rejections are returned as QueryRejected, whose
+to_dict() tells the model why and what cheaper query to try instead.
+"""
+import re
+import sqlite3
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional
+
+try:
+    from db.connection import DB_SETTING
+except ImportError:  # 直接執行 python db/db_init.py 時
+    from connection import DB_SETTING
+
+# SQLite 3.36 以前的查詢計畫寫成 "SCAN TABLE t"，之後是 "SCAN t"
+_SCAN = re.compile(r"^SCAN (?:TABLE )?(\w+)(.*)$")
+_TABLE_REF = re.compile(r"\b(?:from|join)\s+([A-Za-z_]\w*)(?:\s+(?:as\s+)?([A-Za-z_]\w*))?", re.I)
+_NOT_ALIAS = {
+    'where', 'join', 'inner', 'left', 'right', 'full', 'cross', 'natural', 'on', 'using', 'group', 'order',
+    'limit', 'having', 'union', 'except', 'intersect', 'window', 'as',
+}
+_AGGREGATE = re.compile(r"\b(?:sum|count|avg|min|max|total|group_concat)\s*\(|\bgroup\s+by\b|\bdistinct\b", re.I)
+_LIMIT = re.compile(r"\blimit\s+\d+", re.I)
+_READ_STATEMENT = re.compile(r"^\s*(?:select|with|values)\b", re.I)
+_PROGRESS_STEPS = 1000
+# 字串、帶引號的識別字與註解（未結束的字串或註解延伸到結尾）
+_LEXEMES = re.compile(r"'(?:[^']|'')*(?:'|$)|\"(?:[^\"]|\"\")*(?:\"|$)|`[^`]*(?:`|$)|\[[^\]]*(?:\]|$)|--[^\n]*|/\*.*?(?:\*/|$)", re.S)
+_MUTATION = re.compile(r"^\s*(?:with\b.*)?\b(update|delete)\b", re.I | re.S)
+
+
+class QueryRejected(Exception):
+    """A query that was refused or aborted, with a reason the model can act on"""
+
+    def __init__(self, reason: str, message: str, hint: str = None, **details: Any):
+        super().__init__(message)
+        self.reason = reason
+        self.message = message
+        self.hint = hint
+        self.details = details
+
+    def to_dict(self) -> Dict[str, Any]:
+        result = {"status": "rejected", "reason": self.reason, "message": self.message}
+        if self.hint:
+            result["hint"] = self.hint
+        result.update(self.details)
+        return result
+
+
+def mask_sql(sql: str) -> str:
+    """sql with comments blanked and the insides of literals and quoted identifiers replaced by 'x'.
+
+    The result has the same length as sql, so positions found in it can be
+    used to slice the original; keyword searches on it are not fooled by a
+    WHERE inside a string or a comment.
+    """
+    def blank(match: re.Match) -> str:
+        token = match.group(0)
+        if token.startswith(('--', '/*')):
+            return ' ' * len(token)
+        return token[0] + 'x' * max(0, len(token) - 2) + (token[-1] if len(token) > 1 else '')
+    return _LEXEMES.sub(blank, sql)
+
+
+def top_level(masked: str) -> str:
+    """masked SQL with everything inside parentheses blanked (subqueries, function arguments)"""
+    depth, chars = 0, []
+    for char in masked:
+        if char == '(':
+            depth += 1
+        chars.append(char if depth == 0 else ' ')
+        if char == ')' and depth:
+            depth -= 1
+    return ''.join(chars)
+
+
+def unbounded_mutation(sql: str) -> Optional[str]:
+    """Why sql must not run on the writer (an incomplete statement, or UPDATE/DELETE without a WHERE), or None"""
+    statement = sql.rstrip()
+    if not sqlite3.complete_statement(statement if statement.endswith(';') else statement + ';'):
+        # 結尾的註解或未結束的字串會吞掉分號
+        return "the statement is incomplete (unterminated string or trailing comment)"
+    masked = top_level(mask_sql(sql))
+    match = _MUTATION.match(masked)
+    if match and not re.search(r"\bwhere\b", masked[match.end():], re.I):
+        return f"{match.group(1).upper()} without a WHERE clause is not allowed"
+    return None
+
+
+def table_aliases(sql: str) -> Dict[str, str]:
+    """Map each alias (and table name) in FROM/JOIN clauses to its table"""
+    aliases = {}
+    for table, alias in _TABLE_REF.findall(sql):
+        aliases[table.lower()] = table.lower()
+        if alias and alias.lower() not in _NOT_ALIAS:
+            aliases[alias.lower()] = table.lower()
+    return aliases
+
+
+def estimate_rows(conn: sqlite3.Connection, table: str) -> int:
+    """Cheap row estimate: MAX(rowid) is an index lookup, unlike COUNT(*)"""
+    try:
+        row = conn.execute(f'SELECT MAX(rowid) FROM "{table}"').fetchone()
+    except sqlite3.Error:
+        return 0
+    return row[0] or 0
+
+
+def check_plan(conn: sqlite3.Connection, sql: str, large_table_rows: int = None) -> List[str]:
+    """Reject writes and full scans of large tables; return the plan lines otherwise"""
+    # 真正的保護是 query_only 連線，這裡只是提早給出清楚的原因
+    if not _READ_STATEMENT.match(sql):
+        raise _read_only_rejection()
+    large_table_rows = large_table_rows or DB_SETTING['LARGE_TABLE_ROWS']
+    try:
+        plan = [row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}")]
+    except sqlite3.Error as e:
+        raise QueryRejected("invalid", f"The query could not be planned: {e}", "Fix the SQL syntax and try again.")
+
+    # 有 LIMIT 且不需排序或彙總時，掃描會在取得足夠列數後停止
+    stops_early = bool(_LIMIT.search(sql)) and not _AGGREGATE.search(sql) and not any("TEMP B-TREE" in p for p in plan)
+    aliases = table_aliases(sql)
+    scanned = []
+    for line in plan:
+        match = _SCAN.match(line)
+        if not match or match.group(1) == "CONSTANT":
+            continue
+        table = aliases.get(match.group(1).lower(), match.group(1).lower())
+        rows = estimate_rows(conn, table)
+        if rows >= large_table_rows:
+            scanned.append({"table": table, "estimated_rows": rows, "plan": line})
+
+    if len(scanned) > 1:
+        raise QueryRejected(
+            "cross_scan",
+            f"The query scans {len(scanned)} large tables in full, which is a cross join over millions of row pairs.",
+            "Join on an indexed column (e.g. id) and filter by a date range, or use summarize_transactions for totals.",
+            scans=scanned, plan=plan,
+        )
+    if scanned and not stops_early:
+        scan = scanned[0]
+        raise QueryRejected(
+            "full_scan",
+            f"The query reads all ~{scan['estimated_rows']} rows of {scan['table']}.",
+            "For totals by period, type or item use the summarize_transactions tool (or the rollup tables). "
+            "Otherwise add a date range filter (date_key BETWEEN 20240101 AND 20240131) so an index is used, "
+            "or add a LIMIT without ORDER BY on unindexed columns.",
+            scans=scanned, plan=plan,
+        )
+    return plan
+
+
+@contextmanager
+def time_budget(conn: sqlite3.Connection, milliseconds: float = None) -> Iterator[float]:
+    """Abort statements on conn that run longer than the budget; yields the deadline (time.perf_counter())"""
+    milliseconds = milliseconds or DB_SETTING['QUERY_TIMEOUT_MS']
+    deadline = time.perf_counter() + milliseconds / 1000
+    conn.set_progress_handler(lambda: 1 if time.perf_counter() > deadline else 0, _PROGRESS_STEPS)
+    try:
+        yield deadline
+    except sqlite3.OperationalError as e:
+        if "interrupted" in str(e):
+            raise QueryRejected(
+                "timeout",
+                f"The query was stopped after {milliseconds:.0f} ms.",
+                "Narrow the date range, aggregate with GROUP BY, or use summarize_transactions.",
+            ) from None
+        raise
+    finally:
+        conn.set_progress_handler(None, _PROGRESS_STEPS)
+
+
+def _read_only_rejection() -> QueryRejected:
+    return QueryRejected(
+        "read_only",
+        "execute_sql only runs read-only queries.",
+        "Transactions are added by the intent checker with record_transactions; do not modify data here.",
+    )
+
+
+def read_only_error(error: Exception) -> Optional[QueryRejected]:
+    """Translate SQLite's query_only error into a rejection"""
+    if isinstance(error, sqlite3.OperationalError) and "readonly" in str(error).replace(" ", "").lower():
+        return _read_only_rejection()
+    return None
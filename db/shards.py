@@ -0,0 +1,173 @@
+"""
+Per-tenant ledger shards.
+
+With sharding on, every tenant (a user_id, or a thread_id for per-conversation
+ledgers) has its own SQLite file under SHARD_SETTING['DIR'], so one tenant's
+writes never wait on another's writer lock and scans only see that tenant's
+rows. ShardRouter leases tenants their ConnectionManager, applies pending
+migrations the first time a shard is opened in this process, and closes
+managers that are idle or beyond the MAX_OPEN most recently used ones.
+A leased shard is never closed under its users: eviction of a shard that is
+still leased is deferred until the last lease is released, so one shard file
+never has two managers (two writers) at once.
+
+Tenant ids become file names: ids made of letters, digits, '-' and '_' are
+used as-is, anything else is replaced by a hash so ids cannot escape DIR.
+"""
+import hashlib
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional
+
+try:
+    from db.connection import ConnectionManager, close_connection_manager, get_connection_manager
+except ImportError:  # 直接執行 python db/db_init.py 時
+    from connection import ConnectionManager, close_connection_manager, get_connection_manager
+from config import SHARD_SETTING
+
+
+_SAFE_TENANT = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+
+def shard_path(tenant: str, directory: str = None) -> str:
+    """Database file of a tenant's shard"""
+    tenant = str(tenant)
+    name = tenant if _SAFE_TENANT.match(tenant) else "t-" + hashlib.sha256(tenant.encode('utf-8')).hexdigest()[:24]
+    return os.path.join(directory or SHARD_SETTING['DIR'], f"{name}.db")
+
+
+def list_shards(directory: str = None) -> List[Dict[str, Any]]:
+    """Shard files on disk with their size (the WAL included)"""
+    directory = directory or SHARD_SETTING['DIR']
+    if not os.path.isdir(directory):
+        return []
+    shards = []
+    for name in sorted(os.listdir(directory)):
+        if not name.endswith('.db'):
+            continue
+        path = os.path.join(directory, name)
+        size = sum(os.path.getsize(path + suffix) for suffix in ('', '-wal') if os.path.exists(path + suffix))
+        shards.append({'shard': name[:-3], 'db_path': path, 'bytes': size})
+    return shards
+
+
+class ShardRouter:
+    """LRU of open tenant shards with idle eviction"""
+
+    def __init__(self, directory: str = None, max_open: int = None, idle_seconds: float = None):
+        self.directory = directory or SHARD_SETTING['DIR']
+        self.max_open = max_open or SHARD_SETTING['MAX_OPEN']
+        self.idle_seconds = idle_seconds if idle_seconds is not None else SHARD_SETTING['IDLE_SECONDS']
+        # tenant -> (db_path, 最後使用時間)，依使用順序排列，最久未用的在前
+        self._open: "OrderedDict[str, tuple]" = OrderedDict()
+        self._migrated = set()
+        # db_path -> 使用中的租約數；被逐出但仍有租約的分片等最後一個租約結束才關閉
+        self._leases: Dict[str, int] = {}
+        self._deferred = set()
+        # 正在關閉的分片，關閉完成前不再借出
+        self._closing = set()
+        self._lock = threading.Lock()
+        self._closed = threading.Condition(self._lock)
+        self.stats = {'hits': 0, 'opened': 0, 'migrated': 0, 'evicted_idle': 0, 'evicted_lru': 0,
+                      'eviction_deferred': 0}
+
+    @contextmanager
+    def lease(self, tenant: Optional[str]) -> Iterator[ConnectionManager]:
+        """ConnectionManager of the tenant's shard (of DATABASE_PATH for tenant None), kept open until the block exits"""
+        if tenant is None:
+            yield get_connection_manager()
+            return
+        now = time.monotonic()
+        with self._lock:
+            path = self._open[tenant][0] if tenant in self._open else shard_path(tenant, self.directory)
+            # 同一分片正在關閉時等它關完，再開啟新的管理器
+            self._closed.wait_for(lambda: path not in self._closing)
+            entry = self._open.pop(tenant, None)
+            self._open[tenant] = (path, now)
+            self._leases[path] = self._leases.get(path, 0) + 1
+            self._deferred.discard(path)
+            self.stats['hits' if entry else 'opened'] += 1
+            evicted = self._evict(now)
+            migrated = path in self._migrated
+        try:
+            self._close(evicted)
+            if not migrated:
+                self._migrate(path)
+            yield get_connection_manager(path)
+        finally:
+            with self._lock:
+                self._leases[path] -= 1
+                evicted = []
+                if not self._leases[path]:
+                    del self._leases[path]
+                    if path in self._deferred:
+                        self._deferred.discard(path)
+                        self._closing.add(path)
+                        evicted.append(path)
+            self._close(evicted)
+
+    def _evict(self, now: float) -> List[str]:
+        """Drop idle and least recently used shards; the caller closes the returned paths with _close"""
+        evicted = []
+        while self._open:
+            tenant, (path, used) = next(iter(self._open.items()))
+            if len(self._open) > self.max_open:
+                self.stats['evicted_lru'] += 1
+            elif now - used > self.idle_seconds:
+                self.stats['evicted_idle'] += 1
+            else:
+                break
+            del self._open[tenant]
+            if self._leases.get(path):
+                # 仍有工具呼叫在使用，由最後一個租約關閉
+                self._deferred.add(path)
+                self.stats['eviction_deferred'] += 1
+            else:
+                self._closing.add(path)
+                evicted.append(path)
+        return evicted
+
+    def _close(self, paths: List[str]) -> None:
+        for path in paths:
+            try:
+                close_connection_manager(path)
+            finally:
+                with self._lock:
+                    self._closing.discard(path)
+                    self._closed.notify_all()
+
+    def _migrate(self, path: str) -> None:
+        try:
+            from db.db_init import DatabaseManager
+        except ImportError:
+            from db_init import DatabaseManager
+        # migrate() 在寫入連線的交易中檢查版本，兩個執行緒同時開啟同一分片也只會套用一次
+        if DatabaseManager(path).migrate():
+            self._count('migrated')
+        with self._lock:
+            self._migrated.add(path)
+
+    def _count(self, key: str) -> None:
+        with self._lock:
+            self.stats[key] += 1
+
+    def close_idle(self) -> int:
+        """Close shards idle longer than idle_seconds; returns how many were closed"""
+        with self._lock:
+            evicted = self._evict(time.monotonic())
+        self._close(evicted)
+        return len(evicted)
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self.stats)
+            stats['open'] = len(self._open)
+            stats['leased'] = len(self._leases)
+        return stats
+
+
+shard_router = ShardRouter()
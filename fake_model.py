@@ -0,0 +1,207 @@
+"""
+Local stand-in for ChatGoogleGenerativeAI.
+
+FakeChatModel never leaves the process. It answers with simple rules: route
+queries to the query agent, record "item amount" messages and run a fixed
+summary SQL. Set MODEL_PROVIDER=fake to use it for load tests without Gemini.
+With error_rate set it also fails a share of calls with RateLimitError, a
+stand-in for the provider's HTTP 429, so retries can be exercised offline.
+
+ScriptedChatModel replays a fixed list of responses instead, so a benchmark
+can drive the graph through an exact sequence of tool calls and handoffs
+(MODEL_PROVIDER=scripted).
+"""
+import asyncio
+import random
+import threading
+import time
+import uuid
+from collections import deque
+from typing import Any, Dict, Iterable, List, Optional, Union
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, ToolMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+from langchain_core.utils.function_calling import convert_to_openai_tool
+
+from router import is_query, parse_transactions
+
+SUMMARY_SQL = (
+    "SELECT transaction_type, SUM(total) AS total, SUM(count) AS count "
+    "FROM transactions_monthly GROUP BY transaction_type"
+)
+
+
+def _tool_call(name: str, args: dict) -> AIMessage:
+    return AIMessage(
+        content="",
+        tool_calls=[{"name": name, "args": args, "id": f"call_{uuid.uuid4().hex[:12]}"}],
+    )
+
+
+class RateLimitError(Exception):
+    """Simulated HTTP 429 from the fake model"""
+
+    status_code = 429
+
+    def __init__(self, message: str = "429 Resource has been exhausted (simulated)", retry_after: float = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class FakeChatModel(BaseChatModel):
+    """Rule-based chat model with configurable latency, 429 rate and tool calling"""
+
+    latency: float = 0.0
+    error_rate: float = 0.0
+    tool_names: List[str] = []
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-chat"
+
+    def bind_tools(self, tools, **kwargs: Any) -> "FakeChatModel":
+        names = [convert_to_openai_tool(t)["function"]["name"] for t in tools]
+        return self.model_copy(update={"tool_names": names})
+
+    def respond(self, messages: List[BaseMessage]) -> AIMessage:
+        last = messages[-1]
+        tools = set(self.tool_names)
+
+        if isinstance(last, ToolMessage):
+            if last.name and last.name.startswith("transfer_to_") and "execute_sql" in tools:
+                return _tool_call("execute_sql", {"sql": SUMMARY_SQL})
+            content = last.content if isinstance(last.content, str) else str(last.content)
+            return AIMessage(content=f"(fake) {content[:200]}")
+
+        text = last.content if isinstance(last.content, str) else ""
+        if isinstance(last, HumanMessage) and "transfer_to_query_agent" in tools:
+            if is_query(text):
+                return _tool_call("transfer_to_query_agent", {})
+            transactions = parse_transactions(text)
+            if transactions and "record_transactions" in tools:
+                return _tool_call("record_transactions", {"items": transactions})
+            return AIMessage(content="(fake) Are you looking to record a transaction or query transaction records?")
+        if isinstance(last, HumanMessage) and "execute_sql" in tools:
+            return _tool_call("execute_sql", {"sql": SUMMARY_SQL})
+        return AIMessage(content=f"(fake) {text[:200]}")
+
+    def _generate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager=None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        if self.latency:
+            time.sleep(self.latency)
+        self.maybe_fail()
+        return ChatResult(generations=[ChatGeneration(message=self.respond(messages))])
+
+    async def _agenerate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager=None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        self.maybe_fail()
+        return ChatResult(generations=[ChatGeneration(message=self.respond(messages))])
+
+    def maybe_fail(self) -> None:
+        if self.error_rate and random.random() < self.error_rate:
+            raise RateLimitError()
+
+
+class ModelScript:
+    """Queue of responses shared by a ScriptedChatModel and its bound copies"""
+
+    def __init__(self, fallback: str = "(scripted) summary"):
+        self.fallback = fallback
+        self._responses = deque()
+        self._lock = threading.Lock()
+        self.stats = {'calls': 0, 'aux_calls': 0}
+
+    def load(self, responses: Iterable[Union[str, Dict[str, Any], AIMessage]]) -> None:
+        """Queue responses: plain text, {"tool": name, "args": {...}} or a ready AIMessage"""
+        with self._lock:
+            self._responses.extend(responses)
+
+    def remaining(self) -> int:
+        with self._lock:
+            return len(self._responses)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._responses.clear()
+
+    def next(self) -> AIMessage:
+        with self._lock:
+            if not self._responses:
+                raise RuntimeError("ModelScript exhausted: the graph made more model calls than scripted")
+            response = self._responses.popleft()
+            self.stats['calls'] += 1
+        if isinstance(response, AIMessage):
+            return response.model_copy()
+        if isinstance(response, dict):
+            return _tool_call(response["tool"], response.get("args", {}))
+        return AIMessage(content=response)
+
+    def aux(self) -> AIMessage:
+        with self._lock:
+            self.stats['aux_calls'] += 1
+        return AIMessage(content=self.fallback)
+
+
+class ScriptedChatModel(BaseChatModel):
+    """Deterministic chat model that replays a ModelScript.
+
+    Calls from agents (models with bound tools) consume the script in order.
+    Tool-less calls, such as history compaction, get the script's fallback
+    text so long conversations do not need to script them.
+    """
+
+    script: Any = None
+    latency: float = 0.0
+    tool_names: List[str] = []
+
+    def __init__(self, **kwargs: Any):
+        super().__init__(**kwargs)
+        if self.script is None:
+            self.script = ModelScript()
+
+    @property
+    def _llm_type(self) -> str:
+        return "scripted-chat"
+
+    def bind_tools(self, tools, **kwargs: Any) -> "ScriptedChatModel":
+        names = [convert_to_openai_tool(t)["function"]["name"] for t in tools]
+        # model_copy 為淺層複製，綁定工具後仍共用同一份 script
+        return self.model_copy(update={"tool_names": names})
+
+    def respond(self, messages: List[BaseMessage]) -> AIMessage:
+        return self.script.next() if self.tool_names else self.script.aux()
+
+    def _generate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager=None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        if self.latency:
+            time.sleep(self.latency)
+        return ChatResult(generations=[ChatGeneration(message=self.respond(messages))])
+
+    async def _agenerate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager=None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return ChatResult(generations=[ChatGeneration(message=self.respond(messages))])
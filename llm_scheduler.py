@@ -0,0 +1,580 @@
+"""
+Scheduling layer for chat model calls.
+
+Every agent and the history compactor share one model, and through it one
+LLMScheduler. The scheduler puts each call through:
+- a concurrency pool: at most MAX_CONCURRENCY requests are in flight, the
+  rest wait in FIFO order (sync callers on an Event, async callers on a
+  future of their own event loop, so the event loop is never blocked);
+- a token bucket: RATE_PER_MINUTE requests, with bursts up to BURST; a call
+  waits for its token before it takes a slot, so slots are not held idle;
+- retries: rate limits (429) and transient server errors are retried with
+  full-jitter exponential backoff, and the bucket is drained so the other
+  callers slow down too;
+- coalescing: a call identical to one already in flight in the same
+  conversation (same thread_id and user_id, same bound tools, same messages)
+  waits for that call's result instead of sending another.
+
+Streams are scheduled and retried until their first chunk arrives; after
+that an error reaches the caller, because chunks were already shown.
+
+    python llm_scheduler.py --calls 200 --latency 0.05 --error-rate 0.2
+    python llm_scheduler.py --mode threads --concurrency 4 --rate 600 --duplicates 0.5
+"""
+import argparse
+import asyncio
+import copy
+import hashlib
+import json
+import random
+import statistics
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Iterator, List, Optional
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import BaseMessage
+from langchain_core.outputs import ChatResult
+from langchain_core.runnables import RunnableBinding
+from langchain_core.runnables.config import ensure_config
+
+from config import LLM_SCHEDULER_SETTING
+
+_RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504}
+_RETRYABLE_ERRORS = {
+    'ResourceExhausted', 'TooManyRequests', 'RateLimitError', 'ServiceUnavailable',
+    'DeadlineExceeded', 'InternalServerError', 'TimeoutError',
+}
+_RETRYABLE_GRPC_CODES = {'RESOURCE_EXHAUSTED', 'UNAVAILABLE', 'DEADLINE_EXCEEDED'}
+
+
+def _status(error: BaseException) -> Any:
+    """HTTP status (or grpc code name) an SDK exception carries, if any"""
+    response = getattr(error, 'response', None)
+    for status in (getattr(error, 'status_code', None), getattr(error, 'code', None),
+                   getattr(response, 'status_code', None)):
+        if callable(status):
+            # grpc 例外的 code 是方法，回傳 StatusCode enum
+            try:
+                status = getattr(status(), 'name', None)
+            except Exception:
+                status = None
+        if status is not None:
+            return status
+    return None
+
+
+def is_retryable(error: BaseException) -> bool:
+    """Rate limits and transient provider errors, judged by status code or exception type.
+
+    The message text is not used: a prompt or a row that happens to contain
+    "429" must not turn a bad request into retries. Exceptions that wrap the
+    provider's error (raise ... from e) are judged by their cause.
+    """
+    seen = set()
+    while error is not None and id(error) not in seen:
+        seen.add(id(error))
+        status = _status(error)
+        if (isinstance(status, int) and status in _RETRYABLE_STATUS) or status in _RETRYABLE_GRPC_CODES:
+            return True
+        if any(cls.__name__ in _RETRYABLE_ERRORS for cls in type(error).__mro__):
+            return True
+        error = error.__cause__
+    return False
+
+
+class TokenBucket:
+    """Token bucket that hands out reservations: the caller sleeps for the returned delay"""
+
+    def __init__(self, rate_per_second: float, burst: int):
+        self.rate = rate_per_second
+        self.capacity = max(1, burst)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self) -> float:
+        if self.rate <= 0:
+            return 0.0
+        with self._lock:
+            self._refill()
+            # token 可以借成負數：後到的呼叫依序排在更後面的時間點
+            self.tokens -= 1
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def drain(self) -> None:
+        """Spend the saved burst after a 429, so waiting callers pace themselves"""
+        with self._lock:
+            self._refill()
+            self.tokens = min(self.tokens, 0.0)
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+
+class SlotPool:
+    """FIFO semaphore shared by threads and event loops"""
+
+    def __init__(self, size: int):
+        self.size = max(1, size)
+        self.used = 0
+        self._waiters = deque()
+        self._lock = threading.Lock()
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiters)
+
+    def acquire(self) -> None:
+        with self._lock:
+            if self.used < self.size and not self._waiters:
+                self.used += 1
+                return
+            event = threading.Event()
+            self._waiters.append(event)
+        # release() 直接把名額轉交給等待者，used 不變
+        event.wait()
+
+    async def aacquire(self) -> None:
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if self.used < self.size and not self._waiters:
+                self.used += 1
+                return
+            waiter = loop.create_future()
+            self._waiters.append((loop, waiter))
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            with self._lock:
+                queued = (loop, waiter) in self._waiters
+                if queued:
+                    self._waiters.remove((loop, waiter))
+            if not queued:
+                # 名額已經轉交過來，取消時要還回去
+                self.release()
+            raise
+
+    def release(self) -> None:
+        with self._lock:
+            while self._waiters:
+                waiter = self._waiters.popleft()
+                if isinstance(waiter, threading.Event):
+                    waiter.set()
+                    return
+                loop, future = waiter
+                if future.done() or loop.is_closed():
+                    continue
+                loop.call_soon_threadsafe(self._hand_over, future)
+                return
+            self.used -= 1
+
+    def _hand_over(self, future: asyncio.Future) -> None:
+        # 在等待者的 event loop 中執行；它若已被取消，名額交給下一位
+        if future.done():
+            self.release()
+        else:
+            future.set_result(None)
+
+
+class LLMScheduler:
+    """Concurrency pool, token bucket, retries and coalescing for model calls"""
+
+    def __init__(self, setting: Dict[str, Any] = None):
+        setting = dict(LLM_SCHEDULER_SETTING, **(setting or {}))
+        self.max_retries = setting['MAX_RETRIES']
+        self.backoff_base = setting['BACKOFF_BASE']
+        self.backoff_max = setting['BACKOFF_MAX']
+        self.coalesce = setting['COALESCE']
+        self.slots = SlotPool(setting['MAX_CONCURRENCY'])
+        self.bucket = TokenBucket(setting['RATE_PER_MINUTE'] / 60, setting['BURST'])
+        self._inflight: Dict[str, Future] = {}
+        self._waits = deque(maxlen=setting['WAIT_SAMPLES'])
+        self._lock = threading.Lock()
+        self.stats = {
+            'calls': 0, 'completed': 0, 'failed': 0, 'retries': 0, 'coalesced': 0,
+            'rate_limited': 0, 'in_flight': 0, 'max_in_flight': 0, 'max_queue_depth': 0,
+        }
+
+    # ---- 同步 ----
+
+    def run(self, call: Callable[[], Any], key: str = None) -> Any:
+        """Run call() under the scheduler; calls with the same key in flight share one result"""
+        pending, leader = self._join(key)
+        if not leader:
+            return copy.deepcopy(pending.result())
+        try:
+            result = self._attempts(call)
+        except BaseException as error:
+            self._finish(key, pending, error=error)
+            raise
+        self._finish(key, pending, result=result)
+        return result
+
+    def stream(self, open_stream: Callable[[], Iterator[Any]]) -> Iterator[Any]:
+        attempt = 0
+        while True:
+            self._enter()
+            try:
+                iterator = iter(open_stream())
+                try:
+                    first = next(iterator, _DONE)
+                except Exception as error:
+                    delay = self._retry_delay(attempt, error)
+                    if delay is None:
+                        raise
+                else:
+                    if first is not _DONE:
+                        yield first
+                        yield from iterator
+                    self._count('completed')
+                    return
+            finally:
+                self._leave()
+            attempt += 1
+            time.sleep(delay)
+
+    def _attempts(self, call: Callable[[], Any]) -> Any:
+        attempt = 0
+        while True:
+            self._enter()
+            try:
+                result = call()
+            except Exception as error:
+                delay = self._retry_delay(attempt, error)
+                if delay is None:
+                    raise
+            else:
+                self._count('completed')
+                return result
+            finally:
+                self._leave()
+            attempt += 1
+            time.sleep(delay)
+
+    def _enter(self) -> None:
+        started = time.perf_counter()
+        # 先等 token 再取名額：等待速率限制時不佔用並行名額
+        delay = self.bucket.reserve()
+        if delay:
+            self._count('rate_limited')
+            time.sleep(delay)
+        self._queued()
+        self.slots.acquire()
+        self._started(time.perf_counter() - started)
+
+    # ---- 非同步 ----
+
+    async def arun(self, call: Callable[[], Awaitable[Any]], key: str = None) -> Any:
+        pending, leader = self._join(key)
+        if not leader:
+            # shield：等待者被取消時不能連帶取消其他人共用的結果
+            return copy.deepcopy(await asyncio.shield(asyncio.wrap_future(pending)))
+        try:
+            result = await self._aattempts(call)
+        except BaseException as error:
+            self._finish(key, pending, error=error)
+            raise
+        self._finish(key, pending, result=result)
+        return result
+
+    async def astream(self, open_stream: Callable[[], AsyncIterator[Any]]) -> AsyncIterator[Any]:
+        attempt = 0
+        while True:
+            await self._aenter()
+            try:
+                iterator = open_stream().__aiter__()
+                try:
+                    first = await iterator.__anext__()
+                except StopAsyncIteration:
+                    self._count('completed')
+                    return
+                except Exception as error:
+                    delay = self._retry_delay(attempt, error)
+                    if delay is None:
+                        raise
+                else:
+                    yield first
+                    async for chunk in iterator:
+                        yield chunk
+                    self._count('completed')
+                    return
+            finally:
+                self._leave()
+            attempt += 1
+            await asyncio.sleep(delay)
+
+    async def _aattempts(self, call: Callable[[], Awaitable[Any]]) -> Any:
+        attempt = 0
+        while True:
+            await self._aenter()
+            try:
+                result = await call()
+            except Exception as error:
+                delay = self._retry_delay(attempt, error)
+                if delay is None:
+                    raise
+            else:
+                self._count('completed')
+                return result
+            finally:
+                self._leave()
+            attempt += 1
+            await asyncio.sleep(delay)
+
+    async def _aenter(self) -> None:
+        started = time.perf_counter()
+        delay = self.bucket.reserve()
+        if delay:
+            self._count('rate_limited')
+            await asyncio.sleep(delay)
+        self._queued()
+        await self.slots.aacquire()
+        self._started(time.perf_counter() - started)
+
+    # ---- 共用 ----
+
+    def _join(self, key: Optional[str]):
+        """Return (future, is_leader); only the leader sends the request"""
+        with self._lock:
+            self.stats['calls'] += 1
+            if key is None or not self.coalesce:
+                return None, True
+            pending = self._inflight.get(key)
+            if pending is not None:
+                self.stats['coalesced'] += 1
+                return pending, False
+            pending = self._inflight[key] = Future()
+            return pending, True
+
+    def _finish(self, key: Optional[str], pending: Optional[Future], result: Any = None,
+                error: BaseException = None) -> None:
+        if pending is None:
+            return
+        with self._lock:
+            self._inflight.pop(key, None)
+        if error is None:
+            pending.set_result(result)
+        elif isinstance(error, Exception):
+            pending.set_exception(error)
+        else:
+            # leader 被取消（CancelledError 等）不代表請求失敗，等待者改拿到一般例外
+            pending.set_exception(RuntimeError(f"coalesced model call was abandoned: {error!r}"))
+
+    def _retry_delay(self, attempt: int, error: Exception) -> Optional[float]:
+        """Backoff before the next attempt, or None when the error is final"""
+        if attempt >= self.max_retries or not is_retryable(error):
+            self._count('failed')
+            return None
+        self._count('retries')
+        self.bucket.drain()
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        retry_after = getattr(error, 'retry_after', None)
+        if isinstance(retry_after, (int, float)):
+            delay = max(delay, float(retry_after))
+        return delay
+
+    def _count(self, key: str, value: int = 1) -> None:
+        with self._lock:
+            self.stats[key] += value
+
+    def _queued(self) -> None:
+        with self._lock:
+            self.stats['max_queue_depth'] = max(self.stats['max_queue_depth'], self.slots.queued + 1)
+
+    def _started(self, waited: float) -> None:
+        with self._lock:
+            self._waits.append(waited)
+            self.stats['in_flight'] += 1
+            self.stats['max_in_flight'] = max(self.stats['max_in_flight'], self.stats['in_flight'])
+
+    def _leave(self) -> None:
+        with self._lock:
+            self.stats['in_flight'] -= 1
+        self.slots.release()
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Counters plus the current queue depth and wait times (ms) of recent requests"""
+        with self._lock:
+            stats = dict(self.stats)
+            waits = sorted(self._waits)
+        stats['queue_depth'] = self.slots.queued
+        stats['coalescing'] = len(self._inflight)
+        if waits:
+            stats['wait_ms'] = {
+                'p50': round(waits[len(waits) // 2] * 1000, 2),
+                'p95': round(waits[min(len(waits) - 1, int(len(waits) * 0.95))] * 1000, 2),
+                'max': round(waits[-1] * 1000, 2),
+                'mean': round(statistics.mean(waits) * 1000, 2),
+            }
+        return stats
+
+
+_DONE = object()
+
+
+def _message_key(message: BaseMessage) -> List[Any]:
+    # 不含訊息與 tool call 的 id：重送的相同提示也能合併；對話範圍由 coalesce_key 加入
+    calls = [[call['name'], call['args']] for call in getattr(message, 'tool_calls', None) or []]
+    return [message.type, message.content, getattr(message, 'name', None), calls]
+
+
+class ScheduledChatModel(BaseChatModel):
+    """Chat model that sends every call of `inner` through an LLMScheduler"""
+
+    inner: Any
+    scheduler: Any
+
+    @property
+    def _llm_type(self) -> str:
+        return f"scheduled-{self.inner._llm_type}"
+
+    def bind_tools(self, tools, **kwargs: Any) -> "ScheduledChatModel":
+        bound = self.inner.bind_tools(tools, **kwargs)
+        # Gemini 以 bind() 回傳 RunnableBinding，把轉換好的參數留在外層；假模型則回傳新的模型
+        if isinstance(bound, RunnableBinding) and bound.bound is self.inner:
+            return self.bind(**bound.kwargs)
+        if isinstance(bound, BaseChatModel):
+            return self.model_copy(update={'inner': bound})
+        raise TypeError(f"cannot schedule {type(bound).__name__} returned by {type(self.inner).__name__}.bind_tools")
+
+    def coalesce_key(self, messages: List[BaseMessage], stop: Optional[List[str]], kwargs: Dict[str, Any],
+                     run_manager=None) -> Optional[str]:
+        if not self.scheduler.coalesce:
+            return None
+        # 只合併同一對話、同一使用者的呼叫：不同使用者的相同提示各自的工具呼叫讀寫的是各自的帳本。
+        # run config 的 configurable 會複製到 callback metadata；沒有 run_manager 時改讀目前的 config
+        scoped = (run_manager.metadata if run_manager is not None else None) or \
+            ensure_config().get('configurable') or {}
+        scope = [scoped.get('thread_id'), scoped.get('user_id')]
+        payload = json.dumps(
+            [id(self.inner), scope, [_message_key(m) for m in messages], stop, kwargs],
+            ensure_ascii=False, sort_keys=True, default=str,
+        )
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def _should_stream(self, *, async_api: bool, run_manager=None, **kwargs: Any) -> bool:
+        inner = type(self.inner)
+        if inner._stream is BaseChatModel._stream and inner._astream is BaseChatModel._astream:
+            return False
+        return super()._should_stream(async_api=async_api, run_manager=run_manager, **kwargs)
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                  run_manager=None, **kwargs: Any) -> ChatResult:
+        return self.scheduler.run(
+            lambda: self.inner._generate(messages, stop=stop, run_manager=run_manager, **kwargs),
+            key=self.coalesce_key(messages, stop, kwargs, run_manager),
+        )
+
+    async def _agenerate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                         run_manager=None, **kwargs: Any) -> ChatResult:
+        return await self.scheduler.arun(
+            lambda: self.inner._agenerate(messages, stop=stop, run_manager=run_manager, **kwargs),
+            key=self.coalesce_key(messages, stop, kwargs, run_manager),
+        )
+
+    def _stream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                run_manager=None, **kwargs: Any):
+        yield from self.scheduler.stream(
+            lambda: self.inner._stream(messages, stop=stop, run_manager=run_manager, **kwargs)
+        )
+
+    async def _astream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                       run_manager=None, **kwargs: Any):
+        async for chunk in self.scheduler.astream(
+            lambda: self.inner._astream(messages, stop=stop, run_manager=run_manager, **kwargs)
+        ):
+            yield chunk
+
+
+_scheduler: Optional[LLMScheduler] = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler() -> LLMScheduler:
+    """Process-wide scheduler, created from LLM_SCHEDULER_SETTING on first use"""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = LLMScheduler()
+        return _scheduler
+
+
+def get_scheduler_stats() -> Dict[str, Any]:
+    return _scheduler.get_stats() if _scheduler is not None else {}
+
+
+def schedule(model: BaseChatModel) -> BaseChatModel:
+    """Wrap model with the shared scheduler unless LLM_SCHEDULER_SETTING disables it"""
+    if not LLM_SCHEDULER_SETTING['ENABLED']:
+        return model
+    return ScheduledChatModel(inner=model, scheduler=get_scheduler())
+
+
+def _prompts(calls: int, duplicates: float) -> List[str]:
+    # duplicates 比例的呼叫共用少數幾個提示，用來觀察合併效果
+    return [f"shared question {i % 3}" if random.random() < duplicates else f"question {i}" for i in range(calls)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Drive the scheduler with the fake model (latency and simulated 429s)")
+    parser.add_argument("--calls", type=int, default=200)
+    parser.add_argument("--mode", choices=["async", "threads"], default="async")
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds per fake model call")
+    parser.add_argument("--error-rate", type=float, default=0.2, help="share of fake model calls that return 429")
+    parser.add_argument("--duplicates", type=float, default=0.3, help="share of calls that repeat a shared prompt")
+    parser.add_argument("--concurrency", type=int, default=LLM_SCHEDULER_SETTING['MAX_CONCURRENCY'])
+    parser.add_argument("--rate", type=float, default=6000, help="requests per minute (0 = unlimited)")
+    parser.add_argument("--burst", type=int, default=LLM_SCHEDULER_SETTING['BURST'])
+    parser.add_argument("--backoff", type=float, default=0.05, help="backoff base in seconds")
+    args = parser.parse_args()
+
+    from fake_model import FakeChatModel
+
+    scheduler = LLMScheduler({
+        'MAX_CONCURRENCY': args.concurrency, 'RATE_PER_MINUTE': args.rate, 'BURST': args.burst,
+        'BACKOFF_BASE': args.backoff,
+    })
+    model = ScheduledChatModel(inner=FakeChatModel(latency=args.latency, error_rate=args.error_rate),
+                               scheduler=scheduler)
+    prompts = _prompts(args.calls, args.duplicates)
+    failures = []
+
+    def call(prompt: str) -> None:
+        try:
+            model.invoke(prompt)
+        except Exception as e:
+            failures.append(repr(e))
+
+    async def acall(prompt: str) -> None:
+        try:
+            await model.ainvoke(prompt)
+        except Exception as e:
+            failures.append(repr(e))
+
+    started = time.perf_counter()
+    if args.mode == "async":
+        async def run_all():
+            await asyncio.gather(*(acall(prompt) for prompt in prompts))
+        asyncio.run(run_all())
+    else:
+        with ThreadPoolExecutor(max_workers=min(64, args.calls)) as pool:
+            list(pool.map(call, prompts))
+    elapsed = time.perf_counter() - started
+
+    report = {
+        'mode': args.mode,
+        'seconds': round(elapsed, 3),
+        'calls_per_second': round(args.calls / elapsed, 2) if elapsed else None,
+        'failed_calls': len(failures),
+        'scheduler': scheduler.get_stats(),
+    }
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+"""
+Compact encoding of tool results and of the history sent to the model.
+
+Every model call resends the conversation, so its size is paid on every turn:
+- table(): query tools return {"columns": [...], "rows": [[...], ...]}, naming
+  each column once instead of once per row.
+- model_messages(): the view of the history an agent's model receives.
+  Handoff bookkeeping (transfer_to_* calls and their "Successfully
+  transferred" replies) is left out, and tool calls and tool outputs older
+  than PROMPT_SETTING['TOOL_OUTPUT_TURNS'] turns are dropped; the assistant's
+  text replies of those turns stay, and they already state what the tools
+  found. An old output that carries a fetch_more handle is kept in elided
+  form (status, row_count, handle) so the model can still page through it.
+
+The state and checkpoints keep every message unchanged; only the prompt is
+compacted.
+"""
+import json
+from typing import Any, Dict, List, Optional, Sequence
+
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, ToolMessage
+
+from config import PROMPT_SETTING
+
+HANDOFF_PREFIX = "transfer_to_"
+# 舊輪的工具結果刪減後仍保留的欄位：模型之後還能以 handle 呼叫 fetch_more
+KEPT_FIELDS = ("status", "row_count", "handle")
+
+
+def table(columns: List[str], rows: Sequence[Sequence[Any]]) -> Dict[str, Any]:
+    """Tool result fields for rows given in column order"""
+    if PROMPT_SETTING['COLUMNAR_RESULTS']:
+        return {"columns": columns, "rows": [list(row) for row in rows]}
+    return {"columns": columns, "results": [dict(zip(columns, row)) for row in rows]}
+
+
+def records(columns: List[str], rows: Sequence[Sequence[Any]]):
+    """A nested list of records (e.g. a series in an analysis): a table, or a list of dicts when not columnar"""
+    if PROMPT_SETTING['COLUMNAR_RESULTS']:
+        return {"columns": columns, "rows": [list(row) for row in rows]}
+    return [dict(zip(columns, row)) for row in rows]
+
+
+def is_handoff(call: Dict[str, Any]) -> bool:
+    return call["name"].startswith(HANDOFF_PREFIX)
+
+
+def _without_calls(message: AIMessage, drop: set) -> Optional[AIMessage]:
+    """Copy of message without the tool calls whose ids are in drop, or None if nothing is left"""
+    calls = [call for call in message.tool_calls if call["id"] not in drop]
+    if len(calls) == len(message.tool_calls):
+        return message
+    if not calls and not message.content:
+        return None
+    # additional_kwargs 可能還有 provider 原始的 function_call，不能沿用
+    return AIMessage(content=message.content, tool_calls=calls, id=message.id, name=message.name)
+
+
+def _elided(message: ToolMessage) -> Optional[ToolMessage]:
+    """Copy of an old tool output reduced to KEPT_FIELDS, or None if it has no handle worth keeping"""
+    try:
+        result = json.loads(message.content) if isinstance(message.content, str) else None
+    except ValueError:
+        return None
+    if not isinstance(result, dict) or not result.get("handle"):
+        return None
+    kept = {field: result[field] for field in KEPT_FIELDS if field in result}
+    kept["elided"] = True
+    return message.model_copy(update={"content": json.dumps(kept, ensure_ascii=False)})
+
+
+def _turn_starts(messages: List[BaseMessage]) -> List[int]:
+    return [index for index, message in enumerate(messages) if isinstance(message, HumanMessage)]
+
+
+def model_messages(messages: List[BaseMessage], setting: Dict[str, Any] = None) -> List[BaseMessage]:
+    """The history as the model should see it; messages itself is not modified"""
+    setting = setting or PROMPT_SETTING
+    collapse = setting['COLLAPSE_HANDOFFS']
+    turns = setting['TOOL_OUTPUT_TURNS']
+    starts = _turn_starts(messages)
+    # 此索引之前的輪只保留文字
+    recent = starts[-turns] if turns > 0 and len(starts) >= turns else 0
+    if not collapse and recent == 0:
+        return messages
+
+    # 舊輪中帶有分頁 handle 的工具結果：呼叫保留，結果只留 KEPT_FIELDS
+    elided = {}
+    for message in messages[:recent]:
+        if isinstance(message, ToolMessage):
+            short = _elided(message)
+            if short is not None:
+                elided[message.tool_call_id] = short
+
+    dropped = set()
+    encoded = []
+    for index, message in enumerate(messages):
+        if isinstance(message, AIMessage) and message.tool_calls:
+            dropped.update(
+                call["id"] for call in message.tool_calls
+                if (index < recent and call["id"] not in elided) or (collapse and is_handoff(call))
+            )
+            message = _without_calls(message, dropped)
+        elif isinstance(message, ToolMessage):
+            # 工具回覆與它的呼叫一起保留或刪除，模型 API 要求兩者成對
+            if message.tool_call_id in dropped:
+                continue
+            if index < recent:
+                message = elided.get(message.tool_call_id)
+        if message is not None:
+            encoded.append(message)
+    return encoded
@@ -1,32 +1,141 @@
 import os
+import threading
+import time
 import uuid
+from contextlib import contextmanager
 from dotenv import load_dotenv
-from config import API_SETTING
-from langchain_google_genai import ChatGoogleGenerativeAI
+from config import API_SETTING, ROUTER_SETTING, DISPLAY_SETTING, LLM_SCHEDULER_SETTING, SPECULATION_SETTING
 
-from langchain_core.messages import ToolMessage
+from langchain_core.messages import AIMessage, AIMessageChunk, HumanMessage, SystemMessage, ToolMessage
 from langchain_core.tools import tool
+from langchain_core.runnables.config import run_in_executor
 
 from typing import Annotated, Literal
 
 from langchain_core.tools.base import InjectedToolCallId
 from langgraph.prebuilt import InjectedState
 
-from langgraph.graph import MessagesState, StateGraph, START
+from langgraph.errors import ParentCommand
+from langgraph.graph import MessagesState, StateGraph, START, END
 from langgraph.prebuilt import create_react_agent, InjectedState
+from langgraph.prebuilt.chat_agent_executor import AgentState
 from langgraph.types import Command, interrupt
-from langgraph.checkpoint.memory import MemorySaver
+from langgraph.utils.runnable import RunnableCallable
 
 # 從 config 檔案匯入設定
-from prompts import INTENT_CHECKER_AGENT_PROMPT, INSERT_AGENT_PROMPT, QUERY_AGENT_PROMPT
-from tools import execute_sql, exec_sqlite3_sql
+from checkpointer import build_checkpointer
+from compaction import compact_messages
+from llm_scheduler import get_scheduler_stats, schedule
+from message_encoding import model_messages
+from prompts import INTENT_CHECKER_AGENT_PROMPT, INSERT_AGENT_PROMPT, QUERY_AGENT_PROMPT, QUERY_ANSWER_PROMPT, render_prompt
+from tools import (
+    analyze_transactions, execute_sql, exec_sqlite3_sql, fetch_more, import_statement, record_transactions, search_transactions,
+    summarize_transactions,
+)
+from tools import TransactionItem, insert_transactions, tenant_db
+from query_cache import query_cache, make_key, extract_executed_sql
+from router import route_message, get_router_stats, is_query, looks_like_query, format_confirmation, format_recorded, format_cancelled
+from speculation import get_speculation_stats, speculation_stats
+from tracing import span, traced_node
 
 
 load_dotenv()
 
-os.environ['GOOGLE_API_KEY'] = os.getenv('API_KEY', default=None)
+if os.getenv('API_KEY'):
+    os.environ['GOOGLE_API_KEY'] = os.getenv('API_KEY')
+
+
+def create_model():
+    """Gemini by default; MODEL_PROVIDER=fake / scripted use the local stand-in models.
+
+    The model is wrapped by the shared LLM scheduler (concurrency, rate limit,
+    retries, coalescing) unless LLM_SCHEDULER_SETTING['ENABLED'] is off.
+    """
+    if API_SETTING['PROVIDER'] == 'fake':
+        from fake_model import FakeChatModel
+        model = FakeChatModel(latency=API_SETTING['FAKE_LATENCY'], error_rate=API_SETTING['FAKE_ERROR_RATE'])
+    elif API_SETTING['PROVIDER'] == 'scripted':
+        from fake_model import ScriptedChatModel
+        model = ScriptedChatModel(latency=API_SETTING['FAKE_LATENCY'])
+    else:
+        # langchain_google_genai 匯入約需 1 秒，只在真正建立模型時才載入
+        from langchain_google_genai import ChatGoogleGenerativeAI
+        # 由排程器負責重試時，關閉 SDK 自己的重試，避免重試次數相乘
+        retries = {'max_retries': 1} if LLM_SCHEDULER_SETTING['ENABLED'] else {}
+        model = ChatGoogleGenerativeAI(model=API_SETTING['MODEL_NAME'], **retries)
+    return schedule(model)
+
+
+# 模型、agent 與編譯後的 graph 都在第一次使用時才建立，啟動時只載入模組
+_lazy = {}
+_lazy_lock = threading.RLock()
+
+
+def _get_or_build(name: str, build):
+    value = _lazy.get(name)
+    if value is None:
+        with _lazy_lock:
+            value = _lazy.get(name)
+            if value is None:
+                value = _lazy[name] = build()
+    return value
+
+
+def get_model():
+    return _get_or_build("model", create_model)
+
+
+class ChatState(MessagesState):
+    # 前置路由解析出、等待使用者確認的交易
+    pending_transactions: list
+    # 已壓縮的早期對話摘要
+    summary: str
+    # 推測執行：{"question_id"}，草稿完成後加上 "messages" 與 "seconds"
+    speculation: dict
+
+
+class ChatAgentState(AgentState):
+    summary: str
+
+
+def with_summary(prompt: str):
+    """Build a state_modifier that renders the prompt for this turn and appends the rolling summary.
+
+    The history is compacted by message_encoding.model_messages (no handoff
+    bookkeeping, no stale tool outputs); the state itself is left untouched.
+    """
+    def state_modifier(state):
+        system_prompt = render_prompt(prompt)
+        if state.get("summary"):
+            system_prompt += f"\n\n    Summary of the earlier conversation:\n{state['summary']}\n"
+        return [SystemMessage(content=system_prompt)] + model_messages(state["messages"])
+    return state_modifier
+
 
-model = ChatGoogleGenerativeAI(model=API_SETTING['MODEL_NAME'])
+def turn_messages(messages: list) -> list:
+    """Messages since the latest user message.
+
+    The parent graph already holds everything before it, and add_messages
+    merges by id, so handing back this tail is enough to keep the state
+    consistent without copying the whole history.
+    """
+    for index in range(len(messages) - 1, -1, -1):
+        if isinstance(messages[index], HumanMessage):
+            return messages[index:]
+    return messages
+
+
+def new_messages(state: dict, result: dict) -> dict:
+    """Only return the messages an agent added, instead of the full history"""
+    return {"messages": result["messages"][len(state["messages"]):]}
+
+
+def in_thread_pool(func):
+    """Async variant of a blocking node: run it in the loop's executor so SQLite work never stalls the event loop"""
+    async def afunc(state):
+        # run_in_executor copies the context, so nested subgraph calls keep the run config
+        return await run_in_executor(None, func, state)
+    return afunc
 
 
 # Define a helper for each of the agent nodes to call
@@ -50,7 +159,7 @@ def make_handoff_tool(*, agent_name: str):
         return Command(
             goto=agent_name,
             graph=Command.PARENT,
-            update={"messages": state["messages"] + [tool_message]},
+            update={"messages": turn_messages(state["messages"]) + [tool_message]},
         )
 
     return handoff_to_agent
@@ -59,72 +168,264 @@ def make_handoff_tool(*, agent_name: str):
 
 # Define travel advisor ReAct agent
 intent_checker_agent_tools = [
+    record_transactions,
+    import_statement,
     make_handoff_tool(agent_name="insert_agent"),
     make_handoff_tool(agent_name="query_agent"),
 ]
 
-intent_checker_agent = create_react_agent(
-    model,
-    intent_checker_agent_tools,
-    state_modifier=(
-        INTENT_CHECKER_AGENT_PROMPT
-    ),
-)
-
-def call_intent_checker_agent(
-    state: MessagesState,
-) -> Command[Literal["insert_agent", "human"]]:
-    return intent_checker_agent.invoke(state)
-
-
-
-
 # Define hotel advisor ReAct agent
 insert_agent_tools = [
     exec_sqlite3_sql,
     make_handoff_tool(agent_name="intent_checker_agent"),
 ]
 
-insert_agent = create_react_agent(
-    model,
-    insert_agent_tools,
-    state_modifier=(
-        INSERT_AGENT_PROMPT
-    ),
-)
-
-def call_insert_agent(
-    state: MessagesState,
-) -> Command[Literal["intent_checker_agent", "human"]]:
-    print("Insert Agent 被呼叫")  # 除錯用
-    print("收到的狀態:", state)  # 除錯用
-    result = insert_agent.invoke(state)
-    print("Insert Agent 執行結果:", result)  # 除錯用
-    return result
-
-
-
 # Define hotel advisor ReAct agent
 query_agent_tools = [
+    summarize_transactions,
+    analyze_transactions,
+    search_transactions,
     execute_sql,
+    fetch_more,
     make_handoff_tool(agent_name="intent_checker_agent"),
 ]
 
-query_agent = create_react_agent(
-    model,
-    query_agent_tools,
-    state_modifier=(
-        QUERY_AGENT_PROMPT
-    ),
-)
+# agent 名稱 -> (工具, 提示詞模板)
+AGENTS = {
+    "intent_checker_agent": (intent_checker_agent_tools, INTENT_CHECKER_AGENT_PROMPT),
+    "insert_agent": (insert_agent_tools, INSERT_AGENT_PROMPT),
+    "query_agent": (query_agent_tools, QUERY_AGENT_PROMPT),
+}
+
+
+def get_agent(name: str):
+    """The ReAct agent for name, compiled on first use"""
+    tools, prompt = AGENTS[name]
+    return _get_or_build(name, lambda: create_react_agent(
+        get_model(),
+        tools,
+        state_schema=ChatAgentState,
+        state_modifier=with_summary(prompt),
+    ))
+
+
+def latest_question_id(state: dict):
+    return next((m.id for m in reversed(state["messages"]) if isinstance(m, HumanMessage)), None)
+
+def speculating(state: dict):
+    """Id of the question being drafted speculatively this turn, if any"""
+    speculation = state.get("speculation")
+    question_id = latest_question_id(state)
+    if speculation and question_id is not None and speculation.get("question_id") == question_id:
+        return question_id
+    return None
+
+@contextmanager
+def classification(state: dict):
+    """Report whether the intent checker agreed with this turn's speculative draft"""
+    question_id = speculating(state)
+    if question_id is None:
+        yield
+        return
+    started = time.perf_counter()
+    agrees = False
+    try:
+        yield
+    except ParentCommand as e:
+        agrees = e.args[0].goto == "query_agent"
+        raise
+    finally:
+        speculation_stats.classified(question_id, agrees, time.perf_counter() - started)
+
+def call_intent_checker_agent(
+    state: ChatState,
+) -> Command[Literal["insert_agent", "human"]]:
+    with classification(state):
+        return new_messages(state, get_agent("intent_checker_agent").invoke(state))
+
+async def acall_intent_checker_agent(state: ChatState):
+    with classification(state):
+        return new_messages(state, await get_agent("intent_checker_agent").ainvoke(state))
+
+def call_insert_agent(
+    state: ChatState,
+) -> Command[Literal["intent_checker_agent", "human"]]:
+    return new_messages(state, get_agent("insert_agent").invoke(state))
+
+async def acall_insert_agent(state: ChatState):
+    return new_messages(state, await get_agent("insert_agent").ainvoke(state))
+
+def answer_from_cache(question: str, key) -> str:
+    """Answer a repeated question from the caches with at most one model call."""
+    with tenant_db() as manager:
+        version = manager.write_version
+    answer = query_cache.get_answer(key, version)
+    if answer is not None:
+        return answer
+
+    sql = query_cache.get_sql(key)
+    if sql is None:
+        return None
+    result = execute_sql.invoke({"sql": sql})
+    if result["status"] != "success":
+        return None
+    response = get_model().invoke([
+        SystemMessage(content=QUERY_ANSWER_PROMPT),
+        HumanMessage(content=f"Question: {question}\nSQL: {sql}\nResult: {result}"),
+    ])
+    query_cache.put_answer(key, version, response.content)
+    return response.content
+
+def latest_question(state: ChatState):
+    question = next(
+        (m.content for m in reversed(state["messages"]) if isinstance(m, HumanMessage)),
+        None,
+    )
+    # 只快取可獨立理解的查詢，避免「那上個月呢？」這類依賴上下文的問題
+    if not isinstance(question, str) or not is_query(question):
+        return None
+    return question
+
+def remember_query(key, version: int, update: dict) -> dict:
+    """Store the SQL and answer of a finished query_agent run and return its update"""
+    sql = extract_executed_sql(update["messages"])
+    if sql is not None:
+        query_cache.put_sql(key, sql)
+        final = update["messages"][-1] if update["messages"] else None
+        if isinstance(final, AIMessage) and final.content and not final.tool_calls:
+            query_cache.put_answer(key, version, final.content)
+    return update
+
+def take_draft(state: ChatState):
+    """The speculative draft for this question, as the query_agent update that commits it"""
+    speculation = state.get("speculation") or {}
+    if speculating(state) is None or speculation.get("messages") is None:
+        return None
+    return {"messages": speculation["messages"], "speculation": None}
 
 def call_query_agent(
-    state: MessagesState,
+    state: ChatState,
 ) -> Command[Literal["intent_checker_agent", "human"]]:
-    return query_agent.invoke(state)
+    draft = take_draft(state)
+    if draft is not None:
+        return draft
+    question = latest_question(state)
+    if question is None:
+        return new_messages(state, get_agent("query_agent").invoke(state))
+
+    key = make_key(question)
+    answer = answer_from_cache(question, key)
+    if answer is not None:
+        return {"messages": [AIMessage(content=answer, name="query_agent")]}
+
+    with tenant_db() as manager:
+        version = manager.write_version
+    return remember_query(key, version, new_messages(state, get_agent("query_agent").invoke(state)))
+
+async def acall_query_agent(state: ChatState):
+    draft = take_draft(state)
+    if draft is not None:
+        return draft
+    question = latest_question(state)
+    if question is None:
+        return new_messages(state, await get_agent("query_agent").ainvoke(state))
+
+    key = make_key(question)
+    answer = await run_in_executor(None, answer_from_cache, question, key)
+    if answer is not None:
+        return {"messages": [AIMessage(content=answer, name="query_agent")]}
+
+    with tenant_db() as manager:
+        version = manager.write_version
+    return remember_query(key, version, new_messages(state, await get_agent("query_agent").ainvoke(state)))
+
+@contextmanager
+def drafting(state: ChatState):
+    """Time a speculative draft and turn its outcome into the "speculation" update"""
+    question_id = speculating(state)
+    draft = {"question_id": question_id}
+    started = time.perf_counter()
+    ok = False
+    try:
+        with speculation_stats.guard(question_id):
+            yield draft
+        ok = True
+    except ParentCommand:
+        # 草稿要交回 intent checker：放棄推測，不讓交接影響主流程
+        pass
+    except Exception as e:
+        draft["error"] = str(e)
+    finally:
+        draft["seconds"] = time.perf_counter() - started
+        if not ok:
+            draft.pop("messages", None)
+        speculation_stats.drafted(question_id, ok, draft["seconds"])
+
+def query_draft(state: ChatState) -> dict:
+    """Run the query agent speculatively; query_agent commits the result if the intent checker agrees"""
+    with drafting(state) as draft:
+        draft["messages"] = call_query_agent(state)["messages"]
+    return {"speculation": draft}
+
+async def aquery_draft(state: ChatState) -> dict:
+    with drafting(state) as draft:
+        draft["messages"] = (await acall_query_agent(state))["messages"]
+    return {"speculation": draft}
+
+def compact_history(state: ChatState) -> dict:
+    """Fold old messages into the rolling summary once a thread gets long."""
+    update = compact_messages(state["messages"], state.get("summary", ""), get_model())
+    return update or {}
+
+def pre_router(
+    state: ChatState,
+) -> Command[Literal["intent_checker_agent", "query_agent", "query_draft", "__end__"]]:
+    """Handle high-confidence messages locally; everything else goes to the intent checker."""
+    text = state["messages"][-1].content
+    pending = state.get("pending_transactions") or []
+    decision = None
+    if ROUTER_SETTING['ENABLED'] and isinstance(text, str):
+        decision = route_message(text, pending=pending)
+
+    if decision is None:
+        question_id = latest_question_id(state)
+        if SPECULATION_SETTING['ENABLED'] and question_id is not None and isinstance(text, str) and looks_like_query(text):
+            # 兩個節點在同一個 superstep 平行執行
+            speculation_stats.started()
+            return Command(
+                goto=["intent_checker_agent", "query_draft"],
+                update={"pending_transactions": [], "speculation": {"question_id": question_id}},
+            )
+        return Command(goto="intent_checker_agent", update={"pending_transactions": []})
+
+    if decision["route"] == "query":
+        return Command(goto="query_agent", update={"pending_transactions": []})
+
+    if decision["route"] == "insert":
+        reply = format_confirmation(decision["transactions"], text)
+        pending = decision["transactions"]
+    elif decision["route"] == "confirm":
+        try:
+            count = insert_transactions([TransactionItem(**t) for t in decision["transactions"]])
+        except Exception:
+            # 寫入失敗時交給 intent checker 走一般流程
+            return Command(goto="intent_checker_agent", update={"pending_transactions": []})
+        reply = format_recorded(count, text)
+        pending = []
+    else:
+        reply = format_cancelled(text)
+        pending = []
+
+    return Command(
+        goto=END,
+        update={
+            "messages": [AIMessage(content=reply, name="pre_router")],
+            "pending_transactions": pending,
+        },
+    )
 
 def human_node(
-    state: MessagesState, config
+    state: ChatState, config
 ) -> Command[Literal["intent_checker_agent", "human"]]:
     """A node for collecting user input."""
 
@@ -151,34 +452,71 @@ def human_node(
     )
 
 
-builder = StateGraph(MessagesState)
-builder.add_node("intent_checker_agent", call_intent_checker_agent)
-builder.add_node("insert_agent", call_insert_agent)
-builder.add_node("query_agent", call_query_agent)
+def traced_callable(name: str, func, afunc) -> RunnableCallable:
+    """Node runnable with sync and async variants, each recorded as a "node:<name>" span"""
+    return RunnableCallable(traced_node(name)(func), traced_node(name)(afunc))
+
+
+builder = StateGraph(ChatState)
+# 每個節點同時提供同步與非同步版本：graph.invoke 走同步，graph.ainvoke / astream 走非同步
+builder.add_node("compact_history", traced_callable("compact_history", compact_history, in_thread_pool(compact_history)))
+builder.add_node("pre_router", traced_callable("pre_router", pre_router, in_thread_pool(pre_router)))
+builder.add_node("intent_checker_agent", traced_callable("intent_checker_agent", call_intent_checker_agent, acall_intent_checker_agent))
+builder.add_node("insert_agent", traced_callable("insert_agent", call_insert_agent, acall_insert_agent))
+builder.add_node("query_agent", traced_callable("query_agent", call_query_agent, acall_query_agent))
+builder.add_node("query_draft", traced_callable("query_draft", query_draft, aquery_draft))
 
 # This adds a node to collect human input, which will route
 # back to the active agent.
-builder.add_node("human", human_node)
+builder.add_node("human", traced_node("human")(human_node))
+
+# Every turn first compacts long histories, then goes through the rule-based router,
+# which falls back to the intent checker.
+builder.add_edge(START, "compact_history")
+builder.add_edge("compact_history", "pre_router")
+
+def get_checkpointer():
+    return _get_or_build("checkpointer", build_checkpointer)
+
 
-# We'll always start with a general travel advisor.
-builder.add_edge(START, "intent_checker_agent")
+def get_graph():
+    """The compiled graph; the checkpoint database is opened on first use"""
+    return _get_or_build("graph", lambda: builder.compile(checkpointer=get_checkpointer()))
 
-checkpointer = MemorySaver()
-graph = builder.compile(checkpointer=checkpointer)
+
+def warm_up() -> None:
+    """Build the model, every agent and the graph now instead of on the first turn"""
+    get_graph()
+    for name in AGENTS:
+        get_agent(name)
+
+
+def __getattr__(name: str):
+    # 相容舊用法：agents.graph / agents.model / agents.checkpointer 在存取時才建立
+    if name == "graph":
+        return get_graph()
+    if name == "model":
+        return get_model()
+    if name == "checkpointer":
+        return get_checkpointer()
+    if name in AGENTS:
+        return get_agent(name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 
 
 thread_config = {"configurable": {"thread_id": uuid.uuid4()}}
 
-def stream_graph_updates(user_input_str: str):
+def print_node_updates(user_input_str: str):
+    """Debug display: print every node update as it completes"""
     user_input_dict = {
         "messages": [
             {"role": "user", "content": user_input_str}
         ]
     }
 
-    for update in graph.stream(
+    for update in get_graph().stream(
         user_input_dict,
         config=thread_config,
         stream_mode="updates",
@@ -192,6 +530,84 @@ def stream_graph_updates(user_input_str: str):
                     if hasattr(message, 'content') and message.content:  # 檢查是否有 content 屬性且不為空
                         print(message.content)
 
+def message_text(message) -> str:
+    """Plain text of a message or chunk (Gemini may return a list of content blocks)"""
+    if isinstance(message.content, str):
+        return message.content
+    return "".join(
+        block.get("text", "") if isinstance(block, dict) else str(block)
+        for block in message.content
+    )
+
+def top_level_node(metadata: dict) -> str:
+    """Graph node a streamed message belongs to, also when it comes from an agent subgraph inside the node"""
+    namespace = metadata.get("langgraph_checkpoint_ns") or ""
+    return namespace.split("|")[0].split(":")[0] or metadata.get("langgraph_node")
+
+def stream_graph_updates(user_input_str: str):
+    """Print assistant tokens as they arrive, then the first-token and total latency.
+
+    Tool calls, tool results and history are not shown. Replies that do not
+    come from a streaming model call (router confirmations, cached answers)
+    are picked up from the node updates instead.
+    """
+    if DISPLAY_SETTING['STREAM_MODE'] == 'updates':
+        return print_node_updates(user_input_str)
+
+    user_input_dict = {
+        "messages": [
+            {"role": "user", "content": user_input_str}
+        ]
+    }
+    started = time.perf_counter()
+    first_token = None
+    shown = set()
+
+    current = None
+
+    def show(text: str, message_id) -> None:
+        nonlocal first_token, current
+        if first_token is None:
+            first_token = time.perf_counter() - started
+            print("Assistant: ", end="", flush=True)
+        elif message_id != current:
+            print()
+        print(text, end="", flush=True)
+        current = message_id
+        shown.add(message_id)
+
+    for mode, chunk in get_graph().stream(
+        user_input_dict,
+        config=thread_config,
+        stream_mode=["messages", "updates"],
+    ):
+        if mode == "messages":
+            message, metadata = chunk
+            if not isinstance(message, (AIMessage, AIMessageChunk)):
+                continue
+            if top_level_node(metadata) in DISPLAY_SETTING['HIDDEN_NODES']:
+                continue
+            text = message_text(message)
+            # 完整訊息若已逐字顯示過就略過
+            if text and (isinstance(message, AIMessageChunk) or message.id not in shown):
+                show(text, message.id)
+            continue
+
+        for node_id, value in chunk.items():
+            if node_id in DISPLAY_SETTING['HIDDEN_NODES'] or not isinstance(value, dict):
+                continue
+            for message in value.get("messages", []):
+                if isinstance(message, AIMessage) and message.id not in shown and message_text(message):
+                    show(message_text(message), message.id)
+
+    total = time.perf_counter() - started
+    if first_token is None:
+        print("Assistant: (no reply)")
+    else:
+        print()
+    ttft = f"{first_token:.2f}s" if first_token is not None else "-"
+    print(f"[first token {ttft} | turn {total:.2f}s]")
+
 def main():
     """
     主迴圈：持續詢問使用者輸入，輸入 'quit' / 'exit' / 'q' 時結束。
@@ -199,11 +615,16 @@ def main():
     while True:
         user_input = input("User: ")
         if user_input.lower() in ["quit", "exit", "q"]:
+            print("Router stats:", get_router_stats())
+            if SPECULATION_SETTING['ENABLED']:
+                print("Speculation stats:", get_speculation_stats())
+            print("Query cache stats:", query_cache.get_stats())
             print("Goodbye!")
             break
 
         # 呼叫我們的函式，將使用者輸入丟給 graph
-        stream_graph_updates(user_input)
+        with span("turn", thread_id=str(thread_config["configurable"]["thread_id"])):
+            stream_graph_updates(user_input)
 
 # 執行主函式
 if __name__ == '__main__':
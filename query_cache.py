@@ -0,0 +1,198 @@
+"""
+Cache for the query agent.
+
+Two layers are kept:
+- SQL layer: normalized question + resolved date window -> SQL the agent wrote.
+  A date window is part of the key so "本月總支出" asked in another month
+  does not reuse last month's SQL.
+- Result layer: (SQL, table version) -> execute_sql result, and
+  (question key, table version) -> final answer. Every committed write bumps
+  the table version, which invalidates these entries without scanning them.
+"""
+import json
+import re
+import threading
+import time
+import unicodedata
+from calendar import monthrange
+from collections import OrderedDict
+from datetime import date, timedelta
+from typing import Any, Dict, Hashable, List, Optional, Tuple
+
+from langchain_core.messages import AIMessage, ToolMessage
+
+from config import QUERY_CACHE_SETTING
+
+_MISSING = object()
+
+
+class LRUCache:
+    """Thread-safe LRU cache with an optional per-entry TTL and hit/miss counters"""
+
+    def __init__(self, maxsize: int = 256, ttl: float = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'expired': 0}
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._data.get(key, _MISSING)
+            if entry is _MISSING:
+                self.stats['misses'] += 1
+                return default
+            stored_at, value = entry
+            if self.ttl is not None and time.monotonic() - stored_at > self.ttl:
+                del self._data[key]
+                self.stats['expired'] += 1
+                self.stats['misses'] += 1
+                return default
+            self._data.move_to_end(key)
+            self.stats['hits'] += 1
+            return value
+
+    def put(self, key: Hashable, value: Any) -> None:
+        with self._lock:
+            self._data[key] = (time.monotonic(), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.stats['evictions'] += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self.stats, size=len(self._data))
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+        return stats
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._data)
+
+
+_FILLER = re.compile(r"請問|请问|幫我|帮我|麻煩|麻烦|一下|\bplease\b|\bcan you\b|\bcould you\b|\btell me\b", re.I)
+_PUNCTUATION = re.compile(r"[\s\W_]+", re.U)
+
+
+def normalize_question(text: str) -> str:
+    """Lowercase, NFKC-fold and strip filler words and punctuation from a question"""
+    text = unicodedata.normalize('NFKC', text or "").lower()
+    text = _FILLER.sub(" ", text)
+    return _PUNCTUATION.sub(" ", text).strip()
+
+
+def _month_window(year: int, month: int) -> Tuple[str, str]:
+    return date(year, month, 1).isoformat(), date(year, month, monthrange(year, month)[1]).isoformat()
+
+
+def resolve_date_window(text: str, today: date = None) -> Optional[Tuple[str, str]]:
+    """Resolve relative period words ("本月", "last week", ...) to a (start, end) date window"""
+    today = today or date.today()
+    text = text.lower()
+    if re.search(r"上個月|上个月|last month", text):
+        last = today.replace(day=1) - timedelta(days=1)
+        return _month_window(last.year, last.month)
+    if re.search(r"本月|這個月|这个月|this month", text):
+        return _month_window(today.year, today.month)
+    if re.search(r"上週|上周|上禮拜|last week", text):
+        start = today - timedelta(days=today.weekday() + 7)
+        return start.isoformat(), (start + timedelta(days=6)).isoformat()
+    if re.search(r"本週|本周|這週|这周|這禮拜|this week", text):
+        start = today - timedelta(days=today.weekday())
+        return start.isoformat(), (start + timedelta(days=6)).isoformat()
+    if re.search(r"去年|last year", text):
+        return date(today.year - 1, 1, 1).isoformat(), date(today.year - 1, 12, 31).isoformat()
+    if re.search(r"今年|this year", text):
+        return date(today.year, 1, 1).isoformat(), date(today.year, 12, 31).isoformat()
+    if re.search(r"昨天|yesterday", text):
+        day = (today - timedelta(days=1)).isoformat()
+        return day, day
+    if re.search(r"今天|today", text):
+        return today.isoformat(), today.isoformat()
+    return None
+
+
+def make_key(question: str, today: date = None) -> Tuple[str, Optional[Tuple[str, str]]]:
+    """Cache key for a question: normalized text plus its resolved date window"""
+    return normalize_question(question), resolve_date_window(question, today=today)
+
+
+def _parse_tool_content(content: Any) -> Optional[dict]:
+    if isinstance(content, dict):
+        return content
+    if isinstance(content, str):
+        try:
+            parsed = json.loads(content)
+        except ValueError:
+            return None
+        return parsed if isinstance(parsed, dict) else None
+    return None
+
+
+def extract_executed_sql(messages: List[Any]) -> Optional[str]:
+    """Return the last SQL that execute_sql ran successfully in the given messages"""
+    calls = {}
+    executed = None
+    for message in messages:
+        if isinstance(message, AIMessage):
+            for call in message.tool_calls:
+                if call["name"] == "execute_sql":
+                    calls[call["id"]] = call["args"].get("sql")
+        elif isinstance(message, ToolMessage) and message.tool_call_id in calls:
+            result = _parse_tool_content(message.content)
+            if result and result.get("status") == "success":
+                executed = calls[message.tool_call_id]
+    return executed
+
+
+class QueryCache:
+    """NL-to-SQL cache plus version-keyed result and answer caches"""
+
+    def __init__(self, setting: Dict[str, Any] = None):
+        setting = setting or QUERY_CACHE_SETTING
+        self.enabled = setting['ENABLED']
+        self.sql = LRUCache(setting['SQL_MAXSIZE'], setting['SQL_TTL'])
+        self.results = LRUCache(setting['RESULT_MAXSIZE'], setting['RESULT_TTL'])
+        self.answers = LRUCache(setting['RESULT_MAXSIZE'], setting['RESULT_TTL'])
+
+    def get_sql(self, key: Hashable) -> Optional[str]:
+        return self.sql.get(key) if self.enabled else None
+
+    def put_sql(self, key: Hashable, sql: str) -> None:
+        if self.enabled:
+            self.sql.put(key, sql)
+
+    def get_result(self, sql: str, version: int) -> Optional[dict]:
+        return self.results.get((sql, version)) if self.enabled else None
+
+    def put_result(self, sql: str, version: int, result: dict) -> None:
+        if self.enabled:
+            self.results.put((sql, version), result)
+
+    def get_answer(self, key: Hashable, version: int) -> Optional[str]:
+        return self.answers.get((key, version)) if self.enabled else None
+
+    def put_answer(self, key: Hashable, version: int, answer: str) -> None:
+        if self.enabled:
+            self.answers.put((key, version), answer)
+
+    def clear(self) -> None:
+        self.sql.clear()
+        self.results.clear()
+        self.answers.clear()
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            'sql': self.sql.get_stats(),
+            'results': self.results.get_stats(),
+            'answers': self.answers.get_stats(),
+        }
+
+
+query_cache = QueryCache()
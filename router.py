@@ -0,0 +1,235 @@
+"""
+Rule-based pre-router placed in front of the intent checker agent.
+
+Only high-confidence messages are handled here: plain "item amount" records
+(e.g. "coffee 80", "午餐 150 元, 計程車 30") and common summary questions
+(e.g. "本月總支出", "this month's expenses"). A number only counts as an
+amount with a currency, a spending verb or a common item name, and never when
+it looks like a year or an ordinal, so "page 2" or "bus 2024" are not
+recorded. Everything else returns None and falls through to the LLM.
+"""
+import re
+import threading
+from datetime import date, timedelta
+from typing import Dict, Any, List, Optional
+
+_AMOUNT = r"(?P<currency>NT\$|\$)?\s*(?P<amount>\d+(?:\.\d{1,2})?)\s*(?P<unit>元|塊錢?|块钱?|dollars?|TWD|NTD)?"
+_VERB = r"(?P<verb>買了?|买了?|購買|购买|花了?|付了?|bought|buy|paid(?:\s+for)?)?\s*"
+_ITEM = r"(?P<item>[A-Za-z一-鿿][A-Za-z一-鿿' \-]{0,29}?)"
+_DATE_WORDS = {
+    "今天": 0, "today": 0,
+    "昨天": 1, "yesterday": 1,
+    "前天": 2,
+}
+_DATE = r"(?P<date>今天|昨天|前天|today|yesterday|\d{4}-\d{2}-\d{2})?"
+
+_ITEM_FIRST = re.compile(rf"^{_DATE}\s*{_VERB}{_ITEM}\s*[:：]?\s*{_AMOUNT}\s*{_DATE.replace('date', 'date2')}$", re.I)
+_AMOUNT_FIRST = re.compile(rf"^{_DATE}\s*{_AMOUNT}\s+(?:on\s+|for\s+)?{_ITEM}\s*{_DATE.replace('date', 'date2')}$", re.I)
+_SEPARATORS = re.compile(r"\s*(?:[,，、;；]|\band\b|和|跟)\s*", re.I)
+
+# 項目中出現這些字詞代表句子不只是「項目 金額」，交給 LLM 判斷
+_FILLER_WORDS = re.compile(r"記|记|幫|帮|請|请|我|花|今天|昨天|前天|\b(?:record|log|spent|spend|paid|please|my|i)\b", re.I)
+_INCOME_WORDS = re.compile(r"薪水|薪資|薪资|工資|工资|獎金|奖金|收入|利息|股息|退款|salary|bonus|income|interest|dividend|refund", re.I)
+# 常見的消費與收入項目：沒有幣別或動詞時，項目須是這些字詞之一才視為記帳
+_ITEM_WORDS = re.compile(
+    r"早餐|午餐|晚餐|宵夜|早午餐|便當|咖啡|茶|飲料|奶茶|點心|点心|零食|水果|麵包|面包|餐|飯|饭|麵|面|"
+    r"計程車|计程车|公車|公车|捷運|捷运|高鐵|高铁|火車|火车|油錢|油钱|加油|停車|停车|車票|车票|"
+    r"房租|電費|电费|水費|水费|瓦斯|電話費|电话费|網路|网路|保險|保险|"
+    r"超市|日用品|衣服|鞋|書|书|文具|電影|电影|門票|门票|禮物|礼物|藥|药|看診|剪髮|剪发|"
+    r"\b(?:breakfast|brunch|lunch|dinner|supper|snacks?|coffee|latte|tea|drinks?|juice|beer|wine|meal|food|"
+    r"groceries|grocery|fruit|bread|pizza|burger|sandwich|sushi|taxi|uber|bus|train|metro|mrt|subway|"
+    r"fare|gas|fuel|parking|tolls?|rent|electricity|water bill|phone bill|internet|insurance|"
+    r"clothes|shoes|books?|stationery|movie|tickets?|gifts?|medicine|haircut|gym)\b",
+    re.I,
+)
+# 金額前的序數標記（第 3、No. 5、#7）
+_ORDINAL_PREFIX = re.compile(r"(?:第|\bno\.?|#)\s*$", re.I)
+_QUESTION_WORDS = re.compile(r"[?？]|多少|幾|几|嗎|吗|查|列出|統計|统计|明細|明细|\b(?:how|what|which|list|show|total|sum)\b", re.I)
+
+_PERIOD = re.compile(
+    r"本月|這個月|这个月|上個月|上个月|今天|昨天|本週|本周|這週|这周|這禮拜|上週|上周|今年|去年|"
+    r"this month|last month|this week|last week|today|yesterday|this year|last year",
+    re.I,
+)
+_LEDGER = re.compile(
+    r"支出|收入|花費|花费|消費|消费|開銷|开销|交易|帳|账|花了|"
+    r"expenses?|income|spend(?:ing)?|spent|transactions?|earn(?:ed|ings)?",
+    re.I,
+)
+_RECORD_WORDS = re.compile(r"記錄|记录|記帳|记账|記一筆|记一笔|\b(?:record|log|add)\b", re.I)
+_DATE_LITERAL = re.compile(r"\d{4}\s*[-/年]\s*\d{1,2}(?:\s*[-/月]\s*\d{1,2}\s*日?)?\s*月?|\d{1,2}\s*月(?:\s*\d{1,2}\s*日)?")
+_QUERY_VERB = re.compile(r"多少|總|总|查詢|查询|列出|統計|统计|明細|明细|\b(?:how much|total|list|show|summary)\b", re.I)
+
+_AFFIRMATIVE = re.compile(r"^(?:是|對|对|好|好的|確認|确认|沒錯|没错|正確|正确|可以|ok|okay|y|yes|yep|correct|confirm(?:ed)?)[!！。.]*$", re.I)
+_NEGATIVE = re.compile(r"^(?:不|不是|不對|不对|否|取消|算了|no|n|nope|cancel)[!！。.]*$", re.I)
+_CJK = re.compile(r"[一-鿿]")
+
+_stats_lock = threading.Lock()
+_stats = {
+    'messages': 0,
+    'insert': 0,
+    'query': 0,
+    'confirm': 0,
+    'cancel': 0,
+    'fallthrough': 0,
+}
+
+
+def _count(route: str) -> None:
+    with _stats_lock:
+        _stats['messages'] += 1
+        _stats[route] += 1
+
+
+def get_router_stats() -> Dict[str, Any]:
+    """Return routing counters and the share of messages handled without the LLM"""
+    with _stats_lock:
+        stats = dict(_stats)
+    hits = stats['messages'] - stats['fallthrough']
+    stats['hit_rate'] = hits / stats['messages'] if stats['messages'] else 0.0
+    # 每個命中至少省下一次 intent checker 的模型呼叫
+    stats['llm_calls_saved'] = hits
+    return stats
+
+
+def reset_router_stats() -> None:
+    with _stats_lock:
+        for key in _stats:
+            _stats[key] = 0
+
+
+def _resolve_date(*words: Optional[str], today: date) -> Optional[str]:
+    words = [w for w in words if w]
+    if len(words) > 1:
+        return None
+    if not words:
+        return today.isoformat()
+    word = words[0].lower()
+    if word in _DATE_WORDS:
+        return (today - timedelta(days=_DATE_WORDS[word])).isoformat()
+    try:
+        return date.fromisoformat(word).isoformat()
+    except ValueError:
+        return None
+
+
+def _is_amount(match: re.Match, item: str) -> bool:
+    """Whether the number is a price: "page 2", "room 101", "chapter 11" or "bus 2024" are not"""
+    if match.group('currency') or match.group('unit'):
+        return True
+    number = match.group('amount')
+    # 像年份的整數與序數（第 3、#7）不當作金額
+    if (number.isdigit() and 1900 <= int(number) <= 2100) or _ORDINAL_PREFIX.search(item):
+        return False
+    # 沒有幣別時，須有消費動詞或常見的支出、收入項目名稱（_AMOUNT_FIRST 沒有動詞）
+    return bool(match.groupdict().get('verb') or _ITEM_WORDS.search(item) or _INCOME_WORDS.search(item))
+
+
+def parse_transactions(text: str, today: date = None) -> Optional[List[Dict[str, Any]]]:
+    """Parse "item amount" phrases into transactions, or None if any part is unclear"""
+    today = today or date.today()
+    if _QUESTION_WORDS.search(text):
+        return None
+
+    transactions = []
+    for segment in _SEPARATORS.split(text.strip()):
+        if not segment:
+            continue
+        match = _ITEM_FIRST.match(segment) or _AMOUNT_FIRST.match(segment)
+        if not match:
+            return None
+        item = match.group('item').strip()
+        when = _resolve_date(match.group('date'), match.group('date2'), today=today)
+        amount = float(match.group('amount'))
+        if not item or _FILLER_WORDS.search(item) or when is None or amount <= 0:
+            return None
+        if not _is_amount(match, item):
+            return None
+        transactions.append({
+            'item': item,
+            'amount': amount,
+            'date': when,
+            'transaction_type': 'Income' if _INCOME_WORDS.search(item) else 'Expense',
+        })
+    return transactions or None
+
+
+def is_query(text: str) -> bool:
+    """True for common summary questions such as "本月總支出" or "this month's expenses" """
+    if not _LEDGER.search(text) or _RECORD_WORDS.search(text):
+        return False
+    # 日期以外還有數字（例如金額）時，不視為高信心查詢
+    if re.search(r"\d", _DATE_LITERAL.sub("", text)):
+        return False
+    return bool(_PERIOD.search(text) or _DATE_LITERAL.search(text) or _QUERY_VERB.search(text))
+
+
+def route_message(text: str, pending: List[Dict[str, Any]] = None, today: date = None) -> Optional[Dict[str, Any]]:
+    """Decide a route for a user message without calling the LLM.
+
+    Args:
+        text: The latest user message.
+        pending: Transactions awaiting confirmation from a previous route.
+        today: Date used for "today"/"yesterday" (defaults to date.today()).
+
+    Returns:
+        A dict with "route" ("insert", "query", "confirm" or "cancel") and,
+        for insert/confirm, the "transactions"; or None to fall through.
+    """
+    text = (text or "").strip()
+    if pending:
+        if _AFFIRMATIVE.match(text):
+            _count('confirm')
+            return {'route': 'confirm', 'transactions': pending}
+        if _NEGATIVE.match(text):
+            _count('cancel')
+            return {'route': 'cancel'}
+
+    transactions = parse_transactions(text, today=today)
+    if transactions:
+        _count('insert')
+        return {'route': 'insert', 'transactions': transactions}
+
+    if is_query(text):
+        _count('query')
+        return {'route': 'query'}
+
+    _count('fallthrough')
+    return None
+
+
+def looks_like_query(text: str) -> bool:
+    """Looser than is_query: likely enough to draft a query speculatively, not to skip the intent checker"""
+    text = (text or "").strip()
+    if not text or _RECORD_WORDS.search(text) or parse_transactions(text):
+        return False
+    return bool(_QUESTION_WORDS.search(text) or (_LEDGER.search(text) and (_PERIOD.search(text) or _DATE_LITERAL.search(text))))
+
+
+def format_confirmation(transactions: List[Dict[str, Any]], text: str = "") -> str:
+    """Render the confirmation prompt for parsed transactions in the user's language"""
+    zh = bool(_CJK.search(text))
+    lines = ["好的，以下是交易明細：" if zh else "Great, here are the transaction details:"]
+    for t in transactions:
+        if zh:
+            kind = '收入' if t['transaction_type'] == 'Income' else '支出'
+            lines.append(f"- 項目：{t['item']}　金額：{t['amount']:g}　日期：{t['date']}　類型：{kind}")
+        else:
+            lines.append(
+                f"- Item: {t['item']}  Amount: {t['amount']:g}  "
+                f"Date: {t['date']}  Transaction Type: {t['transaction_type']}"
+            )
+    lines.append("請確認是否正確？(是/否)" if zh else "Please confirm if everything is correct. (yes/no)")
+    return "\n".join(lines)
+
+
+def format_recorded(count: int, text: str = "") -> str:
+    if _CJK.search(text):
+        return f"已記錄 {count} 筆交易。"
+    return f"Recorded {count} transaction(s)."
+
+
+def format_cancelled(text: str = "") -> str:
+    if _CJK.search(text):
+        return "好的，已取消這次記錄。"
+    return "OK, the transaction was not recorded."
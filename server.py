@@ -0,0 +1,229 @@
+"""
+Asyncio multi-session server for the bookkeeping graph.
+
+Each conversation has its own thread_id, and many run concurrently on one
+event loop through graph.ainvoke. Blocking SQLite work (tools, router writes,
+checkpoints) runs in a bounded thread pool.
+
+    python server.py                         # HTTP server on SERVER_HOST:SERVER_PORT
+    python server.py --fake                  # same, with the local fake model
+    python server.py --fake --load-test 100  # 100 simulated users, no HTTP
+
+HTTP API:
+    POST /chat   {"message": "coffee 80", "thread_id": "optional", "user_id": "optional"}
+                 -> {"thread_id": "...", "reply": "...", "seconds": 0.12}
+    GET  /stats  -> server, router, query cache, connection, shard, replica and LLM scheduler counters
+
+With DB_SHARDING=true each user_id (or thread_id, see DB_SHARD_KEY) gets its
+own ledger file, so users do not share one SQLite writer lock. With
+DB_READ_REPLICA=true the query tools read a backup-API snapshot instead of
+the file the inserts go to.
+"""
+import argparse
+import asyncio
+import importlib
+import json
+import statistics
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Optional
+
+from config import API_SETTING, LLM_SCHEDULER_SETTING, SERVER_SETTING
+from db.connection import get_connection_manager
+from db.replica import get_replica_stats
+from db.shards import shard_router
+from tracing import span
+
+_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 500: "Internal Server Error"}
+LOAD_TEST_MESSAGES = ["coffee 80", "yes", "本月總支出", "this month's expenses", "hello"]
+
+
+class ChatServer:
+    """Serves concurrent conversations with at most max_concurrency turns in flight"""
+
+    def __init__(self, graph, max_concurrency: int = None):
+        self.graph = graph
+        self.semaphore = asyncio.Semaphore(max_concurrency or SERVER_SETTING['MAX_CONCURRENCY'])
+        self.stats = {'active': 0, 'queued': 0, 'served': 0, 'errors': 0, 'busy_seconds': 0.0}
+
+    async def chat(self, message: str, thread_id: Optional[str] = None, user_id: Optional[str] = None) -> Dict[str, Any]:
+        """Run one turn of a conversation and return the assistant's reply"""
+        thread_id = thread_id or uuid.uuid4().hex
+        config = {"configurable": {"thread_id": thread_id}}
+        if user_id:
+            # 分片開啟時，工具依 user_id 選擇這位使用者的帳本
+            config["configurable"]["user_id"] = user_id
+        self.stats['queued'] += 1
+        async with self.semaphore:
+            self.stats['queued'] -= 1
+            self.stats['active'] += 1
+            started = time.perf_counter()
+            try:
+                with span("turn", thread_id=thread_id):
+                    result = await self.graph.ainvoke(
+                        {"messages": [{"role": "user", "content": message}]}, config=config
+                    )
+            except Exception:
+                self.stats['errors'] += 1
+                raise
+            finally:
+                elapsed = time.perf_counter() - started
+                self.stats['active'] -= 1
+                self.stats['busy_seconds'] += elapsed
+
+        self.stats['served'] += 1
+        reply = result["messages"][-1].content if result.get("messages") else ""
+        return {"thread_id": thread_id, "reply": reply, "seconds": round(elapsed, 4)}
+
+    def get_stats(self, agents) -> Dict[str, Any]:
+        return {
+            'server': dict(self.stats),
+            'router': agents.get_router_stats(),
+            'query_cache': agents.query_cache.get_stats(),
+            'database': get_connection_manager().get_stats(),
+            'shards': shard_router.get_stats(),
+            'replica': get_replica_stats(),
+            'speculation': agents.get_speculation_stats(),
+            'llm': agents.get_scheduler_stats(),
+        }
+
+
+async def _read_request(reader: asyncio.StreamReader):
+    head = await reader.readuntil(b"\r\n\r\n")
+    lines = head.decode("latin-1").split("\r\n")
+    method, path, _ = lines[0].split(" ", 2)
+    headers = {}
+    for line in lines[1:]:
+        if ":" in line:
+            name, value = line.split(":", 1)
+            headers[name.strip().lower()] = value.strip()
+    length = int(headers.get("content-length", "0"))
+    body = await reader.readexactly(length) if length else b""
+    return method, path, headers, body
+
+
+def _response(status: int, payload: Dict[str, Any], keep_alive: bool) -> bytes:
+    body = json.dumps(payload, ensure_ascii=False, default=str).encode("utf-8")
+    head = (
+        f"HTTP/1.1 {status} {_REASONS[status]}\r\n"
+        "Content-Type: application/json; charset=utf-8\r\n"
+        f"Content-Length: {len(body)}\r\n"
+        f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+    )
+    return head.encode("latin-1") + body
+
+
+def make_handler(server: ChatServer, agents):
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                try:
+                    method, path, headers, body = await _read_request(reader)
+                except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+                    break
+                keep_alive = headers.get("connection", "").lower() != "close"
+
+                if path == "/stats" and method == "GET":
+                    status, payload = 200, server.get_stats(agents)
+                elif path == "/chat" and method == "POST":
+                    try:
+                        request = json.loads(body or b"{}")
+                        message = request["message"]
+                    except (ValueError, KeyError, TypeError):
+                        status, payload = 400, {"error": 'Expected JSON body with a "message" field'}
+                    else:
+                        try:
+                            status, payload = 200, await server.chat(
+                                message, request.get("thread_id"), request.get("user_id")
+                            )
+                        except Exception as e:
+                            status, payload = 500, {"error": str(e)}
+                elif path in ("/chat", "/stats"):
+                    status, payload = 405, {"error": f"{method} not allowed on {path}"}
+                else:
+                    status, payload = 404, {"error": f"Unknown path {path}"}
+
+                writer.write(_response(status, payload, keep_alive))
+                await writer.drain()
+                if not keep_alive:
+                    break
+        finally:
+            writer.close()
+    return handle
+
+
+async def run_load_test(server: ChatServer, users: int, turns: int) -> Dict[str, Any]:
+    """Simulate concurrent users, each in its own thread, and report latency percentiles"""
+    latencies = []
+
+    async def user(index: int) -> None:
+        thread_id = f"load-{index}-{uuid.uuid4().hex[:8]}"
+        for turn in range(turns):
+            message = LOAD_TEST_MESSAGES[(index + turn) % len(LOAD_TEST_MESSAGES)]
+            result = await server.chat(message, thread_id, user_id=f"load-user-{index}")
+            latencies.append(result["seconds"])
+
+    started = time.perf_counter()
+    await asyncio.gather(*(user(i) for i in range(users)))
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {
+        'users': users,
+        'turns': len(latencies),
+        'seconds': round(elapsed, 3),
+        'turns_per_second': round(len(latencies) / elapsed, 2) if elapsed else None,
+        'p50': latencies[len(latencies) // 2] if latencies else None,
+        'p95': latencies[int(len(latencies) * 0.95) - 1] if latencies else None,
+        'mean': round(statistics.mean(latencies), 4) if latencies else None,
+    }
+
+
+async def serve(args) -> None:
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=args.threads, thread_name_prefix="coinchat-db"))
+
+    # multi-agent.py 在第一次使用時才建立模型，provider 須在那之前決定
+    if args.fake:
+        API_SETTING['PROVIDER'] = 'fake'
+    # 假模型沒有供應商的速率限制，預設不套用 token bucket，否則壓力測試量到的是 bucket 而非伺服器
+    rate = args.rate if args.rate is not None else (0 if args.fake else None)
+    if rate is not None:
+        LLM_SCHEDULER_SETTING['RATE_PER_MINUTE'] = rate
+    agents = importlib.import_module("multi-agent")
+    server = ChatServer(agents.graph, args.concurrency)
+
+    if args.load_test:
+        report = await run_load_test(server, args.load_test, args.turns)
+        report['server'] = server.get_stats(agents)
+        print(json.dumps(report, ensure_ascii=False, indent=2, default=str))
+        return
+
+    http = await asyncio.start_server(make_handler(server, agents), args.host, args.port)
+    print(f"Serving on http://{args.host}:{args.port} (max {args.concurrency} concurrent turns)")
+    # 先開始接受連線，模型與 agent 在背景建立；期間進來的請求會等它們建好
+    loop.run_in_executor(None, agents.warm_up)
+    async with http:
+        await http.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Multi-session asyncio server for Multi-Agent-CoinChat")
+    parser.add_argument("--host", default=SERVER_SETTING['HOST'])
+    parser.add_argument("--port", type=int, default=SERVER_SETTING['PORT'])
+    parser.add_argument("--concurrency", type=int, default=SERVER_SETTING['MAX_CONCURRENCY'])
+    parser.add_argument("--threads", type=int, default=SERVER_SETTING['DB_THREADS'])
+    parser.add_argument("--fake", action="store_true", help="use the local fake model instead of Gemini")
+    parser.add_argument("--load-test", type=int, default=0, metavar="USERS", help="run a local load test and exit")
+    parser.add_argument("--turns", type=int, default=5, help="turns per simulated user in --load-test")
+    parser.add_argument("--rate", type=float, default=None,
+                        help="model requests per minute (default: LLM_RATE_PER_MINUTE, unlimited with --fake; 0 = unlimited)")
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        print("Goodbye!")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+"""
+Bookkeeping for speculative query drafting.
+
+When a message falls through the rule-based router but looks like a query,
+the graph runs the query agent (the "draft") in parallel with the intent
+checker. Each speculation is settled once both sides have reported:
+- hit: the intent checker handed off to query_agent and the draft finished,
+  so query_agent commits the draft instead of calling the model again. The
+  latency saved is min(draft, classification) — the shorter of the two no
+  longer runs after the other.
+- dropped: the intent checker decided otherwise; the draft's model time was
+  wasted (query tools are read-only, so nothing else needs undoing). The
+  draft is also cancelled before its next model call, because the graph
+  waits for both parallel nodes before moving on.
+- failed: the draft raised or handed back to the intent checker; query_agent
+  runs normally if it is reached.
+"""
+import logging
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, Optional, Tuple
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.tracers.context import register_configure_hook
+
+_MAX_PENDING = 1000
+
+
+class SpeculationCancelled(Exception):
+    """Raised in a draft once the intent checker has decided against it"""
+
+
+class DraftGuard(BaseCallbackHandler):
+    """Stops a cancelled draft at its next model call"""
+
+    raise_error = True
+    run_inline = True
+
+    def __init__(self, cancelled: threading.Event):
+        self.cancelled = cancelled
+
+    def on_chat_model_start(self, serialized, messages, **kwargs) -> None:
+        # 只在模型呼叫前檢查：工具的例外會被 ToolNode 轉成錯誤訊息，無法中止 agent
+        if self.cancelled.is_set():
+            raise SpeculationCancelled()
+
+
+_draft_guard_var: ContextVar[Optional[DraftGuard]] = ContextVar("coinchat_draft_guard", default=None)
+register_configure_hook(_draft_guard_var, inheritable=True)
+
+
+class _IgnoreDraftGuard(logging.Filter):
+    """LangChain logs every exception raised by a callback; a cancelled draft is expected, not an error"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return not (isinstance(record.args, tuple) and record.args[:1] == (DraftGuard.__name__,))
+
+
+logging.getLogger("langchain_core.callbacks.manager").addFilter(_IgnoreDraftGuard())
+
+
+class SpeculationStats:
+    """Thread-safe counters for speculative drafts, keyed by the question's message id"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._drafts: "OrderedDict[str, Tuple[bool, float]]" = OrderedDict()
+        self._verdicts: "OrderedDict[str, Tuple[bool, float]]" = OrderedDict()
+        self._cancel: Dict[str, threading.Event] = {}
+        self.stats = {
+            'started': 0, 'hits': 0, 'dropped': 0, 'failed': 0,
+            'draft_seconds': 0.0, 'latency_saved_seconds': 0.0, 'wasted_seconds': 0.0,
+        }
+
+    def started(self) -> None:
+        with self._lock:
+            self.stats['started'] += 1
+
+    @contextmanager
+    def guard(self, question_id: str) -> Iterator[None]:
+        """Run a draft so that a disagreeing intent checker cancels its remaining model calls"""
+        with self._lock:
+            cancelled = self._cancel.setdefault(question_id, threading.Event())
+        token = _draft_guard_var.set(DraftGuard(cancelled))
+        try:
+            yield
+        finally:
+            _draft_guard_var.reset(token)
+
+    def drafted(self, question_id: str, ok: bool, seconds: float) -> None:
+        """The draft finished; ok is False when it raised, was cancelled or handed back"""
+        with self._lock:
+            self._cancel.pop(question_id, None)
+            self.stats['draft_seconds'] += seconds
+            self._remember(self._drafts, question_id, (ok, seconds))
+            self._settle(question_id)
+
+    def classified(self, question_id: str, agrees: bool, seconds: float) -> None:
+        """The intent checker finished; agrees is True when it handed off to query_agent"""
+        with self._lock:
+            if not agrees and question_id not in self._drafts:
+                # 草稿可能還沒開始，先建立事件讓它一開始就停止
+                self._cancel.setdefault(question_id, threading.Event()).set()
+            self._remember(self._verdicts, question_id, (agrees, seconds))
+            self._settle(question_id)
+
+    def _remember(self, pending: OrderedDict, question_id: str, value: Tuple[bool, float]) -> None:
+        pending[question_id] = value
+        # 只有一方回報的項目（例如執行中途失敗）不能無限累積
+        while len(pending) > _MAX_PENDING:
+            pending.popitem(last=False)
+
+    def _settle(self, question_id: str) -> None:
+        if question_id not in self._drafts or question_id not in self._verdicts:
+            return
+        ok, draft_seconds = self._drafts.pop(question_id)
+        agrees, classify_seconds = self._verdicts.pop(question_id)
+        if not agrees:
+            self.stats['dropped'] += 1
+            self.stats['wasted_seconds'] += draft_seconds
+        elif not ok:
+            self.stats['failed'] += 1
+        else:
+            self.stats['hits'] += 1
+            self.stats['latency_saved_seconds'] += min(draft_seconds, classify_seconds)
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self.stats)
+        settled = stats['hits'] + stats['dropped'] + stats['failed']
+        stats['hit_rate'] = stats['hits'] / settled if settled else 0.0
+        for key in ('draft_seconds', 'latency_saved_seconds', 'wasted_seconds'):
+            stats[key] = round(stats[key], 4)
+        return stats
+
+    def reset(self) -> None:
+        with self._lock:
+            self._drafts.clear()
+            self._verdicts.clear()
+            self._cancel.clear()
+            for key in self.stats:
+                self.stats[key] = 0
+
+
+speculation_stats = SpeculationStats()
+
+
+def get_speculation_stats() -> Dict[str, Any]:
+    return speculation_stats.get_stats()
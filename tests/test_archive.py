@@ -0,0 +1,98 @@
+"""Archived rows must not change query answers (db/archive.py)"""
+import pytest
+
+from db.archive import sql_date_range
+
+
+@pytest.mark.parametrize("sql", [
+    "SELECT COUNT(*) FROM transactions WHERE NOT (date >= '2021-01-01')",
+    "SELECT COUNT(*) FROM transactions t WHERE t.date >= '2026-01-01' OR t.amount > 100",
+    "SELECT COUNT(*) FROM transactions WHERE date >= '2024-01-01' OR item = 'coffee'",
+    "SELECT COUNT(*) FROM transactions WHERE date != '2024-01-01'",
+    "SELECT COUNT(*) FROM transactions WHERE date_key NOT BETWEEN 20240101 AND 20240131",
+    "SELECT COUNT(*) FROM transactions WHERE substr(date, 1, 7) = '2024-03'",
+    "SELECT COUNT(*) FROM transactions WHERE date_key IN (20240101, 20240102)",
+    "SELECT COUNT(*) FROM transactions WHERE date >= '2024-01-01' AND (item = 'a' OR amount > 5)",
+    "SELECT * FROM (SELECT date, SUM(amount) OVER (ORDER BY date) AS s FROM transactions) WHERE date >= '2024-01-01'",
+    "WITH t AS (SELECT * FROM transactions) SELECT COUNT(*) FROM t WHERE date >= '2024-01-01'",
+    "SELECT COUNT(*) FROM transactions WHERE amount > 100",
+    "SELECT COUNT(*) FROM transactions -- WHERE date >= '2024-01-01'",
+])
+def test_unbounded_shapes(sql):
+    assert sql_date_range(sql) == (None, None)
+
+
+@pytest.mark.parametrize("sql, expected", [
+    ("SELECT SUM(amount) FROM transactions WHERE date_key BETWEEN 20240101 AND 20240131 AND transaction_type = 'Expense'",
+     (20240101, 20240131)),
+    ("SELECT * FROM transactions WHERE date >= '2024-03-01' AND date < '2024-04-01' ORDER BY date", (20240301, 20240401)),
+    ("SELECT * FROM transactions WHERE (date >= '2024-01-01' AND date <= '2024-01-31')", (20240101, 20240131)),
+    ("SELECT * FROM transactions WHERE date LIKE '2024-03%' GROUP BY item", (20240301, 20240331)),
+    ("SELECT * FROM transactions WHERE item = 'A OR NOT B' AND date_key >= 20240105", (20240105, None)),
+    ("SELECT * FROM transactions WHERE date >= '2023-01-01' AND date >= '2024-06-01'", (20240601, None)),
+    ("SELECT * FROM transactions WHERE date = '2024-02-29'", (20240229, 20240229)),
+])
+def test_bounded_conjunctions(sql, expected):
+    assert sql_date_range(sql) == expected
+
+
+def test_date_function_bound():
+    start, end = sql_date_range("SELECT * FROM transactions WHERE date >= date('now', '-1 month')")
+    assert start is not None and end is None
+
+
+@pytest.fixture
+def archived_ledger(tmp_path, monkeypatch):
+    """A ledger with two transactions archived (2020) and one in the hot table (2026)"""
+    monkeypatch.setenv('DATABASE_PATH', str(tmp_path / 'ledger.db'))
+    from db.connection import close_all
+    from db.db_init import DatabaseManager, date_key
+
+    manager = DatabaseManager()
+    manager.migrate()
+    rows = [('Coffee', 80.0, '2020-03-01', 'Expense'), ('Taxi', 300.0, '2020-04-02', 'Expense'),
+            ('Lunch', 150.0, '2026-01-05', 'Expense')]
+    with manager.connections.writer() as conn:
+        conn.executemany(
+            "INSERT INTO transactions (item, amount, date, transaction_type, date_key) VALUES (?, ?, ?, ?, ?)",
+            [row + (date_key(row[2]),) for row in rows],
+        )
+    assert manager.archive(before='2021-01-01')['rows'] == 2
+    yield manager
+    close_all()
+
+
+@pytest.mark.parametrize("sql, expected", [
+    ("SELECT COUNT(*) FROM transactions WHERE NOT (date >= '2021-01-01')", 2),
+    ("SELECT COUNT(*) FROM transactions t WHERE t.date >= '2026-01-01' OR t.amount > 100", 2),
+    ("SELECT COUNT(*) FROM transactions WHERE date >= '2026-01-01' OR item = 'Coffee'", 2),
+    ("SELECT COUNT(*) FROM transactions WHERE date_key BETWEEN 20200101 AND 20200331", 1),
+    ("SELECT SUM(amount) FROM transactions", 530.0),
+])
+def test_execute_sql_reads_archived_rows(archived_ledger, sql, expected):
+    import tools
+
+    result = tools.execute_sql.invoke({"sql": sql})
+    assert result["status"] == "success", result
+    assert result["rows"][0][0] == expected
+
+
+def test_execute_sql_rejects_large_archive_loads(archived_ledger, monkeypatch):
+    import tools
+    from config import ARCHIVE_SETTING
+
+    monkeypatch.setitem(ARCHIVE_SETTING, 'MAX_QUERY_ROWS', 1)
+    result = tools.execute_sql.invoke({"sql": "SELECT SUM(amount) + 0 FROM transactions"})
+    assert result["status"] == "rejected" and result["reason"] == "archive_scan"
+    # 只涵蓋一個封存期間的查詢仍可執行
+    result = tools.execute_sql.invoke({"sql": "SELECT COUNT(*) FROM transactions WHERE date LIKE '2020-03%'"})
+    assert result["rows"][0][0] == 1
+
+
+def test_archive_load_counts_against_time_budget(archived_ledger, monkeypatch):
+    import tools
+    from config import DB_SETTING
+
+    monkeypatch.setitem(DB_SETTING, 'QUERY_TIMEOUT_MS', 1e-6)
+    result = tools.execute_sql.invoke({"sql": "SELECT MAX(amount) FROM transactions"})
+    assert result["status"] == "rejected" and result["reason"] == "timeout"
@@ -1,14 +1,175 @@
 import os
+import re
 import sqlite3
+import threading
+from calendar import monthrange
+from contextlib import closing, contextmanager, nullcontext
+from contextvars import ContextVar
+from datetime import date
+from functools import wraps
+from typing import Iterator, List, Literal, Optional
+
+from langchain_core.runnables.config import RunnableConfig, ensure_config
 from langchain_core.tools import tool
+from pydantic import BaseModel, Field, field_validator
+
+from config import DB_SETTING, SHARD_SETTING
+from db.db_init import DatabaseManager, date_key
+from db.importer import import_statement as import_statement_file, resolve_import_path
+from db.replica import get_read_manager as replica_or_primary, remember_write
+from db.sandbox import QueryRejected, check_plan, read_only_error, time_budget, unbounded_mutation
+from db.shards import shard_router
+from db.result_handles import ResultHandleStore
+from message_encoding import table
+from query_cache import query_cache
+from tracing import span, sql_span, traced_tool
+
+TABLE_NAME = os.getenv('TABLE_NAME', 'transactions')
+
+# 大型查詢結果的分頁 cursor，供 fetch_more 使用
+result_handles = ResultHandleStore()
+
+
+# 第一次使用時套用尚未執行的結構遷移（舊資料庫沒有彙總表與 date_key）
+_schema_ready = False
+_schema_lock = threading.Lock()
+
+
+def current_tenant(config: RunnableConfig = None) -> Optional[str]:
+    """Tenant of the running graph call (configurable[SHARD_SETTING['KEY']]), None when sharding is off"""
+    if not SHARD_SETTING['ENABLED']:
+        return None
+    # 工具與節點執行時，LangChain 會把目前的 graph config 放在 context 中
+    configurable = (config or ensure_config()).get('configurable') or {}
+    tenant = configurable.get(SHARD_SETTING['KEY'])
+    return str(tenant) if tenant not in (None, '') else None
+
+
+# 目前工具呼叫租用的連線管理器
+_leased_db: ContextVar = ContextVar('leased_db', default=None)
+
+
+@contextmanager
+def tenant_db(config: RunnableConfig = None) -> Iterator:
+    """The current tenant's ConnectionManager (DATABASE_PATH's when sharding is off), not evicted until the block exits"""
+    leased = _leased_db.get()
+    if leased is not None and config is None:
+        yield leased
+        return
+    with shard_router.lease(current_tenant(config)) as manager:
+        token = _leased_db.set(manager)
+        try:
+            yield manager
+        finally:
+            _leased_db.reset(token)
+
+
+def uses_tenant_db(func):
+    """Decorator for a tool function: holds tenant_db() for the whole call; apply it below @traced_tool"""
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        with tenant_db():
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def get_db_manager():
+    """ConnectionManager leased by the running tenant_db() block"""
+    leased = _leased_db.get()
+    if leased is None:
+        # 未租用的管理器可能被 ShardRouter 逐出關閉，同一分片會出現兩個寫入者
+        raise RuntimeError("get_db_manager() must be called inside tenant_db() or a @uses_tenant_db tool")
+    return leased
+
+
+def current_session(config: RunnableConfig = None) -> Optional[str]:
+    """Conversation of the running graph call (configurable thread_id)"""
+    configurable = (config or ensure_config()).get('configurable') or {}
+    return configurable.get('thread_id')
+
+
+# 查詢工具的讀取來源：開啟讀取副本時為夠新的快照，否則為主資料庫
+def get_read_manager():
+    return replica_or_primary(get_db_manager(), current_session())
+
+
+def wrote(manager) -> None:
+    """Make the current conversation read its own write from here on"""
+    remember_write(manager, current_session())
 
-# 連接到 SQLite 資料庫（或根據需要更改為其他資料庫）
-def get_db_connection():
-    conn = sqlite3.connect('db/transactions.db')
-    conn.row_factory = sqlite3.Row
-    return conn
+
+def has_archive(conn) -> bool:
+    """Whether old transactions were moved to archive files (db/archive.py, which loads NumPy only then)"""
+    try:
+        return conn.execute(f"SELECT 1 FROM {TABLE_NAME}_archive LIMIT 1").fetchone() is not None
+    except sqlite3.OperationalError:
+        return False
+
+
+def archive_entries(conn, start_key: int = None, end_key: int = None) -> list:
+    """Manifest entries of the archived periods overlapping the range"""
+    if not has_archive(conn):
+        return []
+    from db import archive
+    return archive.manifest(conn, TABLE_NAME, start_key, end_key)
+
+
+def sql_archive_range(conn, sql: str) -> tuple:
+    """(entries, start_key, end_key) of the archived rows a query may read; no entries if it does not read TABLE_NAME"""
+    # 彙總表與 FTS 表（transactions_daily、transactions_fts）不算
+    references = len(re.findall(rf"\b{TABLE_NAME}\b", sql, re.I))
+    if not references or not has_archive(conn):
+        return [], None, None
+    from db import archive
+    # 主表出現多次（子查詢、自我 JOIN）時各處的日期條件不同，不依日期篩選
+    start_key, end_key = archive.sql_date_range(sql) if references == 1 else (None, None)
+    return archive.manifest(conn, TABLE_NAME, start_key, end_key), start_key, end_key
+
+
+def open_archive(db, entries: list):
+    """Connection on which TABLE_NAME is the hot table plus an archived table, which load_archive fills.
+
+    Queries that would load more than ARCHIVE_SETTING['MAX_QUERY_ROWS']
+    archived rows (typically ones without a date range) are rejected.
+    """
+    from db import archive
+    rows = sum(entry['rows'] for entry in entries)
+    limit = archive.ARCHIVE_SETTING['MAX_QUERY_ROWS']
+    if rows > limit:
+        raise QueryRejected(
+            "archive_scan",
+            f"The query would load ~{rows} archived transactions from {len(entries)} archive files, "
+            f"more than the {limit} that can be read at once.",
+            "Add a date range (e.g. date_key BETWEEN 20230101 AND 20230331) so only the archive files of that "
+            "period are read. For totals over the whole history use summarize_transactions; its rollup tables "
+            "include archived transactions.",
+            archived_rows=rows,
+        )
+    return archive.open_with_archives(db.db_path, TABLE_NAME)
+
+
+def load_archive(conn, db, entries: list, start_key: int = None, end_key: int = None, deadline: float = None) -> int:
+    """Fill an open_archive connection; call it inside time_budget(conn) so the load counts against the budget"""
+    from db import archive
+    with span("archive_load", periods=len(entries)) as trace:
+        loaded = archive.load_archived(conn, db.db_path, entries, start_key, end_key, deadline)
+        trace.set(rows=loaded)
+    return loaded
+
+
+def ensure_schema() -> None:
+    global _schema_ready
+    # 分片第一次開啟時由 ShardRouter 套用遷移，這裡只負責 DATABASE_PATH
+    if _schema_ready or current_tenant() is not None:
+        return
+    with _schema_lock:
+        if not _schema_ready:
+            DatabaseManager().migrate()
+            _schema_ready = True
 
 @tool
+@traced_tool
+@uses_tenant_db
 def exec_sqlite3_sql(sql: str) -> str:
     """Execute SQL statement.
     
@@ -20,65 +181,662 @@ def exec_sqlite3_sql(sql: str) -> str:
     Returns:
         str: Execution result
     """
-    db_path = 'db/transactions.db'
+    # UPDATE / DELETE 沒有 WHERE 會改動整張表，一律拒絕；字串與註解中的 WHERE 不算
+    rejected = unbounded_mutation(sql)
+    if rejected:
+        return f"SQL execution error: {rejected}"
     try:
-        os.makedirs(os.path.dirname(db_path), exist_ok=True)
-        conn = sqlite3.connect(db_path)
-        cursor = conn.cursor()
-        
-        print(f"Executing SQL: {sql}")  # 除錯用
-        cursor.execute(sql)
-        conn.commit()
-        conn.close()
-        
+        manager = get_db_manager()
+        with manager.writer() as conn, sql_span(sql) as trace:
+            trace.set(rows=conn.execute(sql).rowcount)
+        wrote(manager)
+
         return "SQL execution successful"
     except Exception as e:
-        error_msg = f"SQL execution error: {str(e)}"
-        print(error_msg)  # 除錯用
-        return error_msg
+        return f"SQL execution error: {str(e)}"
+
+def _strip_sql(sql: str) -> str:
+    return sql.strip().rstrip(";").strip()
+
+
+def summarize_result(conn, sql: str, columns: List[str]) -> dict:
+    """Aggregate a result set in SQLite instead of returning its rows.
+
+    Returns the row count plus, per column, the number of non-null values,
+    the min/max and (for numeric values) the sum.
+    """
+    selects = ["COUNT(*)"]
+    for i, _ in enumerate(columns):
+        col = f"c{i}"
+        selects += [
+            f"COUNT({col})",
+            f"MIN({col})",
+            f"MAX({col})",
+            f"SUM(CASE WHEN typeof({col}) IN ('integer', 'real') THEN {col} END)",
+        ]
+    # 以 CTE 欄位清單依位置重新命名，避免欄位名稱重複或含特殊字元
+    aliases = ", ".join(f"c{i}" for i in range(len(columns)))
+    row = conn.execute(
+        f"WITH _q({aliases}) AS ({sql}) SELECT {', '.join(selects)} FROM _q"
+    ).fetchone()
+
+    summary = {"row_count": row[0], "columns": {}}
+    for i, name in enumerate(columns):
+        count, low, high, total = row[1 + i * 4: 5 + i * 4]
+        stats = {"count": count, "min": low, "max": high}
+        if total is not None:
+            stats["sum"] = total
+        summary["columns"][name] = stats
+    return summary
 
 @tool
+@traced_tool
+@uses_tenant_db
 def execute_sql(sql: str) -> dict:
     """
-    Execute the given SQL statement and return the results.
+    Execute the given read-only SQL query and return the results.
+
+    Queries run on a read-only connection with a time budget. A query that
+    would scan a large table in full, or runs too long, is not executed; you
+    get "status": "rejected" with a "reason" and a "hint" for a cheaper query.
+
+    At most a small number of rows are returned inline. When a SELECT returns
+    more rows than that, the rows are NOT included; instead you get a summary
+    (row count and per-column count/min/max/sum) and a "handle" that can be
+    passed to `fetch_more` to page through the rows. Prefer aggregate queries
+    (SUM, COUNT, GROUP BY) over selecting many rows.
+
+    Args:
+        sql (str): The SELECT (or WITH ... SELECT) query to execute.
+
+    Returns:
+        dict: A dictionary containing execution results.
+              - "status": Operation status ("success", "rejected" or "failure").
+              - "message": Detailed message.
+              - "reason": Why the query was rejected ("full_scan", "cross_scan", "timeout", "read_only", "invalid").
+              - "hint": How to write a cheaper query, when rejected.
+              - "columns": Column names.
+              - "row_count": Number of rows in the full result.
+              - "rows": Query results, one list of values per row in "columns" order, only when the result is small.
+              - "summary": Aggregates of the result, when it is too large to inline.
+              - "handle": Handle for `fetch_more`, when it is too large to inline.
+    """
+    sql = _strip_sql(sql)
+    max_rows = DB_SETTING['MAX_RESULT_ROWS']
+    ensure_schema()
+    # 快取以實際讀取來源的版本為鍵：讀副本時是快照的版本
+    db = get_read_manager()
+    version = db.write_version
+    cached = query_cache.get_result(sql, version)
+    if cached is not None:
+        return cached
+    archived = None
+    try:
+        with db.reader() as conn:
+            # 計畫檢查只看主資料庫；封存檔只載入查詢日期範圍內的列
+            check_plan(conn, sql)
+            entries, start_key, end_key = sql_archive_range(conn, sql)
+        if entries:
+            archived = open_archive(db, entries)
+        with (nullcontext(archived) if archived else db.reader()) as conn:
+            with time_budget(conn) as deadline:
+                if archived:
+                    load_archive(conn, db, entries, start_key, end_key, deadline)
+                with sql_span(sql) as trace:
+                    cursor = conn.execute(sql)
+                    if cursor.description is None:
+                        raise QueryRejected("read_only", "execute_sql only runs queries that return rows.")
+                    columns = [col[0] for col in cursor.description]
+                    rows = cursor.fetchmany(max_rows + 1)
+                    cursor.close()
+                    trace.set(rows=len(rows), archived_periods=len(entries))
+                if len(rows) <= max_rows:
+                    response = {
+                        "status": "success",
+                        "row_count": len(rows),
+                        **table(columns, rows),
+                    }
+                    query_cache.put_result(sql, version, response)
+                    return response
+                summary = summarize_result(conn, sql, columns)
+
+        # 含封存列的連線交給分頁 cursor，由它負責關閉
+        conn, archived = archived or db.open_connection(readonly=True), None
+        handle = result_handles.open(conn, sql, summary["row_count"], owner=current_tenant())
+        return {
+            "status": "success",
+            "columns": columns,
+            "row_count": summary["row_count"],
+            "summary": summary["columns"],
+            "handle": handle.id,
+            "message": (
+                f"The result has {summary['row_count']} rows, too many to return. "
+                "Answer from the summary, refine the query with aggregates or filters, "
+                "or call fetch_more with the handle to page through the rows."
+            )
+        }
+    except QueryRejected as e:
+        return e.to_dict()
+    except Exception as e:
+        rejected = read_only_error(e)
+        if rejected is not None:
+            return rejected.to_dict()
+        return {
+            "status": "failure",
+            "message": f"Error executing SQL: {e}"
+        }
+    finally:
+        if archived is not None:
+            archived.close()
+
+@tool
+@traced_tool
+def fetch_more(handle: str, n: int = 20) -> dict:
+    """
+    Fetch the next rows of a large query result returned by `execute_sql`.
 
     Args:
-        sql (str): The SQL statement to execute.
+        handle (str): The "handle" value returned by `execute_sql`.
+        n (int): Number of rows to fetch (capped by the server).
 
     Returns:
         dict: A dictionary containing execution results.
               - "status": Operation status ("success" or "failure").
+              - "columns": Column names.
+              - "rows": The next rows, one list of values per row in "columns" order.
+              - "has_more": Whether more rows remain behind the handle.
               - "message": Detailed message (in case of failure).
-              - "results": Query results (for successful SELECT statements).
     """
-    print(f"Executing SQL: {sql}")  # Log the SQL statement being executed
+    # handle 只屬於開啟它的租戶
+    owner = current_tenant()
+    result = result_handles.get(handle, owner)
+    if result is None:
+        return {
+            "status": "failure",
+            "message": "Unknown or expired handle. Run the query again with execute_sql."
+        }
+    remaining = DB_SETTING['MAX_HANDLE_ROWS'] - result.fetched
+    if remaining <= 0:
+        result_handles.release(handle, owner)
+        return {
+            "status": "rejected",
+            "reason": "row_cap",
+            "message": f"Paged through the maximum of {DB_SETTING['MAX_HANDLE_ROWS']} rows.",
+            "hint": "Answer from the rows and summary you have, or refine the query with filters or GROUP BY."
+        }
+    try:
+        with time_budget(result.conn):
+            rows = result.fetch(max(1, min(n, DB_SETTING['MAX_FETCH_ROWS'], remaining)))
+    except QueryRejected as e:
+        result_handles.release(handle, owner)
+        return e.to_dict()
+    except Exception as e:
+        result_handles.release(handle, owner)
+        return {
+            "status": "failure",
+            "message": f"Error fetching rows: {e}"
+        }
+    if result.exhausted or not rows:
+        result_handles.release(handle, owner)
+    return {
+        "status": "success",
+        **table(result.columns, rows),
+        "has_more": not result.exhausted and bool(rows) and result.fetched < DB_SETTING['MAX_HANDLE_ROWS'],
+    }
+
+class TransactionItem(BaseModel):
+    """A single confirmed transaction to record."""
+
+    item: str = Field(description="What the money was spent on or received for, e.g. 'coffee'")
+    amount: float = Field(gt=0, description="Positive amount of the transaction")
+    date: str = Field(description="Transaction date in YYYY-MM-DD format")
+    transaction_type: Literal["Expense", "Income"] = Field(
+        default="Expense", description='"Expense" or "Income"'
+    )
+
+    @field_validator("item")
+    @classmethod
+    def _check_item(cls, value: str) -> str:
+        value = value.strip()
+        if not value:
+            raise ValueError("item must not be empty")
+        return value
+
+    @field_validator("date")
+    @classmethod
+    def _check_date(cls, value: str) -> str:
+        return date.fromisoformat(value.strip()).isoformat()
+
+
+def insert_transactions(items: List[TransactionItem]) -> int:
+    """Insert validated transactions in a single write transaction and return the row count"""
+    rows = [(t.item, t.amount, t.date, t.transaction_type, date_key(t.date)) for t in items]
+    sql = f"INSERT INTO {TABLE_NAME} (item, amount, date, transaction_type, date_key) VALUES (?, ?, ?, ?, ?)"
+    ensure_schema()
+    with tenant_db() as manager:
+        with manager.writer() as conn, sql_span(sql) as trace:
+            conn.executemany(sql, rows)
+            trace.set(rows=len(rows))
+        wrote(manager)
+    return len(rows)
+
+@tool
+@traced_tool
+def record_transactions(items: List[TransactionItem]) -> dict:
+    """
+    Record one or more confirmed transactions in a single atomic write.
+
+    Use this right after the user confirms the transaction details. Pass every
+    confirmed transaction in one call, e.g. "lunch 150, taxi 30, coffee 80"
+    becomes three items. Either all items are stored or none are.
+
+    Args:
+        items (list): Transactions, each with item, amount, date (YYYY-MM-DD)
+            and transaction_type ("Expense" or "Income").
+
+    Returns:
+        dict: A dictionary containing execution results.
+              - "status": Operation status ("success" or "failure").
+              - "inserted": Number of recorded transactions (on success).
+              - "message": Detailed message.
+    """
+    if not items:
+        return {
+            "status": "failure",
+            "message": "No transactions to record."
+        }
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute(sql)
-        
-        # Check if the SQL statement is a SELECT query
-        if sql.strip().upper().startswith("SELECT"):
-            rows = cursor.fetchall()
-            # Convert each row to dictionary format
-            results = [dict(row) for row in rows]
-            conn.close()
-            print(f"SQL Execution Success: Retrieved {len(results)} records.")  # Log success
-            return {
-                "status": "success",
-                "results": results
-            }
+        inserted = insert_transactions(items)
+        return {
+            "status": "success",
+            "inserted": inserted,
+            "message": f"Recorded {inserted} transaction(s)."
+        }
+    except Exception as e:
+        return {
+            "status": "failure",
+            "message": f"Error recording transactions: {e}"
+        }
+
+def _whole_months(start_date: Optional[str], end_date: Optional[str]) -> bool:
+    """True when the range starts on a 1st and ends on a month's last day (open ends count)"""
+    if start_date and not start_date.endswith("-01"):
+        return False
+    if end_date:
+        end = date.fromisoformat(end_date)
+        return end.day == monthrange(end.year, end.month)[1]
+    return True
+
+@tool
+@traced_tool
+@uses_tenant_db
+def summarize_transactions(
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+    transaction_type: Optional[Literal["Expense", "Income"]] = None,
+    group_by: Literal["total", "day", "month", "item"] = "total",
+    limit: int = 20,
+) -> dict:
+    """
+    Totals and counts of transactions, read from pre-aggregated daily/monthly tables.
+
+    Use this instead of `execute_sql` for totals by period, type or item, e.g.
+    "本月總支出", "monthly income this year" or "what did I spend most on last month".
+    It costs the same no matter how many transactions are stored.
+
+    Args:
+        start_date (str): First day of the range, YYYY-MM-DD (optional).
+        end_date (str): Last day of the range, YYYY-MM-DD (optional).
+        transaction_type (str): "Expense" or "Income" (optional, both when omitted).
+        group_by (str): "total", "day", "month" or "item" (items ordered by total, largest first).
+        limit (int): Maximum rows for day/month/item groupings.
+
+    Returns:
+        dict: A dictionary containing execution results.
+              - "status": Operation status ("success" or "failure").
+              - "columns": Column names.
+              - "rows": Rows of transaction_type, the group key, total and count, in "columns" order.
+              - "source": Table the totals were read from.
+              - "message": Detailed message (in case of failure).
+    """
+    try:
+        start_date = date.fromisoformat(start_date).isoformat() if start_date else None
+        end_date = date.fromisoformat(end_date).isoformat() if end_date else None
+    except ValueError as e:
+        return {"status": "failure", "message": f"Dates must be YYYY-MM-DD: {e}"}
+    limit = max(1, min(limit, DB_SETTING['MAX_RESULT_ROWS']))
+    whole_months = _whole_months(start_date, end_date)
+
+    # 依查詢範圍挑選最小的彙總表：整月用月表，其餘用日表；非整月的項目彙總只能查原始表
+    if group_by == "item" and not whole_months:
+        source, key, period, item = TABLE_NAME, "item", "date_key", "item"
+        total, count = "SUM(amount)", "COUNT(*)"
+    else:
+        item = "item" if group_by == "item" else None
+        if whole_months and group_by != "day":
+            source = f"{TABLE_NAME}_monthly_items" if item else f"{TABLE_NAME}_monthly"
+            period = "month"
         else:
-            conn.commit()
-            conn.close()
-            print("SQL Execution Success: Non-SELECT statement executed.")  # Log success
-            return {
-                "status": "success",
-                "message": "SQL statement executed successfully."
-            }
+            source, period = f"{TABLE_NAME}_daily", "day"
+        key = {"total": None, "day": "day", "month": f"substr({period}, 1, 7)", "item": "item"}[group_by]
+        total, count = "SUM(total)", "SUM(count)"
+
+    def bound(value: str):
+        return {"month": value[:7], "date_key": date_key(value)}.get(period, value)
+
+    where, params = [], []
+    if start_date:
+        where.append(f"{period} >= ?")
+        params.append(bound(start_date))
+    if end_date:
+        where.append(f"{period} <= ?")
+        params.append(bound(end_date))
+    if transaction_type:
+        where.append("transaction_type = ?")
+        params.append(transaction_type)
+
+    select = ["transaction_type"]
+    if key:
+        select.append(f"{key} AS {group_by}")
+    group = ", ".join(["transaction_type"] + ([group_by] if key else []))
+    order = f"transaction_type, {group_by}" if group_by in ("day", "month") else "transaction_type"
+    if group_by == "item":
+        order = "transaction_type, total DESC"
+    sql = (
+        f"SELECT {', '.join(select)}, ROUND({total}, 2) AS total, {count} AS count FROM {source}"
+        + (f" WHERE {' AND '.join(where)}" if where else "")
+        + f" GROUP BY {group} ORDER BY {order}"
+        + (f" LIMIT {limit}" if key else "")
+    )
+
+    try:
+        ensure_schema()
+        db = get_read_manager()
+        entries = []
+        if source == TABLE_NAME:
+            # 彙總表已含封存的交易，只有直接查原始表時要併入封存檔
+            start_key = date_key(start_date) if start_date else None
+            end_key = date_key(end_date) if end_date else None
+            with db.reader() as conn:
+                entries = archive_entries(conn, start_key, end_key)
+        reader = closing(open_archive(db, entries)) if entries else db.reader()
+        with reader as conn, time_budget(conn) as deadline:
+            if entries:
+                load_archive(conn, db, entries, start_key, end_key, deadline)
+            with sql_span(sql) as trace:
+                cursor = conn.execute(sql, params)
+                columns = [col[0] for col in cursor.description]
+                rows = cursor.fetchall()
+                trace.set(rows=len(rows), source=source)
+        return {
+            "status": "success",
+            **table(columns, rows),
+            "source": source,
+        }
+    except QueryRejected as e:
+        return e.to_dict()
     except Exception as e:
-        print(f"SQL Execution Failure: {e}")  # Log failure
         return {
             "status": "failure",
-            "message": f"Error executing SQL: {e}"
-        }
\ No newline at end of file
+            "message": f"Error summarizing transactions: {e}"
+        }
+
+# trigram 索引只能比對 3 個字以上的片段；較短的關鍵字先從彙總表找出項目名稱
+MIN_TRIGRAM_CHARS = 3
+MAX_SEARCH_ITEMS = 50
+
+
+def _like_pattern(term: str) -> str:
+    return "%" + re.sub(r"([\\%_])", r"\\\1", term) + "%"
+
+
+def _search_sql(conn, terms: List[str], filters: List[str], filter_params: list, start_date, end_date):
+    """Build the UNION of full-text matches and short-keyword item matches, best first"""
+    columns = "t.id, t.date, t.item, t.amount, t.transaction_type"
+    where = "".join(f" AND {f}" for f in filters)
+    selects, params = [], []
+
+    long_terms = [t for t in terms if len(t) >= MIN_TRIGRAM_CHARS]
+    if long_terms:
+        match = " OR ".join('"' + t.replace('"', '""') + '"' for t in long_terms)
+        selects.append(
+            f"SELECT {columns}, bm25({TABLE_NAME}_fts) AS rank FROM {TABLE_NAME}_fts "
+            f"JOIN {TABLE_NAME} t ON t.id = {TABLE_NAME}_fts.rowid "
+            f"WHERE {TABLE_NAME}_fts MATCH ?{where}"
+        )
+        params += [match] + filter_params
+
+    short_terms = [t for t in terms if len(t) < MIN_TRIGRAM_CHARS]
+    if short_terms:
+        month_filters, month_params = [], []
+        if start_date:
+            month_filters.append("month >= ?")
+            month_params.append(start_date[:7])
+        if end_date:
+            month_filters.append("month <= ?")
+            month_params.append(end_date[:7])
+        likes = " OR ".join("item LIKE ? ESCAPE '\\'" for _ in short_terms)
+        items = [row[0] for row in conn.execute(
+            f"SELECT DISTINCT item FROM {TABLE_NAME}_monthly_items WHERE ({likes})"
+            + "".join(f" AND {f}" for f in month_filters) + f" LIMIT {MAX_SEARCH_ITEMS}",
+            [_like_pattern(t) for t in short_terms] + month_params,
+        )]
+        if items:
+            selects.append(
+                f"SELECT {columns}, 0.0 AS rank FROM {TABLE_NAME} t "
+                f"WHERE t.item IN ({', '.join('?' for _ in items)}){where}"
+            )
+            params += items + filter_params
+
+    if not selects:
+        return None, []
+    # bm25 越小越相關；短關鍵字的結果排在全文比對之後，同分再依日期新到舊
+    return " UNION ALL ".join(selects) + " ORDER BY rank, date DESC, id DESC LIMIT ?", params
+
+@tool
+@traced_tool
+@uses_tenant_db
+def search_transactions(
+    keywords: str,
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+    transaction_type: Optional[Literal["Expense", "Income"]] = None,
+    limit: int = 20,
+) -> dict:
+    """
+    Find transactions whose item contains any of the keywords, best matches first.
+
+    Use this for keyword questions such as "購買文具的交易" or "all coffee
+    purchases last month" instead of `execute_sql` with `item LIKE '%...%'`.
+    It uses a full-text index over item, so it stays fast for any ledger size.
+
+    Args:
+        keywords (str): One or more keywords separated by spaces, e.g. "文具" or "coffee latte".
+        start_date (str): First day of the range, YYYY-MM-DD (optional).
+        end_date (str): Last day of the range, YYYY-MM-DD (optional).
+        transaction_type (str): "Expense" or "Income" (optional, both when omitted).
+        limit (int): Maximum number of transactions to return.
+
+    Returns:
+        dict: A dictionary containing execution results.
+              - "status": Operation status ("success", "rejected" or "failure").
+              - "columns": Column names.
+              - "rows": Matching transactions, one list of values per row in "columns" order.
+              - "has_more": Whether more transactions matched than were returned.
+              - "message": Detailed message (in case of failure).
+    """
+    terms = list(dict.fromkeys(t for t in re.split(r"[\s,，、;；]+", keywords or "") if t))
+    if not terms:
+        return {"status": "failure", "message": "Give at least one keyword to search for."}
+    try:
+        start_date = date.fromisoformat(start_date).isoformat() if start_date else None
+        end_date = date.fromisoformat(end_date).isoformat() if end_date else None
+    except ValueError as e:
+        return {"status": "failure", "message": f"Dates must be YYYY-MM-DD: {e}"}
+    limit = max(1, min(limit, DB_SETTING['MAX_RESULT_ROWS']))
+
+    filters, filter_params = [], []
+    if start_date:
+        filters.append("t.date_key >= ?")
+        filter_params.append(date_key(start_date))
+    if end_date:
+        filters.append("t.date_key <= ?")
+        filter_params.append(date_key(end_date))
+    if transaction_type:
+        filters.append("t.transaction_type = ?")
+        filter_params.append(transaction_type)
+
+    try:
+        ensure_schema()
+        db = get_read_manager()
+        columns = ["id", "date", "item", "amount", "transaction_type"]
+        with db.reader() as conn:
+            sql, params = _search_sql(conn, terms, filters, filter_params, start_date, end_date)
+            rows = []
+            if sql:
+                with time_budget(conn), sql_span(sql) as trace:
+                    rows = [[row[k] for k in columns] for row in conn.execute(sql, params + [limit + 1])]
+                    trace.set(rows=len(rows))
+            start_key = date_key(start_date) if start_date else None
+            end_key = date_key(end_date) if end_date else None
+            entries = archive_entries(conn, start_key, end_key) if len(rows) <= limit else []
+        if entries:
+            # 封存的交易不在全文索引中：比對封存檔的項目名稱，排在主表結果之後（新到舊）
+            from db import archive
+            archived = archive.load(db.db_path, entries, start_key, end_key, transaction_type)
+            if archived is not None:
+                matched = archived.matching(terms, limit + 1 - len(rows))
+                rows += [[i, day, item, amount, kind] for i, item, amount, day, kind, _, _ in matched.rows()]
+        return {
+            "status": "success",
+            **table(columns, rows[:limit]),
+            "has_more": len(rows) > limit,
+        }
+    except QueryRejected as e:
+        return e.to_dict()
+    except Exception as e:
+        return {
+            "status": "failure",
+            "message": f"Error searching transactions: {e}"
+        }
+
+@tool
+@traced_tool
+@uses_tenant_db
+def analyze_transactions(
+    analysis: Literal["trend", "top_items", "rolling", "percentiles", "compare"],
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+    transaction_type: Optional[Literal["Expense", "Income"]] = None,
+    period: Literal["day", "week", "month"] = "month",
+    window: int = 30,
+    limit: int = 10,
+) -> dict:
+    """
+    Trend and breakdown analytics over a date range, returned as a compact summary.
+
+    Use this for dashboard-style questions instead of writing complex SQL:
+      - "trend": totals per day/week/month with the change from the previous
+        period ("monthly spending trend this year").
+      - "top_items": items ranked by total with their share ("top 10 items by spend").
+      - "rolling": rolling average of daily totals over `window` days ("30-day rolling average").
+      - "percentiles": distribution of single transaction amounts (p50 ... p99).
+      - "compare": the range against the equally long period right before it,
+        with the items that changed most ("this month vs last month").
+
+    Args:
+        analysis (str): One of "trend", "top_items", "rolling", "percentiles", "compare".
+        start_date (str): First day of the range, YYYY-MM-DD (default: 12 months before end_date).
+        end_date (str): Last day of the range, YYYY-MM-DD (default: today).
+        transaction_type (str): "Expense" or "Income" (top_items and rolling default to "Expense").
+        period (str): "day", "week" or "month" for trend.
+        window (int): Window in days for rolling.
+        limit (int): Number of items for top_items and compare.
+
+    Returns:
+        dict: A dictionary containing execution results.
+              - "status": Operation status ("success", "rejected" or "failure").
+              - "analysis", "start_date", "end_date", "rows": What was analyzed.
+              - Analysis-specific summary fields (series, items, percentiles, deltas).
+              - "message": Detailed message (in case of failure).
+    """
+    try:
+        end = date.fromisoformat(end_date) if end_date else date.today()
+        if start_date:
+            start = date.fromisoformat(start_date)
+        else:
+            # 預設為含 end_date 當月在內的最近 12 個月
+            first_month = end.year * 12 + end.month - 12
+            start = date(first_month // 12, first_month % 12 + 1, 1)
+    except ValueError as e:
+        return {"status": "failure", "message": f"Dates must be YYYY-MM-DD: {e}"}
+    if start > end:
+        return {"status": "failure", "message": "start_date must not be after end_date."}
+    limit = max(1, min(limit, DB_SETTING['MAX_RESULT_ROWS']))
+    try:
+        # NumPy 只在第一次分析時載入，不拖慢啟動
+        from analytics import analytics
+
+        ensure_schema()
+        result = analytics.analyze(
+            get_read_manager(), TABLE_NAME, analysis, start.isoformat(), end.isoformat(),
+            transaction_type=transaction_type, period=period, window=max(1, window), limit=limit,
+        )
+    except QueryRejected as e:
+        return e.to_dict()
+    except Exception as e:
+        return {
+            "status": "failure",
+            "message": f"Error analyzing transactions: {e}"
+        }
+    return {"status": "success", **result}
+
+@tool
+@traced_tool
+@uses_tenant_db
+def import_statement(path: str, file_format: Optional[Literal["csv", "ofx"]] = None,
+                     expense_sign: Literal["negative", "positive"] = "negative") -> dict:
+    """
+    Import a bank or credit-card statement file (CSV or OFX) directly into the ledger.
+
+    Use this when the user names a statement file to import, instead of
+    recording its rows one by one. Rows already imported before are skipped.
+    Only files in the import directory can be imported.
+
+    Args:
+        path (str): File name of the statement in the import directory, e.g. "bank-2024-03.csv".
+        file_format (str): "csv" or "ofx" (detected from the file when omitted).
+        expense_sign (str): "negative" if expenses are negative amounts (most bank
+            exports), "positive" if purchases are positive amounts (most card exports).
+
+    Returns:
+        dict: A dictionary containing execution results.
+              - "status": Operation status ("success" or "failure").
+              - "inserted": Number of new transactions.
+              - "duplicates": Rows skipped because they were imported before.
+              - "skipped": Rows that could not be read.
+              - "message": Detailed message.
+    """
+    try:
+        # 路徑來自模型（伺服器模式下即遠端使用者），只允許匯入目錄內的檔案
+        resolved = resolve_import_path(path)
+        manager = get_db_manager()
+        report = import_statement_file(resolved, file_format=file_format, expense_sign=expense_sign,
+                                       db_path=manager.db_path)
+        wrote(manager)
+    except Exception as e:
+        return {
+            "status": "failure",
+            "message": f"Error importing statement: {e}"
+        }
+    return {
+        "status": "success",
+        "inserted": report["inserted"],
+        "duplicates": report["duplicates"],
+        "skipped": report["skipped"],
+        "errors": report["errors"][:3],
+        "message": (
+            f"Imported {report['inserted']} transaction(s) from {path} "
+            f"({report['duplicates']} already imported, {report['skipped']} unreadable)."
+        )
+    }
@@ -0,0 +1,322 @@
+"""
+Lightweight tracing for graph nodes, tools and model calls.
+
+Spans are kept in a context variable, so a tool span nests under the node
+that ran it, even across the executor threads LangGraph uses. Finished spans
+are written to a JSONL file, one OpenTelemetry-shaped span per line (trace_id,
+span_id, parent_span_id, name, start/end time in unix nanoseconds,
+attributes, status). Sampling is decided once per trace, so a sampled turn
+is always recorded in full.
+
+    python tracing.py summary                 # p50/p95 per node and tool
+    python tracing.py summary --path traces.jsonl --prefix tool:
+"""
+import argparse
+import functools
+import inspect
+import json
+import os
+import random
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.tracers.context import register_configure_hook
+
+from config import TRACING_SETTING
+
+_current_span: ContextVar[Optional["Span"]] = ContextVar("coinchat_span", default=None)
+
+
+class Span:
+    """One timed operation; counters added to a span also add to its ancestors"""
+
+    __slots__ = ('trace_id', 'span_id', 'parent', 'name', 'sampled', 'attributes', 'status', 'start_ns', 'end_ns',
+                 'lock')
+
+    def __init__(self, name: str, parent: Optional["Span"], sampled: bool, attributes: Dict[str, Any]):
+        self.name = name
+        self.parent = parent
+        self.trace_id = parent.trace_id if parent else uuid.uuid4().hex
+        self.span_id = uuid.uuid4().hex[:16]
+        self.sampled = sampled
+        self.attributes = attributes
+        self.status = 'OK'
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        # 同一 trace 共用根 span 的鎖：平行節點（query_draft 與 intent_checker_agent）會同時累加同一個祖先
+        self.lock = parent.lock if parent else threading.Lock()
+
+    def set(self, **attributes: Any) -> None:
+        self.attributes.update(attributes)
+
+    def add(self, key: str, value: float = 1) -> None:
+        with self.lock:
+            span = self
+            while span is not None:
+                span.attributes[key] = span.attributes.get(key, 0) + value
+                span = span.parent
+
+    def _snapshot(self) -> Dict[str, Any]:
+        with self.lock:
+            return dict(self.attributes)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_span_id': self.parent.span_id if self.parent else None,
+            'name': self.name,
+            'start_time_unix_nano': self.start_ns,
+            'end_time_unix_nano': self.end_ns,
+            'duration_ms': round((self.end_ns - self.start_ns) / 1e6, 3),
+            'attributes': self._snapshot(),
+            'status': self.status,
+        }
+
+
+class _NoopSpan:
+    """Stands in for a Span when tracing is disabled, so callers never check for None"""
+
+    parent = None
+    sampled = False
+
+    def set(self, **attributes: Any) -> None:
+        pass
+
+    def add(self, key: str, value: float = 1) -> None:
+        pass
+
+
+_NOOP = _NoopSpan()
+
+
+class JsonlSink:
+    """Appends finished spans to a JSONL file"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = None
+
+    def emit(self, span: Span) -> None:
+        line = json.dumps(span.to_dict(), ensure_ascii=False, default=str)
+        with self._lock:
+            if self._file is None:
+                directory = os.path.dirname(self.path)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                self._file = open(self.path, 'a', encoding='utf-8', buffering=1)
+            self._file.write(line + "\n")
+
+    def close(self) -> None:
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+class OpenTelemetrySink:
+    """Re-emits finished spans through the OpenTelemetry SDK (pip install opentelemetry-sdk)"""
+
+    def __init__(self):
+        from opentelemetry import trace
+
+        self._tracer = trace.get_tracer("coinchat")
+
+    def emit(self, span: Span) -> None:
+        attributes = {k: v if isinstance(v, (str, bool, int, float)) else str(v) for k, v in span._snapshot().items()}
+        otel_span = self._tracer.start_span(span.name, start_time=span.start_ns, attributes=attributes)
+        otel_span.end(end_time=span.end_ns)
+
+    def close(self) -> None:
+        pass
+
+
+_sink = None
+_sink_lock = threading.Lock()
+
+
+def get_sink():
+    global _sink
+    with _sink_lock:
+        if _sink is None:
+            if TRACING_SETTING['EXPORTER'] == 'otel':
+                _sink = OpenTelemetrySink()
+            else:
+                _sink = JsonlSink(TRACING_SETTING['PATH'])
+        return _sink
+
+
+def current_span() -> Optional[Span]:
+    return _current_span.get()
+
+
+@contextmanager
+def span(name: str, **attributes: Any) -> Iterator[Span]:
+    """Time a block as a child of the current span (or as a new trace)"""
+    if not TRACING_SETTING['ENABLED']:
+        yield _NOOP
+        return
+    parent = _current_span.get()
+    sampled = parent.sampled if parent else random.random() < TRACING_SETTING['SAMPLE_RATE']
+    current = Span(name, parent, sampled, attributes)
+    token = _current_span.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        # ParentCommand（agent 交接）也以例外傳遞，記錄型別但不視為錯誤
+        current.status = 'OK' if type(e).__name__ == 'ParentCommand' else 'ERROR'
+        current.attributes.setdefault('exception', type(e).__name__)
+        raise
+    finally:
+        current.end_ns = time.time_ns()
+        _current_span.reset(token)
+        if current.sampled:
+            get_sink().emit(current)
+
+
+def _traced(kind: str, name: str, func: Callable) -> Callable:
+    span_name = f"{kind}:{name}"
+    if inspect.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            with span(span_name):
+                return await func(*args, **kwargs)
+        return async_wrapper
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with span(span_name):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def traced_node(name: str) -> Callable[[Callable], Callable]:
+    """Decorator for a graph node function (sync or async)"""
+    return lambda func: _traced("node", name, func)
+
+
+def traced_tool(func: Callable) -> Callable:
+    """Decorator for a tool function; apply it below @tool"""
+    return _traced("tool", func.__name__, func)
+
+
+@contextmanager
+def sql_span(sql: str) -> Iterator[Span]:
+    """Span around one SQL execution; callers set rows= on it"""
+    with span("sql", statement=sql[:TRACING_SETTING['MAX_SQL_CHARS']]) as current:
+        started = time.perf_counter()
+        try:
+            yield current
+        finally:
+            if isinstance(current, Span):
+                elapsed = (time.perf_counter() - started) * 1000
+                current.set(sql_ms=round(elapsed, 3))
+                # 讓外層的 tool / node span 也累計 SQL 時間與筆數
+                if current.parent is not None:
+                    current.parent.add('sql_ms', elapsed)
+                    current.parent.add('rows', current.attributes.get('rows', 0))
+
+
+class ModelCallTracer(BaseCallbackHandler):
+    """Counts model calls and token usage on the span that made them"""
+
+    def on_chat_model_start(self, serialized, messages, **kwargs) -> None:
+        current = _current_span.get()
+        if current is not None:
+            current.add('llm_calls')
+
+    def on_llm_end(self, response, **kwargs) -> None:
+        current = _current_span.get()
+        if current is None:
+            return
+        prompt_tokens = completion_tokens = 0
+        for generations in response.generations:
+            for generation in generations:
+                usage = getattr(getattr(generation, 'message', None), 'usage_metadata', None) or {}
+                prompt_tokens += usage.get('input_tokens', 0)
+                completion_tokens += usage.get('output_tokens', 0)
+        if prompt_tokens or completion_tokens:
+            current.add('prompt_tokens', prompt_tokens)
+            current.add('completion_tokens', completion_tokens)
+
+
+# 所有 LangChain 執行自動掛上 ModelCallTracer，不需要在每個 invoke 傳入 callbacks
+_model_tracer_var: ContextVar[Optional[ModelCallTracer]] = ContextVar("coinchat_model_tracer", default=None)
+register_configure_hook(_model_tracer_var, inheritable=True)
+if TRACING_SETTING['ENABLED']:
+    _model_tracer_var.set(ModelCallTracer())
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(q * (len(ordered) - 1))))]
+
+
+def summarize(path: str, prefix: str = None) -> List[Dict[str, Any]]:
+    """Aggregate a JSONL trace file into per-span-name latency and usage statistics"""
+    groups: Dict[str, Dict[str, Any]] = {}
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            name = record['name']
+            if prefix and not name.startswith(prefix):
+                continue
+            group = groups.setdefault(name, {'durations': [], 'errors': 0, 'llm_calls': 0,
+                                             'prompt_tokens': 0, 'completion_tokens': 0, 'sql_ms': 0.0, 'rows': 0})
+            group['durations'].append(record['duration_ms'])
+            group['errors'] += record.get('status') == 'ERROR'
+            attributes = record.get('attributes') or {}
+            for key in ('llm_calls', 'prompt_tokens', 'completion_tokens', 'sql_ms', 'rows'):
+                group[key] += attributes.get(key, 0) or 0
+
+    rows = []
+    for name, group in sorted(groups.items()):
+        durations = group.pop('durations')
+        rows.append({
+            'name': name,
+            'count': len(durations),
+            'p50_ms': percentile(durations, 0.5),
+            'p95_ms': percentile(durations, 0.95),
+            'max_ms': max(durations),
+            **{k: round(v, 3) if isinstance(v, float) else v for k, v in group.items()},
+        })
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Tracing utilities for Multi-Agent-CoinChat")
+    subcommands = parser.add_subparsers(dest="command", required=True)
+    summary = subcommands.add_parser("summary", help="p50/p95 latency per node, tool and SQL span")
+    summary.add_argument("--path", default=TRACING_SETTING['PATH'])
+    summary.add_argument("--prefix", help='only spans whose name starts with this, e.g. "node:"')
+    summary.add_argument("--json", action="store_true", help="print JSON instead of a table")
+    args = parser.parse_args()
+
+    rows = summarize(args.path, args.prefix)
+    if args.json:
+        print(json.dumps(rows, ensure_ascii=False, indent=2))
+        return
+    header = f"{'span':<34}{'count':>7}{'p50 ms':>10}{'p95 ms':>10}{'llm':>6}{'tokens in/out':>16}{'sql ms':>10}{'rows':>8}"
+    print(header)
+    print("-" * len(header))
+    for row in rows:
+        tokens = f"{row['prompt_tokens']}/{row['completion_tokens']}"
+        print(
+            f"{row['name']:<34}{row['count']:>7}{row['p50_ms']:>10.2f}{row['p95_ms']:>10.2f}"
+            f"{row['llm_calls']:>6}{tokens:>16}{row['sql_ms']:>10.1f}{row['rows']:>8}"
+        )
+
+
+if __name__ == '__main__':
+    main()